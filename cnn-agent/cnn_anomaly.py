@@ -0,0 +1,173 @@
+import math
+
+
+class RunningStats:
+    ''' Running mean and variance of a stream (Welford's algorithm) '''
+
+    __slots__ = ('count', 'mean', 'sum_squares')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_squares = 0.0
+
+    def update(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.sum_squares += delta * (x - self.mean)
+
+    def variance(self):
+        return self.sum_squares / (self.count - 1) if self.count > 1 else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+class P2Quantile:
+    ''' Streaming estimate of the `p` quantile in constant memory
+
+        Jain and Chlamtac's P-square algorithm: five markers track the
+        minimum, the p/2, p and (1+p)/2 quantiles and the maximum, and the
+        middle markers are moved along a parabola fitted through their
+        neighbours as observations arrive.
+    '''
+
+    __slots__ = ('p', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def update(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def parabolic(self, i, d):
+        ''' Return the piecewise-parabolic prediction of marker `i` moved by `d` '''
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        ''' Return the current estimate (nan before any observation) '''
+        q = self.heights
+        if len(q) < 5:
+            return q[int(round(self.p * (len(q) - 1)))] if len(q) > 0 else float('nan')
+        return q[2]
+
+
+class StreamingMetric:
+    ''' Running mean, variance and tail quantiles of one metric
+
+        A value is an outlier once `warmup` values were seen if it lies past
+        the tail quantile and more than `z_threshold` standard deviations
+        from the mean, on the upper tail only or on both tails.
+    '''
+
+    def __init__(self, quantile = 0.999, z_threshold = 4.0, warmup = 1000,
+                 two_sided = False):
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.stats = RunningStats()
+        self.upper = P2Quantile(quantile)
+        self.lower = P2Quantile(1 - quantile) if two_sided else None
+
+    def is_outlier(self, x):
+        ''' Return whether `x` is an outlier of the values seen so far '''
+        if self.stats.count < self.warmup:
+            return False
+        if abs(x - self.stats.mean) <= self.z_threshold * self.stats.std():
+            return False
+        return x > self.upper.value() or \
+            (self.lower is not None and x < self.lower.value())
+
+    def update(self, x):
+        self.stats.update(x)
+        self.upper.update(x)
+        if self.lower is not None:
+            self.lower.update(x)
+
+    def summary(self):
+        return {
+            'count': self.stats.count,
+            'mean': self.stats.mean,
+            'std': self.stats.std(),
+            'upper': self.upper.value(),
+            'lower': self.lower.value() if self.lower is not None else float('nan')
+        }
+
+
+class AnomalyDetector:
+    ''' Flag notable steps from constant-memory statistics of their loss,
+        TD error, reward and Q-value spread (best minus worst action)
+
+        Rewards and TD errors are flagged on both tails, losses and Q-value
+        spreads only when unusually large. Each value is checked against the
+        steps before it, then added to the statistics.
+    '''
+
+    TWO_SIDED = {'loss': False, 'td_error': True, 'reward': True, 'q_spread': False}
+
+    def __init__(self, quantile = 0.999, z_threshold = 4.0, warmup = 1000):
+        self.metrics = {
+            name: StreamingMetric(quantile, z_threshold, warmup, two_sided)
+            for name, two_sided in self.TWO_SIDED.items()
+        }
+
+    def observe(self, values):
+        ''' Check and record the metric values of one step
+
+        Args:
+            values (dict): float value by metric name, where metrics missing
+                or None were not measured for the step
+
+        Returns:
+            list of the names of the metrics that were outliers
+        '''
+        reasons = []
+        for name, metric in self.metrics.items():
+            x = values.get(name)
+            if x is None or math.isnan(x):
+                continue
+            if metric.is_outlier(x):
+                reasons.append(name)
+            metric.update(x)
+        return reasons
+
+    def summary(self):
+        ''' Return the statistics of every metric by name '''
+        return {name: metric.summary() for name, metric in self.metrics.items()}
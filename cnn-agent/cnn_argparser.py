@@ -10,6 +10,11 @@ def CNNArgumentParser():
     # Converts string argument in for "w,h" into integer tuple, "30,20" -> (30,20)
     dimension_parser = lambda arg: tuple(map(int, arg.split(',')))
 
+    # Converts "game:state,game:state" into a list of (game, state) pairs, or
+    # "contest" into the contest validation levels
+    levels_parser = lambda arg: list(retro_utils.CONTEST_VALIDATION_LEVELS) \
+        if arg == 'contest' else [tuple(l.split(':', 1)) for l in arg.split(',')]
+
     # Add BUILD only arguments
     build = subparser.add_parser('build',
                         help='build the model using the provided configuration')
@@ -23,37 +28,163 @@ def CNNArgumentParser():
                         help='amount to increase initial bias term on running right')
     build.add_argument('--model_save_interval', default=1e4, type=int,
                         help='steps between overwriting model saves')
+    build.add_argument('--checkpoint_format', choices=['full','chunked'], default='full',
+                        help='single pickled checkpoint, or a manifest plus content-hashed '
+                             'per-tensor chunks that are only uploaded when changed')
+    build.add_argument('--checkpoint_fp16', action='store_true',
+                        help='toggle to store chunked checkpoint tensors as float16')
+    build.add_argument('--checkpoint_zlib', action='store_true',
+                        help='toggle to zlib-compress chunked checkpoint tensors')
     build.add_argument('--forecast_update_interval', default=1e3, type=int,
                         help='steps between update the Q-value future forecast model')
     build.add_argument('--image_to_grayscale', action='store_true',
                         help='toggle to convert input RGB image to grayscale')
     build.add_argument('--image_dimension', default=(320,224), type=dimension_parser,
                         help='the "width,height" to resize images for network')
+    build.add_argument('--frame_stack', default=1, type=int,
+                        help='number of latest screens stacked as network input '
+                             '(above 1 needs replay_type dedup or compressed)')
     build.add_argument('--use_experience_replay', action='store_true',
                         help='toggle to turn on batch-replay during training')
+    build.add_argument('--prefetch_batches', action='store_true',
+                        help='toggle to gather the next replay batch on a background '
+                             'thread while the emulators step')
     build.add_argument('--batch_size', default=16, type=int,
                         help='size of replay batches inclusive of latest screen')
     build.add_argument('--memory_size', default=10000, type=int,
                         help='memory size to draw experiences from during replay')
+    build.add_argument('--replay_type', default='ring',
+                        choices=['uniform','ring','dedup','compressed','mmap','prioritized'],
+                        help='replay memory: deque of float tensors, uint8 ring buffer, '
+                             'uint8 ring buffer storing each screen once, the same '
+                             'with every screen compressed, uint8 ring buffer in '
+                             'memory-mapped files on local disk, or uint8 ring buffer '
+                             'sampled by priority')
+    build.add_argument('--replay_folder', default='~/replay_memory',
+                        help='local folder holding the memory-mapped replay files')
+    build.add_argument('--replay_codec', choices=['zlib','lz4'], default='zlib',
+                        help='codec of the compressed replay memory (lz4 needs the '
+                             'lz4 package)')
+    build.add_argument('--replay_delta', action='store_true',
+                        help='toggle to store compressed replay screens as deltas '
+                             'to the previous screen of the round')
+    build.add_argument('--decode_threads', default=4, type=int,
+                        help='threads decompressing sampled compressed replay screens')
+    build.add_argument('--target_tau', default=0, type=float,
+                        help='soft-update rate of the forecast model after every step '
+                             '(0 copies it every forecast_update_interval steps instead)')
+    build.add_argument('--cache_target_values', action='store_true',
+                        help='toggle to reuse forecast Q-values of replay slots '
+                             'until the forecast model is refreshed')
+    build.add_argument('--num_actors', default=0, type=int,
+                        help='actor processes feeding a separate learner process '
+                             '(0 acts and learns in a single loop)')
+    build.add_argument('--weight_sync_interval', default=100, type=int,
+                        help='learner steps between publishing weights to actors')
+    build.add_argument('--priority_alpha', default=0.6, type=float,
+                        help='exponent applied to priorities in prioritized replay')
+    build.add_argument('--priority_beta', default=0.4, type=float,
+                        help='importance-sampling correction in prioritized replay')
 
     # Add VALIDATE only arguments
     validate = subparser.add_parser('validate',
                         help='validate the model on a set of validation levels')
+    validate.add_argument('--levels', default=None, type=levels_parser,
+                        help='comma-separated "game:state" levels (or "contest" for the '
+                             'contest validation set) to validate on in parallel')
+    validate.add_argument('--validation_workers', default=0, type=int,
+                        help='worker processes validating levels (0 runs every level '
+                             'at once)')
+    validate.add_argument('--episode_steps', default=4500, type=int,
+                        help='step budget of the single episode played per level')
 
     # Add TEST only arguments
     test = subparser.add_parser('test',
                         help='WARNING: NOT YET IMPLEMENTED')
 
+    # Add VALIDATE and TEST inference arguments
+    for p in [validate, test]:
+        p.add_argument('--inference_engine', action='store_true',
+                        help='toggle to play through a traced and frozen CPU graph '
+                             'with fused conv+ReLU and channels_last layout')
+        p.add_argument('--quantize', choices=['dynamic','static'], default=None,
+                        help='int8 quantization of the inference engine: linear '
+                             'weights only, or conv and linear layers calibrated '
+                             'on sampled screens')
+        p.add_argument('--calibration_steps', default=64, type=int,
+                        help='random-policy screens, played in a separate environment, '
+                             'used to calibrate static quantization and as many '
+                             'held-out screens measuring the accuracy gap')
+        p.add_argument('--accuracy_gap', action='store_true',
+                        help='toggle to report the accuracy gap of the inference '
+                             'engine to the fp32 model before playing')
+        p.add_argument('--inference_threads', default=0, type=int,
+                        help='CPU threads used by the inference engine (0 keeps '
+                             'the PyTorch default)')
+
     # Add common arguments to all sub-parsers
     for p in [build, validate, test]:
-        p.add_argument('-e', '--environment', choices=['aws','local','remote'], default='local',
-                        help='environment script is running on to match display')
+        p.add_argument('-e', '--environment', choices=['aws','local','remote','synthetic'],
+                        default='local',
+                        help='environment script is running on to match display, or '
+                             'a synthetic level that needs no ROM for benchmarks')
+        p.add_argument('--synthetic_episode_length', default=4500, type=int,
+                        help='steps per round of the synthetic environment')
+        p.add_argument('--synthetic_reward_scale', default=1.0, type=float,
+                        help='reward per pixel of progress in the synthetic environment')
+        p.add_argument('--synthetic_reward_noise', default=0.0, type=float,
+                        help='std of Gaussian noise added to synthetic rewards')
         p.add_argument('-l', '--log_folder', default='.', required=True,
                         help='folder used to store all non-model outputs')
         p.add_argument('-c', '--max_step_count', default=100000, type=int,
                         help='maximum number of steps to train before terminating')
         p.add_argument('-m', '--load_model_file', default=None,
                         help='file to load starting model parameters from')
+        p.add_argument('--frame_skip', default=1, type=int,
+                        help='emulator frames each chosen action is repeated for')
+        p.add_argument('--num_envs', default=1, type=int,
+                        help='number of emulators stepped in parallel worker processes')
+        p.add_argument('--model_cache_dir', default='~/.cache/retro_models',
+                        help='local folder caching models loaded off S3')
+        p.add_argument('--model_cache_size', default=4, type=float,
+                        help='gigabytes kept in the local model cache (0 disables it)')
+        p.add_argument('--model_cache_ttl', default=0, type=int,
+                        help='seconds a cached model is trusted before its ETag is '
+                             'checked again with a HEAD request (0 checks on every '
+                             'load, so a newer upload is never missed)')
+        p.add_argument('--log_system', choices=['s3','redis','local'], default='s3',
+                        help='where step metrics are written to')
+        p.add_argument('--diagnostic_clips', choices=['gif','mp4'], default=None,
+                        help='render notable steps into clips of this format '
+                             'in a background process')
+        p.add_argument('--clip_fps', default=10, type=int,
+                        help='frames per second of the diagnostic clips')
+        p.add_argument('--max_selective', default=32, type=int,
+                        help='most notable steps captured per metrics write '
+                             '(0 turns notable step detection off)')
+        p.add_argument('--anomaly_quantile', default=0.999, type=float,
+                        help='tail quantile a metric must pass for its step to be notable')
+        p.add_argument('--anomaly_z_threshold', default=4.0, type=float,
+                        help='standard deviations from the mean a metric must '
+                             'pass for its step to be notable')
+        p.add_argument('--anomaly_warmup', default=1000, type=int,
+                        help='steps observed before any step can be notable')
+        p.add_argument('--context_frames', default=3, type=int,
+                        help='screens before each notable step captured with it')
+        p.add_argument('--screen_buffer_size', default=256, type=int,
+                        help='latest screens kept to capture notable steps from')
+        p.add_argument('--storage_system', choices=['s3','local'], default='s3',
+                        help='where models are saved to and loaded from')
+        p.add_argument('--storage_root', default='model_outputs/',
+                        help='S3 prefix or local folder holding saved models')
+        p.add_argument('--profile', action='store_true',
+                        help='toggle to time every phase of the step loop')
+        p.add_argument('--profile_interval', default=1000, type=int,
+                        help='steps between reporting the per-phase profile')
+        p.add_argument('--profile_trace_steps', default=None, type=dimension_parser,
+                        help='"start,stop" step window to record a torch.profiler trace')
+        p.add_argument('--profile_trace_file', default='profile_trace.json',
+                        help='local Chrome trace file written for --profile_trace_steps')
         p.add_argument('--disable_cuda', action='store_true',
                         help='disables CUDA GPU acceleration even if GPU is available')
 
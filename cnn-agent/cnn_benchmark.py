@@ -0,0 +1,573 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from time import perf_counter, time
+
+from cnn_preprocess import ScreenPreprocessor
+from cnn_model import BasicConvolutionNetwork
+from cnn_config import CNNConfig
+from cnn_memory import get_replay_memory, CompressedReplayMemory
+from cnn_inference import InferenceEngine
+from retro_synthetic import SyntheticEnv, BUTTONS
+
+# Optional backends and dependencies that should stay unloaded at startup
+HEAVY_MODULES = ['boto3', 'botocore', 'redis', 'torchvision', 'PIL', 'matplotlib']
+
+# Runs cnn_main in a fresh interpreter, timing its import and the first call
+# into the environment step (the first action) as wall-clock timestamps
+STARTUP_SCRIPT = '''
+import json, sys, time
+times = {'started': time.time()}
+heavy_modules = json.loads(sys.argv[2])
+sys.argv = json.loads(sys.argv[1])
+import cnn_main
+times['imported'] = time.time()
+import retro_vec_env
+step = retro_vec_env.DummyVecEnv.step
+def timed_step(self, buttons_list):
+    times.setdefault('first_action', time.time())
+    return step(self, buttons_list)
+retro_vec_env.DummyVecEnv.step = timed_step
+cnn_main.main()
+times['modules'] = [m for m in heavy_modules if m in sys.modules]
+print('STARTUP ' + json.dumps(times))
+'''
+
+
+def make_benchmark_frames(count, frame_shape = (224,320,3), seed = 0):
+    ''' Return `count` uint8 frames [count,height,width,color] made of flat
+        color blocks with light noise, roughly resembling Sonic screens '''
+    rng = np.random.RandomState(seed)
+    height, width, color = frame_shape
+    blocks = rng.randint(0, 256, size=(count, height // 16, width // 16, color))
+    frames = blocks.repeat(16, axis=1).repeat(16, axis=2)
+    noise = rng.randint(-8, 9, size=frames.shape)
+    return np.clip(frames + noise, 0, 255).astype(np.uint8)
+
+
+def pil_convert_screen(obs, image_to_grayscale, image_dimension):
+    ''' Reference PIL conversion matching the original convert_screen_to_input '''
+    from torchvision.transforms.functional import to_pil_image, to_tensor
+    pil_image = to_pil_image(obs)
+    if image_to_grayscale:
+        pil_image = pil_image.convert('L')
+    if tuple(image_dimension) != (320,224):
+        pil_image = pil_image.resize(image_dimension)
+    return to_tensor(pil_image)
+
+
+def time_per_call(func, repeats):
+    ''' Return the mean seconds per call of `func` over `repeats` calls '''
+    func() # Warm up allocations and lazy initialization
+    start = perf_counter()
+    for _ in range(repeats):
+        func()
+    return (perf_counter() - start) / repeats
+
+
+def benchmark_preprocess(args):
+    ''' Compare per-frame latency of the PIL and tensor preprocessing paths
+        and check the outputs agree within `args.tolerance` '''
+    frames = make_benchmark_frames(args.frames)
+    preprocessor = ScreenPreprocessor(args.image_to_grayscale, args.image_dimension)
+    out = torch.empty(preprocessor.output_shape(args.frames))
+
+    pil_out = torch.stack([pil_convert_screen(f, args.image_to_grayscale,
+        args.image_dimension) for f in frames])
+    tensor_out = preprocessor(frames)
+
+    # Area resizing differs from PIL's resampling filter pixel by pixel, so
+    # resized outputs are compared on the mean difference instead of the max
+    diff = (pil_out - tensor_out).abs()
+    is_resize = tuple(args.image_dimension) != (320,224)
+    checked_diff = float(diff.mean() if is_resize else diff.max())
+
+    results = {
+        'benchmark': 'preprocess',
+        'frames': args.frames,
+        'image_to_grayscale': args.image_to_grayscale,
+        'image_dimension': list(args.image_dimension),
+        'pil_ms_per_frame': 1e3 * time_per_call(lambda: [pil_convert_screen(f,
+            args.image_to_grayscale, args.image_dimension) for f in frames],
+            args.repeats) / args.frames,
+        'tensor_ms_per_frame': 1e3 * time_per_call(lambda: [preprocessor(f)
+            for f in frames], args.repeats) / args.frames,
+        'tensor_batch_ms_per_frame': 1e3 * time_per_call(lambda: preprocessor(frames),
+            args.repeats) / args.frames,
+        'tensor_batch_out_ms_per_frame': 1e3 * time_per_call(lambda: preprocessor(frames, out),
+            args.repeats) / args.frames,
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'within_tolerance': checked_diff <= args.tolerance
+    }
+    return results
+
+
+def benchmark_replay(args):
+    ''' Measure add and sample throughput of each replay memory type on
+        converted screens, adding consecutive transitions as an episode '''
+    preprocessor = ScreenPreprocessor(args.image_to_grayscale, args.image_dimension)
+    screens = list(preprocessor(make_benchmark_frames(args.frames)))
+    live = screens[0].unsqueeze(0)
+    results = {'benchmark': 'replay', 'memory_size': args.memory_size,
+               'batch_size': args.batch_size, 'replay_types': {}}
+
+    for replay_type in args.replay_types:
+        with tempfile.TemporaryDirectory() as replay_folder:
+            memory = get_replay_memory(replay_type, batch_size = args.batch_size,
+                memory_size = args.memory_size, replay_folder = replay_folder)
+
+            start = perf_counter()
+            for i in range(args.memory_size):
+                memory.add_memory(screens[i % len(screens)], i % 18, 1.0,
+                                  screens[(i + 1) % len(screens)], False)
+            add_seconds = perf_counter() - start
+
+            def sample():
+                memory.sample_new_batch()
+                memory.get_batch_start_including(live)
+                memory.get_batch_post_action_including([0], [0.0], live)
+
+            results['replay_types'][replay_type] = {
+                'adds_per_sec': args.memory_size / add_seconds,
+                'sample_ms_per_batch': 1e3 * time_per_call(sample, args.repeats)
+            }
+            memory.flush()
+    return results
+
+
+def benchmark_compression(args):
+    ''' Measure the compression ratio, insert cost and parallel decode
+        throughput of the compressed replay memory for each codec, with and
+        without deltas, on an episode of scrolling synthetic screens
+
+    The synthetic screens carry per-pixel noise, so real Sonic screens
+    compress better; the projected size of a 1M-transition memory counts
+    one compressed frame per chained transition.
+    '''
+    preprocessor = ScreenPreprocessor(args.image_to_grayscale, args.image_dimension)
+    env = SyntheticEnv(episode_length = args.memory_size + 1)
+    run_right = [int(b == "RIGHT") for b in BUTTONS]
+    screens = [preprocessor(env.reset())]
+    for i in range(args.memory_size):
+        # Runs right most of the time, standing still every fourth step
+        obs, _, _, _ = env.step(run_right if i % 4 else [0] * len(BUTTONS))
+        screens.append(preprocessor(obs))
+
+    raw_bytes = screens[0].numel()
+    results = {'benchmark': 'compression', 'memory_size': args.memory_size,
+               'batch_size': args.batch_size, 'raw_bytes_per_frame': raw_bytes,
+               'configurations': {}}
+
+    for codec in args.codecs:
+        for delta in [False, True]:
+            memory = CompressedReplayMemory(batch_size = args.batch_size,
+                memory_size = args.memory_size, codec = codec, delta = delta,
+                decode_threads = args.decode_threads)
+
+            start = perf_counter()
+            for i in range(args.memory_size):
+                memory.add_memory(screens[i], i % 18, 1.0, screens[i + 1], False)
+            add_seconds = perf_counter() - start
+
+            def decode():
+                indices = memory.sample_indices()
+                memory.gather_start_frames(indices)
+                memory.gather_end_frames(indices)
+
+            decode_seconds = time_per_call(decode, args.repeats)
+            ratio = memory.compression_ratio()
+            results['configurations'][codec + ('_delta' if delta else '')] = {
+                'compression_ratio': ratio,
+                'bytes_per_frame': raw_bytes / ratio,
+                'projected_gb_per_1m_transitions': 1e6 * raw_bytes / ratio / 2**30,
+                'insert_ms_per_transition': 1e3 * add_seconds / args.memory_size,
+                'decode_ms_per_batch': 1e3 * decode_seconds,
+                'decoded_frames_per_sec': 2 * args.batch_size / decode_seconds
+            }
+    return results
+
+
+def benchmark_model(args):
+    ''' Measure forward (no gradient) and training step latency of the
+        network at each batch size in `args.batch_sizes` '''
+    device = get_benchmark_device(args)
+    model = BasicConvolutionNetwork(image_to_grayscale = args.image_to_grayscale,
+                                    image_dimension = args.image_dimension)
+    model.to(device)
+    config = CNNConfig(loss_func = F.smooth_l1_loss, opt_func = optim.SGD)
+    config.init_optimizer(model.parameters())
+    preprocessor = ScreenPreprocessor(args.image_to_grayscale, args.image_dimension)
+    screens = preprocessor(make_benchmark_frames(max(args.batch_sizes))).to(device)
+
+    sync = torch.cuda.synchronize if device.type == 'cuda' else lambda: None
+    results = {'benchmark': 'model', 'device': str(device),
+               'image_to_grayscale': args.image_to_grayscale,
+               'image_dimension': list(args.image_dimension), 'batch_sizes': {}}
+
+    for batch_size in args.batch_sizes:
+        batch = screens[:batch_size]
+        rewards = torch.ones(batch_size, device=device)
+        actions = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+
+        def forward():
+            with torch.no_grad():
+                model.forward(batch)
+            sync()
+
+        def train_step():
+            Q_estimates = model.forward(batch)
+            with torch.no_grad():
+                Q_futures = model.forward(batch)
+            loss = config.calculate_loss(Q_estimates, rewards, Q_futures)
+            action_mask = torch.zeros_like(loss).scatter_(1, actions, 1.0)
+            config.optimizer.zero_grad()
+            loss.backward(action_mask)
+            config.optimizer.step()
+            sync()
+
+        results['batch_sizes'][str(batch_size)] = {
+            'forward_ms': 1e3 * time_per_call(forward, args.repeats),
+            'train_step_ms': 1e3 * time_per_call(train_step, args.repeats)
+        }
+    return results
+
+
+def benchmark_checkpoint(args):
+    ''' Measure save and load time of full and chunked checkpoints stored in
+        a temporary local directory '''
+    from retro_s3 import RetroLocalClient, ModelCache
+
+    model = BasicConvolutionNetwork(image_to_grayscale = args.image_to_grayscale,
+                                    image_dimension = args.image_dimension)
+    config = CNNConfig()
+    results = {'benchmark': 'checkpoint',
+               'image_dimension': list(args.image_dimension)}
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        client = RetroLocalClient(root_dir)
+        full_save = time_per_call(lambda: client.save_model(model, config, 'full.pt'),
+                                  args.repeats)
+        full_load = time_per_call(lambda: client.load_model_config_state('full.pt'),
+                                  args.repeats)
+
+        # The first chunked save uploads every chunk, later ones find them stored
+        start = perf_counter()
+        client.save_model_chunked(model, config, 'chunked.pt', fp16 = args.fp16,
+                                  compress = args.compress)
+        chunked_cold_save = perf_counter() - start
+        chunked_save = time_per_call(lambda: client.save_model_chunked(model,
+            config, 'chunked.pt', fp16 = args.fp16, compress = args.compress),
+            args.repeats)
+        chunked_load = time_per_call(lambda: client.load_model_config_state('chunked.pt'),
+                                     args.repeats)
+
+        # A cold load fills the model cache, repeat loads memory-map its entry
+        cache = ModelCache(os.path.join(root_dir, 'cache'), ttl = 300)
+        start = perf_counter()
+        client.load_model_config_state('full.pt', cache = cache)
+        cached_cold_load = perf_counter() - start
+        cached_load = time_per_call(lambda: client.load_model_config_state('full.pt',
+            cache = cache), args.repeats)
+
+        results.update({
+            'cached_cold_load_ms': 1e3 * cached_cold_load,
+            'cached_load_ms': 1e3 * cached_load,
+            'full_bytes': os.path.getsize(os.path.join(root_dir, 'full.pt')),
+            'full_save_ms': 1e3 * full_save,
+            'full_load_ms': 1e3 * full_load,
+            'chunked_fp16': args.fp16,
+            'chunked_compress': args.compress,
+            'chunked_cold_save_ms': 1e3 * chunked_cold_save,
+            'chunked_save_ms': 1e3 * chunked_save,
+            'chunked_load_ms': 1e3 * chunked_load
+        })
+    return results
+
+
+def benchmark_inference(args):
+    ''' Compare per-frame decision latency of the eager fp32 model against
+        the CPU inference engine with each quantization, along with the
+        accuracy gap of the engine to the fp32 model on frames held out
+        from calibration '''
+    if args.inference_threads > 0:
+        torch.set_num_threads(args.inference_threads)
+    model = BasicConvolutionNetwork(image_to_grayscale = args.image_to_grayscale,
+                                    image_dimension = args.image_dimension)
+    model.eval()
+    model.turn_off_gradients()
+    preprocessor = ScreenPreprocessor(args.image_to_grayscale, args.image_dimension)
+    screens = preprocessor(make_benchmark_frames(args.frames))
+    held_out_screens = preprocessor(make_benchmark_frames(args.frames, seed = 1))
+    screen = screens[:1]
+
+    def eager():
+        with torch.no_grad():
+            model.forward(screen)
+
+    results = {'benchmark': 'inference', 'threads': torch.get_num_threads(),
+               'image_dimension': list(args.image_dimension),
+               'eager_ms_per_frame': 1e3 * time_per_call(eager, args.repeats),
+               'engines': {}}
+
+    for quantize in args.quantize_modes:
+        engine = InferenceEngine(model, quantize = None if quantize == 'none' else quantize,
+                                 calibration_screens = screens)
+        results['engines'][quantize] = dict(engine.accuracy_gap(held_out_screens),
+            ms_per_frame = 1e3 * time_per_call(lambda: engine.forward(screen),
+                                               args.repeats))
+    return results
+
+
+def benchmark_startup(args):
+    ''' Measure interpreter start, import time of cnn_main and time to the
+        first action of `validate` mode with a checkpoint on local disk, and
+        list which optional heavy modules were loaded by then '''
+    from retro_s3 import RetroLocalClient
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    model = BasicConvolutionNetwork(image_to_grayscale = args.image_to_grayscale,
+                                    image_dimension = args.image_dimension)
+    runs = []
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        RetroLocalClient(root_dir).save_model(model, CNNConfig(), 'startup.pt')
+        argv = ['cnn_main.py', 'validate', '-e', 'synthetic', '-l', root_dir,
+                '-c', '1', '-m', 'startup.pt', '--storage_system', 'local',
+                '--storage_root', root_dir, '--log_system', 'local'] + \
+            shlex.split(args.main_args)
+
+        for _ in range(args.repeats):
+            launched = time()
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT,
+                json.dumps(argv), json.dumps(HEAVY_MODULES)], cwd=folder, check=True,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode()
+            times = json.loads([l for l in output.splitlines()
+                                if l.startswith('STARTUP ')][-1][len('STARTUP '):])
+            runs.append({
+                'interpreter_seconds': times['started'] - launched,
+                'import_seconds': times['imported'] - times['started'],
+                'first_action_seconds': times['first_action'] - launched,
+                'heavy_modules': times['modules']
+            })
+
+    return {
+        'benchmark': 'startup',
+        'main_args': args.main_args,
+        'repeats': args.repeats,
+        'median_interpreter_seconds': float(np.median([r['interpreter_seconds'] for r in runs])),
+        'median_import_seconds': float(np.median([r['import_seconds'] for r in runs])),
+        'median_first_action_seconds': float(np.median([r['first_action_seconds'] for r in runs])),
+        'heavy_modules': runs[-1]['heavy_modules']
+    }
+
+
+def run_main_steps(mode, step_count, main_args, model = None):
+    ''' Return the wall-clock seconds of running cnn_main.py for
+        `step_count` steps on the synthetic environment, loading `model`
+        from a checkpoint on local disk if given '''
+    from retro_s3 import RetroLocalClient
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as log_folder:
+        command = [sys.executable, os.path.join(folder, 'cnn_main.py'), mode,
+                   '-e', 'synthetic', '-l', log_folder, '-c', str(step_count),
+                   '--log_system', 'local', '--storage_system', 'local',
+                   '--storage_root', log_folder]
+        if model is not None:
+            RetroLocalClient(log_folder).save_model(model, CNNConfig(), 'steps.pt')
+            command += ['-m', 'steps.pt']
+        start = perf_counter()
+        subprocess.run(command + main_args, cwd=folder, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return perf_counter() - start
+
+
+def benchmark_steps(args):
+    ''' Measure end-to-end steps/sec of cnn_main.py in each mode
+
+    Each mode is run twice, for `warmup_steps` and `warmup_steps + steps`
+    steps, and only the difference is timed, so that interpreter start-up,
+    imports and model creation do not count towards the step rate. Modes
+    other than build play a freshly initialized model saved as a checkpoint,
+    like a trained model would be loaded.
+    '''
+    model = BasicConvolutionNetwork(image_to_grayscale = args.image_to_grayscale,
+                                    image_dimension = args.image_dimension)
+    results = {'benchmark': 'steps', 'steps': args.steps, 'modes': {}}
+    for mode in args.modes:
+        main_args = shlex.split(args.main_args)
+        if mode == 'build':
+            main_args += shlex.split(args.build_args)
+        mode_model = None if mode == 'build' else model
+        warmup_seconds = run_main_steps(mode, args.warmup_steps, main_args, mode_model)
+        total_seconds = run_main_steps(mode, args.warmup_steps + args.steps, main_args,
+                                       mode_model)
+        results['modes'][mode] = {
+            'main_args': main_args,
+            'warmup_seconds': warmup_seconds,
+            'steps_per_sec': args.steps / max(total_seconds - warmup_seconds, 1e-9)
+        }
+    return results
+
+
+def get_benchmark_device(args):
+    ''' Return the CUDA device if available and not disabled, else the CPU '''
+    if not args.disable_cuda and torch.cuda.is_available():
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
+def run_benchmark(name, args):
+    ''' Run the benchmark `name` with the parsed command line `args` '''
+    if name == 'preprocess':
+        return benchmark_preprocess(args)
+    elif name == 'replay':
+        return benchmark_replay(args)
+    elif name == 'compression':
+        return benchmark_compression(args)
+    elif name == 'model':
+        return benchmark_model(args)
+    elif name == 'checkpoint':
+        return benchmark_checkpoint(args)
+    elif name == 'steps':
+        return benchmark_steps(args)
+    elif name == 'inference':
+        return benchmark_inference(args)
+    elif name == 'startup':
+        return benchmark_startup(args)
+    else:
+        raise ValueError("No benchmark available for the given name")
+
+
+def BenchmarkArgumentParser():
+    ''' Create a command line argument parser for the cnn_benchmark.py '''
+    parser = argparse.ArgumentParser()
+    subparser = parser.add_subparsers(dest='benchmark')
+    subparser.required = True
+
+    # Converts string argument in for "w,h" into integer tuple, "30,20" -> (30,20)
+    dimension_parser = lambda arg: tuple(map(int, arg.split(',')))
+
+    preprocess = subparser.add_parser('preprocess',
+                        help='compare PIL and tensor screen preprocessing')
+    replay = subparser.add_parser('replay',
+                        help='replay memory add and sample throughput')
+    compression = subparser.add_parser('compression',
+                        help='compressed replay memory ratio and decode throughput')
+    model = subparser.add_parser('model',
+                        help='forward and training step latency per batch size')
+    checkpoint = subparser.add_parser('checkpoint',
+                        help='full and chunked checkpoint save and load time')
+    startup = subparser.add_parser('startup',
+                        help='import time and time to first action of validate mode')
+    steps = subparser.add_parser('steps',
+                        help='end-to-end steps/sec of cnn_main.py on the synthetic environment')
+    inference = subparser.add_parser('inference',
+                        help='eager model against the CPU inference engine')
+    everything = subparser.add_parser('all',
+                        help='run every benchmark above with its own arguments')
+
+    for p in [preprocess, everything]:
+        p.add_argument('--tolerance', default=2/255, type=float,
+                        help='allowed max (or mean if resizing) output difference')
+
+    for p in [replay, everything]:
+        p.add_argument('--replay_types',
+                        default=['ring','dedup','compressed','mmap','prioritized','uniform'],
+                        type=lambda arg: arg.split(','),
+                        help='comma-separated replay memory types to compare')
+
+    for p in [compression, everything]:
+        p.add_argument('--codecs', default=['zlib'], type=lambda arg: arg.split(','),
+                        help='comma-separated codecs to compare (lz4 needs the lz4 package)')
+        p.add_argument('--decode_threads', default=4, type=int,
+                        help='threads decompressing each sampled batch')
+
+    for p in [replay, compression, everything]:
+        p.add_argument('--memory_size', default=512, type=int,
+                        help='transitions added to (and filling) each replay memory')
+        p.add_argument('--batch_size', default=16, type=int,
+                        help='size of each sampled replay batch')
+
+    for p in [model, everything]:
+        p.add_argument('--batch_sizes', default=(1,16,32,64), type=dimension_parser,
+                        help='comma-separated batch sizes to time the network at')
+        p.add_argument('--disable_cuda', action='store_true',
+                        help='time on the CPU even if a GPU is available')
+
+    for p in [checkpoint, everything]:
+        p.add_argument('--fp16', action='store_true',
+                        help='toggle to store chunked checkpoint tensors as float16')
+        p.add_argument('--compress', action='store_true',
+                        help='toggle to zlib-compress chunked checkpoint tensors')
+
+    for p in [steps, everything]:
+        p.add_argument('--modes', default=['build','validate'], type=lambda arg: arg.split(','),
+                        help='comma-separated cnn_main.py modes to run')
+        p.add_argument('--steps', default=200, type=int,
+                        help='timed steps per mode after the warm-up steps')
+        p.add_argument('--warmup_steps', default=20, type=int,
+                        help='steps of the untimed start-up run')
+        p.add_argument('--build_args', default='--use_experience_replay',
+                        help='extra cnn_main.py arguments for build mode only')
+
+    for p in [steps, startup, everything]:
+        p.add_argument('--main_args', default='',
+                        help='extra cnn_main.py arguments for every mode')
+
+    for p in [inference, everything]:
+        p.add_argument('--quantize_modes', default=['none','dynamic','static'],
+                        type=lambda arg: arg.split(','),
+                        help='comma-separated engine quantizations to compare')
+        p.add_argument('--inference_threads', default=0, type=int,
+                        help='CPU threads used for inference (0 keeps the default)')
+
+    # Add common arguments to all sub-parsers
+    for p in [preprocess, replay, compression, model, checkpoint, steps, inference,
+              startup, everything]:
+        p.add_argument('--frames', default=64, type=int,
+                        help='number of distinct synthetic frames used')
+        p.add_argument('--repeats', default=5, type=int,
+                        help='number of timed repeats per measurement')
+        p.add_argument('--image_to_grayscale', action='store_true',
+                        help='toggle to convert input RGB image to grayscale')
+        p.add_argument('--image_dimension', default=(320,224), type=dimension_parser,
+                        help='the "width,height" to resize images for network')
+        p.add_argument('--output_file', default=None,
+                        help='JSON lines file each run is appended to for comparison')
+
+    return parser
+
+
+def main():
+    args = BenchmarkArgumentParser().parse_args()
+    names = [args.benchmark]
+    if args.benchmark == 'all':
+        names = ['preprocess', 'replay', 'compression', 'model', 'checkpoint',
+                 'inference', 'startup', 'steps']
+
+    run = {
+        'timestamp': time(),
+        'torch_version': torch.__version__,
+        'num_threads': torch.get_num_threads(),
+        'results': [run_benchmark(name, args) for name in names]
+    }
+    print(json.dumps(run, indent=2))
+
+    if args.output_file is not None:
+        with open(os.path.expanduser(args.output_file), 'a') as f:
+            f.write(json.dumps(run) + '\n')
+
+
+if __name__ == '__main__':
+    main()
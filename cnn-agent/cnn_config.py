@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import torch.optim as optim
 
 from torch.autograd import Variable
+from retro_s3 import load_pickled
 
 class CNNConfig:
     def __init__(self, gamma = 0.99, loss_func = F.smooth_l1_loss,
@@ -30,26 +31,37 @@ class CNNConfig:
             momentum = self.momentum
         )
 
-    def is_forecast_update(self, count):
-        return count % self.forecast_update_interval == 0
+    def is_forecast_update(self, count, steps = 1):
+        ''' Return whether any of the `steps` counts from `count` onward
+            reaches the forecast update interval '''
+        return -count % self.forecast_update_interval < steps
 
-    def is_model_save(self, count):
-        return count % self.model_save_interval == 0
+    def is_model_save(self, count, steps = 1):
+        ''' Return whether any of the `steps` counts from `count` onward
+            reaches the model save interval '''
+        return -count % self.model_save_interval < steps
 
-    def save(self, path_or_buffer):
-        ''' Save config to a local file path or buffer '''
-        torch.save({
+    def get_state(self, snapshot = False):
+        ''' Return the dictionary written by `save` (already a snapshot) '''
+        return {
             'gamma': self.gamma,
             #'loss_func': self.loss_func,
             'opt_func': self.opt_func,
             'forecast_update_interval': self.forecast_update_interval,
             'lr': self.lr,
             'momentum': self.momentum
-        }, path_or_buffer)
+        }
+
+    def save(self, path_or_buffer):
+        ''' Save config to a local file path or buffer '''
+        torch.save(self.get_state(), path_or_buffer)
 
     def load(self, path_or_buffer):
         ''' Load config from a local file path or buffer '''
-        loaded_dict = torch.load(path_or_buffer)
+        self.load_state(load_pickled(path_or_buffer))
+
+    def load_state(self, loaded_dict):
+        ''' Load config from a dictionary as returned by `get_state` '''
         self.gamma = loaded_dict['gamma']
         #self.loss_func = loaded_dict['loss_func']
         self.opt_func = loaded_dict['opt_func']
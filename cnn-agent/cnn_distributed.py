@@ -0,0 +1,194 @@
+import os
+import torch
+import retro_utils as util
+import torch.multiprocessing as mp
+
+from cnn_model import BasicConvolutionNetwork
+from cnn_memory import SharedReplayMemory
+from cnn_target import TargetNetwork
+
+
+class SharedWeights:
+    ''' Shared-memory copy of the learner's network weights that actors pull
+        from whenever the learner publishes a new version '''
+
+    def __init__(self, model, lock):
+        self.lock = lock
+        self.version = torch.zeros(1, dtype=torch.long).share_memory_()
+        self.tensors = [t.detach().clone().cpu().share_memory_()
+                        for t in model.state_dict().values()]
+
+    def get_version(self):
+        return int(self.version[0])
+
+    def publish(self, model):
+        ''' Copy the weights of `model` in place into shared memory '''
+        with self.lock:
+            for shared, local in zip(self.tensors, model.state_dict().values()):
+                shared.copy_(local)
+            self.version += 1
+
+    def pull(self, model, last_version = -1):
+        ''' Copy the shared weights into `model` if a newer version exists
+
+        Returns:
+            int with the version now held by `model`
+        '''
+        version = self.get_version()
+        if version != last_version:
+            with self.lock:
+                version = self.get_version()
+                for local, shared in zip(model.state_dict().values(), self.tensors):
+                    local.copy_(shared)
+        return version
+
+
+def run_actor(environment, frame_skip, model_kwargs, weights, memory, stop_event,
+              env_options = None):
+    ''' Act in one environment with the latest published policy and push
+        every transition into the shared replay memory '''
+    torch.set_num_threads(1)
+    model = BasicConvolutionNetwork(**model_kwargs)
+    model.eval()
+    model.turn_off_gradients()
+    version = weights.pull(model)
+
+    game_env = util.get_environment(environment, frame_skip, env_options)
+    current_screen = model.convert_screen_to_input(game_env.reset())
+
+    while not stop_event.is_set():
+        version = weights.pull(model, version)
+
+        with torch.no_grad():
+            Q_estimate = model.forward(current_screen.unsqueeze(0))[0]
+        action = model.get_action(Q_estimate)
+
+        obs, reward, done, info = game_env.step(model.convert_action_to_buttons(action))
+
+        # Reset the screen if the game round was terminated
+        if done:
+            obs = game_env.reset()
+
+        next_screen = model.convert_screen_to_input(obs)
+        memory.add_memory(current_screen, action, reward, next_screen, done)
+
+        current_screen = next_screen
+
+    game_env.close()
+
+
+def check_actors(actors):
+    ''' Raise if any actor process exited while the learner still needs it '''
+    for a in actors:
+        if not a.is_alive():
+            raise RuntimeError("Actor process {} exited with code {}".format(
+                a.name, a.exitcode))
+
+
+def acquire_checked(lock, actors, timeout = 1.0):
+    ''' Acquire `lock`, checking that the actors are alive while waiting, so
+        an actor that crashed holding the lock fails the learner instead of
+        hanging it '''
+    while not lock.acquire(timeout = timeout):
+        check_actors(actors)
+
+
+def run_learner(args, model, config, evaluator, saver):
+    ''' Train `model` from a shared replay memory filled by `args.num_actors`
+        actor processes, publishing weights every `args.weight_sync_interval`
+        optimizer steps so acting and learning never wait on each other '''
+    ctx = mp.get_context('spawn')
+    if model.frame_stack > 1:
+        raise ValueError("Frame stacking is not supported with actor processes")
+
+    model_kwargs = {
+        'epsilon': model.epsilon,
+        'image_to_grayscale': model.image_to_grayscale,
+        'image_dimension': model.image_dimension
+    }
+    screen_shape = (1 if model.image_to_grayscale else 3,
+                    model.image_dimension[1], model.image_dimension[0])
+
+    memory = SharedReplayMemory(screen_shape, ctx.RLock(),
+        batch_size = args.batch_size, memory_size = args.memory_size)
+    weights = SharedWeights(model, ctx.Lock())
+    weights.publish(model)
+    stop_event = ctx.Event()
+
+    actors = [
+        ctx.Process(target=run_actor, daemon=True, args=(args.environment,
+            args.frame_skip, model_kwargs, weights, memory, stop_event,
+            util.get_worker_environment_options(util.get_environment_options(args), i)))
+        for i in range(args.num_actors)
+    ]
+    for a in actors:
+        a.start()
+
+    forecast_model = None
+    is_soft_update = args.target_tau > 0
+
+    try:
+        while evaluator.get_count() < args.max_step_count:
+            check_actors(actors)
+            if len(memory) < args.batch_size:
+                stop_event.wait(0.1)
+                continue
+
+            # Hold the lock so actors cannot overwrite the batch mid-read
+            acquire_checked(memory.lock, actors)
+            try:
+                memory.sample_new_batch()
+                batch_states = memory.get_batch_start_including()
+                batch_actions, batch_rewards, batch_next_screens = \
+                    memory.get_batch_post_action_including()
+                batch_dones = memory.get_batch_dones_including()
+            finally:
+                memory.lock.release()
+
+            batch_actions = batch_actions.to(args.device)
+            batch_rewards = batch_rewards.to(args.device)
+
+            # Create the forecast model for future rewards once, then refresh
+            # it in place periodically (or softly after every update below)
+            if forecast_model is None:
+                forecast_model = TargetNetwork(model, tau = args.target_tau)
+            elif not is_soft_update and config.is_forecast_update(evaluator.get_count()):
+                forecast_model.sync(model)
+
+            Q_estimates = model.forward(batch_states.to(args.device))
+            Q_futures = forecast_model.forward(batch_next_screens.to(args.device))
+
+            # Set future Q-values to zero where the round terminated
+            not_done = (1 - batch_dones).float().to(args.device).view(-1,1)
+            Q_futures = Q_futures * not_done
+
+            loss = config.calculate_loss(Q_estimates, batch_rewards, Q_futures)
+
+            action_mask = torch.zeros_like(loss)
+            action_mask.scatter_(1, batch_actions.view(-1,1), 1.0)
+
+            config.optimizer.zero_grad()
+            loss.backward(action_mask)
+            config.optimizer.step()
+
+            if is_soft_update:
+                forecast_model.soft_update(model)
+
+            if (evaluator.get_count() + 1) % args.weight_sync_interval == 0:
+                weights.publish(model)
+
+            if config.is_model_save(evaluator.get_count()) and args.output_model_file != None:
+                out_path = os.path.expanduser(args.log_folder + '/' + args.output_model_file)
+                saver.save_model(model, config, out_path)
+
+            evaluator.summarize_step(
+                Q_estimate = Q_estimates[0],
+                action = int(batch_actions[0]),
+                reward = float(batch_rewards[0]),
+                loss = loss[0],
+                Q_future = Q_futures[0]
+            )
+    finally:
+        stop_event.set()
+        for a in actors:
+            a.join()
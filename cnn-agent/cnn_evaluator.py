@@ -1,10 +1,38 @@
-import redis
-import retro_s3
+import io
+import numpy as np
+import os
+import retro_backends
+import torch
 
-from collections import deque
+from cnn_anomaly import AnomalyDetector
+from cnn_render import ClipEncoder, to_clip_frame
+from retro_redis import RedisMetricsStore
+
+from threading import Event, Thread
 from time import time
+from warnings import warn
 
 class RetroEvaluator:
+    ''' Collects per-step metrics and writes them to the log system
+
+        `summarize_step` only drops the raw step record into a preallocated
+        ring buffer and returns. A background writer thread drains the buffer,
+        converts the records, prints an aggregated console line at most every
+        `print_interval` seconds, and writes batches to the log system once
+        `queue_memory` steps are waiting or `min_write_gap` seconds passed.
+
+        The writer also feeds the loss, TD error, reward and Q-value spread
+        of every step to an AnomalyDetector. Outlier steps go to the
+        selective memory, at most `max_selective` per write, with uint8
+        copies of their screen and of up to `context_frames` screens before
+        it of the same environment. Those screens come from a preallocated
+        uint8 ring of the latest `screen_buffer_size` screens (about 55MB for
+        256 full-size RGB screens), so only notable steps copy them out.
+
+        With a `clip_format`, the screens and Q-values of each written batch
+        of selective memory are also handed to a ClipEncoder process that
+        renders them into a GIF or MP4 under `log_folder`/clips.
+    '''
 
     def __init__(self,
                 log_folder,
@@ -12,30 +40,78 @@ class RetroEvaluator:
                 min_write_gap = 30,
                 queue_memory = 100,
                 print_log_messages = True,
+                print_interval = 5,
+                buffer_size = 65536,
                 redis_host = 'model-storage.bkgf6l.0001.use1.cache.amazonaws.com',
-                redis_port = 6379):
+                redis_port = 6379,
+                redis_client = None,
+                clip_format = None,
+                clip_fps = 10,
+                num_envs = 1,
+                gamma = 0.99,
+                anomaly_quantile = 0.999,
+                anomaly_z_threshold = 4.0,
+                anomaly_warmup = 1000,
+                max_selective = 32,
+                context_frames = 3,
+                screen_buffer_size = 256):
         self.counter = 0
         self.write_number = 0
         self.last_write_time = time()
 
         self.log_system = log_system
         self.print_log_messages = print_log_messages
+        self.print_interval = print_interval
         self.min_write_gap = min_write_gap
-        self.common_memory = deque([], queue_memory)
-        self.selective_memory = deque([], queue_memory)
+        self.queue_memory = queue_memory
+        self.common_memory = []
+        self.selective_memory = []
         self.log_folder = log_folder
 
+        # Single-producer/single-consumer ring buffer of raw step records
+        self.buffer_size = buffer_size
+        self.records = [None] * buffer_size
+        self.record_head = 0
+        self.record_tail = 0
+        self.dropped_count = 0
+        self.profile_report = None
+
+        # Notable step detection and the screens captured around those steps
+        self.num_envs = num_envs
+        self.gamma = gamma
+        self.max_selective = max_selective
+        self.context_frames = context_frames
+        self.screen_buffer_size = screen_buffer_size
+        self.recent_steps = [None] * screen_buffer_size
+        self.screen_frames = None
+        self.detector = None
+        if max_selective > 0:
+            self.detector = AnomalyDetector(anomaly_quantile, anomaly_z_threshold,
+                                            anomaly_warmup)
+
         if log_system == 's3':
-            self.s3 = retro_s3.RetroS3Client()
+            self.s3 = retro_backends.STORAGE.lazy('s3')
         elif log_system == 'redis':
-            self.redis = redis.StrictRedis(host=redis_host, port=redis_port)
-            self.redis_pipeline = self.redis.pipeline()
-            self.redis.rpush('model_names', self.log_folder)
+            # A client (e.g. fakeredis) can be passed in for offline runs
+            self.redis = redis_client or retro_backends.METRICS.create('redis',
+                host=redis_host, port=redis_port)
+            self.redis_store = RedisMetricsStore(self.redis, self.log_folder)
+            self.redis_store.register()
             # TODO: Add logic to check for existence of model and remove
             # previous writes if present
         else:
             pass #self.log_system = open('')
 
+        self.clip_encoder = None
+        if clip_format is not None:
+            self.clip_encoder = ClipEncoder(os.path.join(log_folder, 'clips'),
+                                            clip_format, clip_fps)
+
+        self.is_closed = False
+        self.wake_event = Event()
+        self.writer_thread = Thread(target=self.run_writer, daemon=True)
+        self.writer_thread.start()
+
     def summarize_step(self, Q_estimate, action, reward,
                        loss = None, Q_future = None, next_screen = None):
         ''' Provides evaluator the summary of the last step
@@ -48,41 +124,189 @@ class RetroEvaluator:
             Q_future (tensor, optional):
             next_screen (tensor, optional):
         '''
-        common_memory = {
-            'action': action,
-            'reward': reward,
-            'loss': loss if type(loss) is float or loss is None else float(loss[action])
-        }
-        selective_memory = {
-            'counter': self.counter,
-            'Q_estimate': Q_estimate,
-            'Q_future': Q_future,
-            'screen': next_screen
-        }
+        # Records hold detached CPU values, so no autograd graph or device
+        # memory is kept alive while they wait for the writer
+        loss, Q_estimate, Q_future = (detach_value(loss), detach_value(Q_estimate),
+                                      detach_value(Q_future))
+
+        if self.record_head - self.record_tail >= self.buffer_size:
+            self.dropped_count += 1 # Writer fell a full buffer behind
+        else:
+            self.records[self.record_head % self.buffer_size] = \
+                (self.counter, action, reward, loss, Q_estimate, Q_future)
+            self.record_head += 1
+
+        if self.screen_buffer_size > 0:
+            slot = self.counter % self.screen_buffer_size
+            if next_screen is not None:
+                if self.screen_frames is None:
+                    self.screen_frames = torch.empty(
+                        (self.screen_buffer_size,) + tuple(next_screen.shape),
+                        dtype=torch.uint8)
+                # copy_ casts the rounded [0,255] floats into the uint8 slot
+                self.screen_frames[slot].copy_(next_screen.detach().mul(255).round_())
+            self.recent_steps[slot] = (next_screen is not None, Q_estimate)
 
-        self.common_memory.append(common_memory)
         self.counter += 1
 
-        if self.is_notable(common_memory, selective_memory):
-            self.selective_memory.append(selective_memory)
-        if self.is_write_time():
-            self.write_metrics()
+        if self.record_head - self.record_tail >= self.queue_memory:
+            self.wake_event.set()
+
+    def summarize_profile(self, profile_rows):
+        ''' Hand the evaluator the latest per-phase profiler breakdown, which
+            the writer prints and writes with the next batch of metrics
+
+        Args:
+            profile_rows (list): dictionaries as returned by
+                `PhaseProfiler.summary()`
+        '''
+        self.profile_report = profile_rows
+
+    def drain_records(self):
+        ''' Move waiting raw records into the common/selective memories,
+            converting losses to floats and detecting notable steps off the
+            training thread, and release the drained slots
+
+        Returns:
+            list of the common memory dictionaries that were drained
+        '''
+        head = self.record_head
+        drained = []
+        for i in range(self.record_tail, head):
+            counter, action, reward, loss, Q_estimate, Q_future = \
+                self.records[i % self.buffer_size]
+            self.records[i % self.buffer_size] = None
+            loss = loss if type(loss) is float or loss is None else float(loss[action])
+            drained.append({
+                'counter': counter,
+                'action': action,
+                'reward': reward,
+                'loss': loss
+            })
+            reasons = self.is_notable(action, reward, loss, Q_estimate, Q_future)
+            if len(reasons) > 0 and len(self.selective_memory) < self.max_selective:
+                self.selective_memory.append(
+                    self.capture_step(counter, reasons, Q_estimate, Q_future))
+        self.record_tail = head
+
+        self.common_memory.extend(drained)
+        return drained
+
+    def run_writer(self):
+        ''' Background loop draining records, printing and writing metrics '''
+        last_print_time = time()
+        window = []
+
+        while True:
+            self.wake_event.wait(min(self.print_interval, self.min_write_gap))
+            self.wake_event.clear()
+            is_closed = self.is_closed
+
+            window += self.drain_records()
+
+            if self.print_log_messages and \
+                    (time() - last_print_time >= self.print_interval or is_closed):
+                self.print_log_message(window, time() - last_print_time)
+                window = []
+                last_print_time = time()
+
+            profile_report, self.profile_report = self.profile_report, None
+            if profile_report is not None:
+                self.write_profile(profile_report)
+
+            if len(self.common_memory) > 0 and (self.is_write_time() or is_closed):
+                try:
+                    self.write_metrics()
+                except Exception as e: # Keep the writer alive, drop the batch
+                    warn("Metrics write failed: " + repr(e))
+                    self.common_memory.clear()
+                    self.selective_memory.clear()
+
+            if is_closed:
+                return
+
+    def close(self):
+        ''' Drain and write all remaining metrics, then stop the writer '''
+        self.is_closed = True
+        self.wake_event.set()
+        self.writer_thread.join()
+        if self.clip_encoder is not None:
+            self.clip_encoder.close()
+
+    def print_log_message(self, window, elapsed):
+        ''' Print an aggregated logging message for a window of steps to STDOUT '''
+        if len(window) == 0:
+            return
+        losses = [m['loss'] for m in window if m['loss'] is not None]
+        mean_loss = sum(losses) / len(losses) if len(losses) > 0 else float('nan')
+        total_reward = sum(float(m['reward']) for m in window)
+        print("{o}: {s:.1f} steps/sec, mean loss {l:.6g}, total reward {r:.6g}, "
+              "{d} records dropped".format(o=self.counter,
+            s=len(window) / max(elapsed, 1e-9), l=mean_loss, r=total_reward,
+            d=self.dropped_count))
+
+    def write_profile(self, profile_rows):
+        ''' Print the per-phase profile breakdown and store it on S3 '''
         if self.print_log_messages:
-            self.print_log_message(common_memory, selective_memory)
+            for r in sorted(profile_rows, key=lambda r: -r['share']):
+                print("  {p:<12} {s:6.1%}  p50 {p50:8.3f}ms  p95 {p95:8.3f}ms  "
+                      "p99 {p99:8.3f}ms".format(p=r['phase'], s=r['share'],
+                      p50=r['p50_ms'], p95=r['p95_ms'], p99=r['p99_ms']))
+        if self.log_system == 's3' and len(profile_rows) > 0:
+            self.s3.save_memory(profile_rows,
+                f"{self.log_folder}/profile/{self.counter:010}.csv")
+
+    def is_notable(self, action, reward, loss, Q_estimate = None, Q_future = None):
+        ''' Return why the step was notable enough to output more advanced
+            diagnostics (e.g. Q-values, screen images, etc.): the names of the
+            metrics that were outliers, or an empty list '''
+        if self.detector is None:
+            return []
+        values = {'reward': float(reward), 'loss': loss}
+        if Q_estimate is not None:
+            Q_estimate = Q_estimate.detach().cpu()
+            values['q_spread'] = float(Q_estimate.max() - Q_estimate.min())
+            if Q_future is not None:
+                values['td_error'] = float(reward + self.gamma * float(Q_future[action]) -
+                                           Q_estimate[action])
+        return self.detector.observe(values)
 
-    def print_log_message(self, common, selective):
-        ''' Print logging messages to STDOUT '''
-        print("{o}: {l}".format(o=self.counter, l=common['loss']))
+    def get_recent_step(self, counter):
+        ''' Return the uint8 screen and Q-estimate of step `counter` if its
+            screen is still in the rolling buffer, otherwise None '''
+        if counter < 0 or self.screen_buffer_size == 0:
+            return None
+        slot = counter % self.screen_buffer_size
+        step = self.recent_steps[slot]
+        if step is None or not step[0]:
+            return None
+        screen = self.screen_frames[slot].clone()
+        # Checked after the copy: the slot is only reused once the counter
+        # has moved a full buffer past `counter`
+        if self.counter - counter >= self.screen_buffer_size:
+            return None
+        return screen, step[1]
 
-    def is_notable(self, common, selective):
-        ''' Return whether the step was notable enough to output more advanced
-            diagnostics (e.g. Q-values, screen images, etc.) '''
-        return False
+    def capture_step(self, counter, reasons, Q_estimate, Q_future):
+        ''' Return the selective memory entry of a notable step, with the
+            context screens of the steps before it in the same environment
+            (oldest first) that are still in the rolling buffer '''
+        step = self.get_recent_step(counter)
+        context = [self.get_recent_step(counter - k * self.num_envs)
+                   for k in range(self.context_frames, 0, -1)]
+        return {
+            'counter': counter,
+            'reason': ','.join(reasons),
+            'Q_estimate': None if Q_estimate is None else Q_estimate.detach().cpu(),
+            'Q_future': None if Q_future is None else Q_future.detach().cpu(),
+            'screen': None if step is None else step[0],
+            'context': [c for c in context if c is not None]
+        }
 
     def is_write_time(self):
         ''' Return whether it is time to write (either memory is full or it
             has been too much time since the last write '''
-        is_memory_full = (len(self.common_memory) >= self.common_memory.maxlen)
+        is_memory_full = (len(self.common_memory) >= self.queue_memory)
         is_time_reached = ((time() - self.last_write_time) >= self.min_write_gap)
         return (is_memory_full or is_time_reached)
 
@@ -95,27 +319,35 @@ class RetroEvaluator:
             self.s3.save_memory(self.common_memory,
                 f"{dir}/common_metrics/{num:010}.csv")
         elif metric_type == 'selective':
-            self.s3.save_memory(self.selective_memory,
-                f"{dir}/select_metrics/{num:010}.csv")
+            self.s3.save_memory([{
+                'counter': m['counter'],
+                'reason': m['reason'],
+                'Q_estimate': None if m['Q_estimate'] is None else m['Q_estimate'].tolist(),
+                'Q_future': None if m['Q_future'] is None else m['Q_future'].tolist()
+            } for m in self.selective_memory], f"{dir}/select_metrics/{num:010}.csv")
+            self.write_screens_s3(f"{dir}/select_screens/{num:010}.npz")
 
-    def write_metrics_redis(self, metric_type):
-        ''' '''
-        name = self.log_folder
-        pipe = self.redis_pipeline
+    def write_screens_s3(self, file_name):
+        ''' Store the uint8 screens of the selective memory as one compressed
+            NumPy archive, with arrays named after the step counters '''
+        screens = {}
+        for m in self.selective_memory:
+            if m['screen'] is not None:
+                screens[f"{m['counter']}"] = m['screen'].numpy()
+            for k, (screen, _) in enumerate(m['context']):
+                screens[f"{m['counter']}_context{k}"] = screen.numpy()
+        if len(screens) == 0:
+            return
+        with io.BytesIO() as buffer:
+            np.savez_compressed(buffer, **screens)
+            self.s3.save_bytes(buffer.getvalue(), file_name)
 
+    def write_metrics_redis(self, metric_type):
+        ''' Write either the common or selective metrics to Redis Streams '''
         if metric_type == 'common':
-            for m in self.common_memory:
-                pipe.rpush(name + ':action', m['action'])
-                pipe.rpush(name + ':reward', m['reward'])
-                pipe.rpush(name + ':loss', m['loss'])
+            self.redis_store.write_common(self.common_memory)
         elif metric_type == 'selective':
-            for m in self.selective_memory:
-                pipe.rpush(name + ':selective_times', m['counter'])
-                pipe.set(name + ':q_estimate:' + m['counter'], m['Q_estimate'][0])
-                pipe.set(name + ':q_future:' + m['counter'], m['Q_future'][0])
-                pipe.set(name + ':screen:' + m['counter'], m['screen'])
-        pipe.incrby(name + ':count', len(self.common_memory))
-        pipe.execute()
+            self.redis_store.write_selective(self.selective_memory)
 
     def write_metrics_local(self, metric_type):
         pass
@@ -136,11 +368,34 @@ class RetroEvaluator:
 
         if len(self.selective_memory) > 0:
             self.write_metrics_to_system('selective')
+            self.submit_clip()
             self.selective_memory.clear()
 
         self.write_number += 1
         self.last_write_time = time()
 
+    def submit_clip(self):
+        ''' Hand the selective memory entries that have a screen, each after
+            its context screens, to the clip encoder as one clip named after
+            the first of their counters '''
+        if self.clip_encoder is None:
+            return
+        entries = [m for m in self.selective_memory if m['screen'] is not None]
+        if len(entries) == 0:
+            return
+        frames = []
+        for m in entries:
+            frames += [to_clip_frame(screen, Q) for screen, Q in m['context']]
+            frames.append(to_clip_frame(m['screen'], m['Q_estimate']))
+        self.clip_encoder.submit(f"{entries[0]['counter']:010}", frames)
+
     def get_count(self):
         ''' Returns the step count '''
         return self.counter
+
+
+def detach_value(value):
+    ''' Return a tensor `value` detached and on the CPU, other values as is '''
+    if hasattr(value, 'detach'):
+        return value.detach().cpu()
+    return value
@@ -0,0 +1,218 @@
+import copy
+import torch
+import retro_utils as util
+
+from torch import nn
+
+from cnn_preprocess import FrameStacker
+
+# Fall back to no_grad on PyTorch versions without inference mode
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+class InferenceNetwork(nn.Module):
+    ''' Forward-only wrapper of the layers of a BasicConvolutionNetwork
+
+        Quantization stubs mark where activations enter and leave int8 (they
+        are identities otherwise), and the flatten uses `reshape` so that
+        channels_last activations need no contiguous copy before the
+        fully-connected layer.
+    '''
+
+    def __init__(self, model):
+        super(InferenceNetwork, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.conv_layer = model.conv_layer
+        self.fc_layer = model.fc_layer
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        out = self.quant(x)
+        out = self.conv_layer(out)
+        out = out.reshape(out.size(0), -1)
+        out = self.fc_layer(out)
+        return self.dequant(out)
+
+
+def conv_relu_pairs(layers):
+    ''' Return the names of every Conv2d directly followed by a ReLU '''
+    return [[str(i), str(i + 1)] for i in range(len(layers) - 1)
+            if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.ReLU)]
+
+
+class InferenceEngine:
+    ''' Frozen CPU inference graph of a trained BasicConvolutionNetwork
+
+        The layers are copied onto the CPU, each conv+ReLU pair is fused,
+        weights and activations use the channels_last layout, and the
+        network is traced and frozen into a TorchScript graph. `quantize`
+        optionally converts the network to int8 before tracing: 'dynamic'
+        quantizes the linear layer weights, 'static' quantizes the conv and
+        linear layers with activation ranges calibrated on
+        `calibration_screens`.
+    '''
+
+    def __init__(self, model, quantize = None, calibration_screens = None,
+                 backend = 'fbgemm'):
+        self.model = model
+        self.quantize = quantize
+        self.input_shape = model.get_input_shape(1)
+
+        network = InferenceNetwork(copy.deepcopy(model).cpu()).eval()
+        torch.quantization.fuse_modules(network.conv_layer,
+            conv_relu_pairs(network.conv_layer), inplace=True)
+
+        if quantize == 'dynamic':
+            network = torch.quantization.quantize_dynamic(network, {nn.Linear},
+                                                          dtype=torch.qint8)
+        elif quantize == 'static':
+            if calibration_screens is None:
+                raise ValueError("Static quantization needs calibration_screens")
+            torch.backends.quantized.engine = backend
+            network.qconfig = torch.quantization.get_default_qconfig(backend)
+            torch.quantization.prepare(network, inplace=True)
+            with torch.no_grad():
+                network(self.to_input(calibration_screens))
+            torch.quantization.convert(network, inplace=True)
+        elif quantize is not None:
+            raise ValueError("No quantization available for the given quantize")
+
+        network = network.to(memory_format=torch.channels_last)
+        example = self.to_input(torch.rand(self.input_shape))
+        with torch.no_grad():
+            graph = torch.jit.freeze(torch.jit.trace(network, example))
+            if quantize is None: # Fold the fused conv+ReLU into oneDNN kernels
+                graph = torch.jit.optimize_for_inference(graph)
+        self.graph = graph
+
+        # The first calls let the JIT profile and specialize the graph
+        with inference_mode():
+            for _ in range(3):
+                self.graph(example)
+
+    def to_input(self, screens):
+        ''' Return CPU screens [batch,color,height,width] in channels_last '''
+        if screens.dim() == 3:
+            screens = screens.unsqueeze(0)
+        return screens.cpu().contiguous(memory_format=torch.channels_last)
+
+    def forward(self, screens):
+        ''' Return the Q-values [batch,actions] of a batch of screen-tensors '''
+        with inference_mode():
+            return self.graph(self.to_input(screens))
+
+    def accuracy_gap(self, screens):
+        ''' Compare the engine against the eager fp32 model on `screens`
+
+        Returns:
+            dictionary with the max and mean absolute Q-value difference and
+            the share of screens where both choose the same best action
+        '''
+        reference_model = copy.deepcopy(self.model).cpu().eval()
+        with torch.no_grad():
+            reference = reference_model.forward(screens.cpu())
+        Q_values = self.forward(screens).float()
+        diff = (reference - Q_values).abs()
+        return {
+            'quantize': self.quantize,
+            'max_abs_diff': float(diff.max()),
+            'mean_abs_diff': float(diff.mean()),
+            'action_agreement': float((reference.argmax(1) == Q_values.argmax(1)).float().mean())
+        }
+
+
+def get_frame_stacker(model, num_envs):
+    ''' Return a FrameStacker matching `model`, or None without stacking '''
+    if model.frame_stack == 1:
+        return None
+    return FrameStacker(model.frame_stack, model.preprocessor.output_shape(), num_envs)
+
+
+def collect_screens(model, game_env, count):
+    ''' Return `count` network inputs (stacked if the model stacks screens)
+        seen while taking random actions from a freshly reset environment '''
+    stacker = get_frame_stacker(model, game_env.num_envs)
+    screens = model.convert_screen_to_input(game_env.reset())
+    inputs = [screens if stacker is None else stacker.reset(screens).clone()]
+    while sum(len(s) for s in inputs) < count:
+        buttons = [model.convert_action_to_buttons(model.get_random_action())
+                   for _ in range(game_env.num_envs)]
+        obs, rewards, dones, infos = game_env.step(buttons)
+        screens = model.convert_screen_to_input(obs)
+        inputs.append(screens if stacker is None else stacker.push(screens, dones).clone())
+    return torch.cat(inputs)[:count]
+
+
+def collect_separate_screens(args, model, count):
+    ''' Return `count` network inputs seen under a random policy in an
+        environment of its own, so the environment that is played and scored
+        never takes these steps '''
+    if args.environment == 'remote':
+        raise ValueError("Remote environment cannot provide a separate environment "
+                         "to collect calibration screens from")
+    from retro_vec_env import SubprocessVecEnv
+
+    # A worker process, since the emulator allows one instance per process
+    sample_env = SubprocessVecEnv(args.environment, 1, frame_skip = args.frame_skip,
+                                  env_options = util.get_environment_options(args))
+    try:
+        return collect_screens(model, sample_env, count)
+    finally:
+        sample_env.close()
+
+
+def run_inference(args, model, evaluator):
+    ''' Play `model` through the inference engine without any replay memory,
+        optimizer or gradient tracking, for validate and test modes '''
+    if args.inference_threads > 0:
+        torch.set_num_threads(args.inference_threads)
+
+    # Random-policy screens calibrate static quantization, and later held-out
+    # screens measure how far the engine drifts from the fp32 model on inputs
+    # it was not calibrated on, only when asked for
+    calibration_count = args.calibration_steps if args.quantize == 'static' else 0
+    held_out_count = args.calibration_steps if args.accuracy_gap else 0
+    calibration_screens, held_out_screens = None, None
+    if calibration_count + held_out_count > 0:
+        sample_screens = collect_separate_screens(args, model,
+                                                  calibration_count + held_out_count)
+        if calibration_count > 0:
+            calibration_screens = sample_screens[:calibration_count]
+        held_out_screens = sample_screens[calibration_count:]
+
+    engine = InferenceEngine(model, quantize = args.quantize,
+                             calibration_screens = calibration_screens)
+    if args.accuracy_gap:
+        print("Inference accuracy gap:", engine.accuracy_gap(held_out_screens))
+
+    game_env = util.get_vector_environment(args.environment, args.num_envs,
+                                           args.frame_skip,
+                                           util.get_environment_options(args))
+    num_envs = game_env.num_envs
+
+    # Screens are converted into one reused buffer, and pushed onto a rolling
+    # stack if the model stacks screens
+    stacker = get_frame_stacker(model, num_envs)
+    screens = engine.to_input(torch.empty(model.preprocessor.output_shape(num_envs)))
+    model.convert_screen_to_input(game_env.reset(), screens)
+    inputs = screens if stacker is None else stacker.reset(screens)
+
+    while evaluator.get_count() < args.max_step_count:
+        Q_estimates = engine.forward(inputs)
+
+        actions = [model.get_action(Q_estimates[i]) for i in range(num_envs)]
+        buttons = [model.convert_action_to_buttons(a) for a in actions]
+
+        obs, rewards, dones, infos = game_env.step(buttons)
+        model.convert_screen_to_input(obs, screens)
+        if stacker is not None:
+            inputs = stacker.push(screens, dones)
+
+        for i in range(num_envs):
+            evaluator.summarize_step(Q_estimate=Q_estimates[i], action=actions[i],
+                                     reward=float(rewards[i]))
+
+        if args.environment == 'local':
+            game_env.render()
+
+    game_env.close()
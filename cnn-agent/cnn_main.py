@@ -9,13 +9,18 @@ import torch.nn.functional as F
 from warnings import warn
 from torch import nn
 from torch.autograd import Variable
-from retro_s3 import RetroS3Client
+from retro_backends import get_storage_client
+from retro_s3 import BackgroundModelSaver, ModelCache
 
 from cnn_model import BasicConvolutionNetwork
 from cnn_config import CNNConfig
 from cnn_evaluator import RetroEvaluator
 from cnn_argparser import CNNArgumentParser
-from cnn_memory import UniformReplayMemory
+from cnn_memory import get_replay_memory, RingReplayMemory
+from cnn_target import TargetNetwork, TargetValueCache
+from cnn_preprocess import FrameStacker
+from cnn_sampler import PrefetchingSampler
+from cnn_profiler import PhaseProfiler
 
 parser = CNNArgumentParser()
 # sys.argv.extend(['build', '-l', 'test_ipy'])
@@ -27,7 +32,8 @@ else:
     args.device = torch.device('cpu')
 
 def main():
-    s3 = RetroS3Client()
+    # The storage backend is only imported and connected once first used
+    s3 = get_storage_client(args.storage_system, args.storage_root)
     model = None
     config = None
 
@@ -35,30 +41,45 @@ def main():
         warn("Running " + args.mode + " mode without loading existing model")
 
     if args.load_model_file == None:
+        # Only build mode defines these, the other modes take the defaults
         config = CNNConfig(
-            gamma = args.gamma,
+            gamma = getattr(args, 'gamma', 0.99),
             loss_func = F.smooth_l1_loss,
             opt_func = optim.SGD,
-            forecast_update_interval = args.forecast_update_interval,
-            model_save_interval = args.model_save_interval
+            forecast_update_interval = getattr(args, 'forecast_update_interval', 1e3),
+            model_save_interval = getattr(args, 'model_save_interval', 1e4)
         )
         model = BasicConvolutionNetwork(
-            epsilon = args.epsilon,
-            right_bias = args.right_bias,
-            image_to_grayscale = args.image_to_grayscale,
-            image_dimension = args.image_dimension
+            epsilon = getattr(args, 'epsilon', 0.10),
+            right_bias = getattr(args, 'right_bias', 0),
+            image_to_grayscale = getattr(args, 'image_to_grayscale', False),
+            image_dimension = getattr(args, 'image_dimension', (320,224)),
+            frame_stack = getattr(args, 'frame_stack', 1)
         )
     else:
         model = BasicConvolutionNetwork()
         config = CNNConfig()
 
-        model_buffer, config_buffer = s3.load_model_config_buffer(args.load_model_file)
-        model.load(model_buffer)
-        config.load(config_buffer)
+        # Checkpoints pulled off S3 are kept in a local cache keyed by ETag
+        cache = None
+        if args.storage_system == 's3' and args.model_cache_size > 0:
+            cache = ModelCache(args.model_cache_dir,
+                               max_bytes = int(args.model_cache_size * 2**30),
+                               ttl = args.model_cache_ttl)
+
+        model_state, config_state = s3.load_model_config_state(args.load_model_file,
+                                                               cache = cache)
+        model.load_state(model_state)
+        config.load_state(config_state)
 
     model.to(args.device)
     #config.to(args.device)
-    config.init_optimizer(model.parameters())
+
+    # Validate on every requested level concurrently in worker processes
+    if args.mode == 'validate' and args.levels is not None:
+        from cnn_validation import run_validation
+        run_validation(args, model, s3)
+        return
 
     # Set network to eval mode and do not track gradient if not training
     if args.mode in ['validate','train']:
@@ -66,62 +87,190 @@ def main():
         model.turn_off_gradients()
 
     evaluator = RetroEvaluator(
-        log_folder = args.log_folder
+        log_folder = args.log_folder,
+        log_system = args.log_system,
+        clip_format = args.diagnostic_clips,
+        clip_fps = args.clip_fps,
+        num_envs = args.num_envs,
+        gamma = config.gamma,
+        anomaly_quantile = args.anomaly_quantile,
+        anomaly_z_threshold = args.anomaly_z_threshold,
+        anomaly_warmup = args.anomaly_warmup,
+        max_selective = args.max_selective,
+        context_frames = args.context_frames,
+        screen_buffer_size = args.screen_buffer_size
     )
 
-    memory = UniformReplayMemory(
-        memory_size = args.memory_size,
-        batch_size = args.batch_size
-    )
-
-    game_env = util.get_environment(args.environment)
-
-    # Reset the game and get the initial screen
-    obs = game_env.reset()
-    current_screen = model.convert_screen_to_input(obs)
-
-    while evaluator.get_count() < args.max_step_count:
-        if args.mode == 'build' and args.use_experience_replay:
-            memory.sample_new_batch()
-
-        batch_states = memory.get_batch_start_including(current_screen)
+    # Play through the frozen CPU inference engine, skipping the replay
+    # memory and optimizer entirely
+    if args.mode in ['validate','test'] and args.inference_engine:
+        from cnn_inference import run_inference
+        run_inference(args, model, evaluator)
+        evaluator.close()
+        return
 
-        # Get the Q value for the current screen
-        Q_estimates = model.forward(batch_states.to(args.device))
+    config.init_optimizer(model.parameters())
 
-        # Determine the optimal buttons to press for the current screen
-        current_Q_estimate = Q_estimates[0]
-        action = model.get_action(current_Q_estimate)
-        buttons = model.convert_action_to_buttons(action)
+    # Checkpoints are snapshotted and saved on a background thread
+    chunk_options = None
+    if getattr(args, 'checkpoint_format', 'full') == 'chunked':
+        chunk_options = {'fp16': args.checkpoint_fp16, 'compress': args.checkpoint_zlib}
+    saver = BackgroundModelSaver(s3, chunk_options)
+
+    # Hand training over to a learner fed by separate actor processes
+    if args.mode == 'build' and args.num_actors > 0:
+        from cnn_distributed import run_learner
+        run_learner(args, model, config, evaluator, saver)
+        evaluator.close()
+        saver.close()
+        return
+
+    memory = get_replay_memory(
+        replay_type = getattr(args, 'replay_type', 'ring'),
+        memory_size = getattr(args, 'memory_size', 1),
+        batch_size = getattr(args, 'batch_size', 1),
+        replay_folder = getattr(args, 'replay_folder', None),
+        priority_alpha = getattr(args, 'priority_alpha', 0.6),
+        priority_beta = getattr(args, 'priority_beta', 0.4),
+        num_envs = args.num_envs,
+        frame_stack = model.frame_stack if args.mode == 'build' else 1,
+        codec = getattr(args, 'replay_codec', 'zlib'),
+        delta = getattr(args, 'replay_delta', False),
+        decode_threads = getattr(args, 'decode_threads', 4),
+        screen_shape = model.preprocessor.output_shape()
+    )
+    is_prioritized = getattr(args, 'replay_type', None) == 'prioritized'
+
+    # Optionally reuse forecast Q-values of replay slots between refreshes
+    target_cache = None
+    if getattr(args, 'cache_target_values', False):
+        if not isinstance(memory, RingReplayMemory):
+            raise ValueError("Target value caching needs a slot-based replay_type")
+        target_cache = TargetValueCache(args.memory_size, model.action_count,
+                                        args.device)
+
+    # Optionally gather the next replay batch while the emulators step
+    sampler = None
+    if args.mode == 'build' and args.use_experience_replay and args.prefetch_batches:
+        if not isinstance(memory, RingReplayMemory):
+            raise ValueError("Batch prefetching needs a slot-based replay_type")
+        sampler = PrefetchingSampler(memory, args.num_envs,
+                                     pin_memory = args.device.type == 'cuda',
+                                     gather_end_states = target_cache is None)
+
+    game_env = util.get_vector_environment(args.environment, args.num_envs,
+                                           args.frame_skip,
+                                           util.get_environment_options(args))
+    num_envs = game_env.num_envs
+
+    forecast_model = None
+    is_soft_update = getattr(args, 'target_tau', 0) > 0
+
+    profiler = PhaseProfiler(
+        enabled = args.profile,
+        device = args.device,
+        trace_steps = args.profile_trace_steps,
+        trace_file = os.path.expanduser(args.profile_trace_file)
+    )
 
-        # Apply the button presses and observe the results
-        obs, reward, done, info = game_env.step(buttons)
+    # Reset the games and get the initial screen of each environment
+    obs = game_env.reset()
+    current_screens = list(model.convert_screen_to_input(obs))
 
-        # Reset the screen if the game round was termianted
-        if done:
-            obs = game_env.reset()
+    # Replay stores single screens while the network sees a rolling stack of
+    # the latest screens of each environment
+    stacker = None
+    live_starts = torch.stack(current_screens)
+    if model.frame_stack > 1:
+        stacker = FrameStacker(model.frame_stack,
+                               model.preprocessor.output_shape(), num_envs)
+        live_starts = stacker.reset(live_starts)
 
-        next_screen = model.convert_screen_to_input(obs)
+    while evaluator.get_count() < args.max_step_count:
+        profiler.step(evaluator.get_count())
 
-        summary = {'Q_estimate': Q_estimates[0], 'action': action, 'reward': reward}
+        # Replay batches are read from the memory or from the prefetched batch
+        batch = memory
+        if args.mode == 'build' and args.use_experience_replay:
+            with profiler.phase('sample'):
+                if sampler is None:
+                    memory.sample_new_batch()
+                else: # Swap in the batch gathered during the last step
+                    batch = sampler.next_batch()
+
+        with profiler.phase('gather_starts'):
+            batch_states = batch.get_batch_start_including(live_starts)
+            # The live stack is a view the next push overwrites, so training
+            # on it directly needs its own copy for the backward pass
+            if args.mode == 'build' and batch_states is live_starts and stacker is not None:
+                batch_states = batch_states.clone()
+
+        # Get the Q values for the current screens in one batched pass
+        with profiler.phase('forward'):
+            Q_estimates = model.forward(batch_states.to(args.device))
+
+        # Determine the epsilon-greedy buttons to press for each environment
+        actions = [model.get_action(Q_estimates[i]) for i in range(num_envs)]
+        buttons = [model.convert_action_to_buttons(a) for a in actions]
+
+        # Gather the next replay batch in the background while stepping
+        if sampler is not None:
+            sampler.prefetch()
+
+        # Apply the button presses and observe the results (finished rounds
+        # are reset by the vectorized environment)
+        with profiler.phase('env_step'):
+            obs, rewards, dones, infos = game_env.step(buttons)
+
+        with profiler.phase('preprocess'):
+            next_screens = list(model.convert_screen_to_input(obs))
+            live_ends = torch.stack(next_screens)
+            if stacker is not None:
+                live_ends = stacker.push(live_ends, dones)
+
+        summaries = [
+            {'Q_estimate': Q_estimates[i], 'action': actions[i], 'reward': float(rewards[i]),
+             'next_screen': next_screens[i]}
+            for i in range(num_envs)
+        ]
 
         if args.mode == 'build':
-            batch_actions, batch_rewards, batch_next_screens = \
-                memory.get_batch_post_action_including(action, reward, next_screen)
+            with profiler.phase('gather_ends'):
+                if target_cache is None:
+                    batch_actions, batch_rewards, batch_next_screens = \
+                        batch.get_batch_post_action_including(actions, rewards,
+                                                              live_ends)
+                else: # Replayed end screens are only gathered on cache misses
+                    batch_actions, batch_rewards, _ = \
+                        batch.get_batch_post_action_including(actions, rewards,
+                                                              gather_end_states=False)
+                batch_dones = batch.get_batch_dones_including(dones)
 
             batch_actions = batch_actions.to(args.device)
             batch_rewards = batch_rewards.to(args.device)
 
-            # Periodically create or update a forecast model for future rewards
-            if config.is_forecast_update(evaluator.get_count()):
-                forecast_model = util.clone_checkpoint_nn(model)
-                forecast_model.to(args.device)
+            # Create the forecast model for future rewards once, then refresh
+            # it in place periodically (or softly after every update below)
+            if forecast_model is None:
+                forecast_model = TargetNetwork(model, tau = args.target_tau)
+            elif not is_soft_update and \
+                    config.is_forecast_update(evaluator.get_count(), num_envs):
+                forecast_model.sync(model)
+                if target_cache is not None:
+                    target_cache.invalidate_all()
 
             # Estimate the future Q-value options
-            Q_futures = forecast_model.forward(batch_next_screens.to(args.device))
-
-            if done: # Set future Q-values to zero if round terminated
-                Q_futures[0,:] = torch.zeros_like(Q_futures[0,:])
+            with profiler.phase('forecast'):
+                if target_cache is None:
+                    Q_futures = forecast_model.forward(batch_next_screens.to(args.device))
+                else:
+                    Q_futures = target_cache.forecast_batch_including(forecast_model,
+                                                        memory, live_ends)
+
+            # Set future Q-values to zero where the live or replayed round
+            # terminated, as the actor/learner trainer does
+            not_done = (1 - batch_dones).float().to(args.device).view(-1,1)
+            Q_futures = Q_futures * not_done
 
             # Calculate the loss and create a mask identifying the action taken
             loss = config.calculate_loss(Q_estimates, batch_rewards, Q_futures)
@@ -129,25 +278,67 @@ def main():
             action_mask = torch.zeros_like(loss)
             action_mask.scatter_(1, batch_actions.view(-1,1), 1.0)
 
-            # Run gradient only for chosen action - zero all others with mask
-            config.optimizer.zero_grad()
-            loss.backward(action_mask)
-            config.optimizer.step()
-
-            memory.add_memory(current_screen, action, reward, next_screen)
-            summary.update({'loss': loss[0], 'Q_future': Q_futures[0]})
+            # Scale replayed gradients by their importance-sampling weights
+            if is_prioritized:
+                weights = memory.get_batch_weights_including([1.0] * num_envs)
+                action_mask.mul_(weights.to(args.device).view(-1,1))
 
-            if config.is_model_save(evaluator.get_count()) and args.output_model_file != None:
+            # Run gradient only for chosen action - zero all others with mask
+            with profiler.phase('backward'):
+                config.optimizer.zero_grad()
+                loss.backward(action_mask)
+            with profiler.phase('optimizer'):
+                config.optimizer.step()
+
+            if is_soft_update:
+                forecast_model.soft_update(model)
+                if target_cache is not None:
+                    target_cache.invalidate_all()
+
+            # The memory must not change while the next batch is gathered
+            if sampler is not None:
+                with profiler.phase('prefetch_wait'):
+                    sampler.wait()
+
+            # Feed the loss of each replayed action back as its new priority
+            if is_prioritized:
+                action_loss = loss.detach().gather(1, batch_actions.view(-1,1))
+                memory.update_priorities(action_loss[num_envs:].view(-1))
+
+            with profiler.phase('memory_add'):
+                for i in range(num_envs):
+                    slot = memory.add_memory(current_screens[i], actions[i], rewards[i],
+                                             next_screens[i], dones[i])
+                    if target_cache is not None:
+                        target_cache.invalidate_slot(slot)
+                    summaries[i].update({'loss': loss[i], 'Q_future': Q_futures[i]})
+
+            if config.is_model_save(evaluator.get_count(), num_envs) and args.output_model_file != None:
                 out_path = os.path.expanduser(args.log_folder + '/' + args.output_model_file)
-                s3.save_model(model, config, out_path)
+                saver.save_model(model, config, out_path)
+                memory.flush(background=True)
 
         # Add all added summary information to the evaluator
-        evaluator.summarize_step(**summary)
+        with profiler.phase('summarize'):
+            for summary in summaries:
+                evaluator.summarize_step(**summary)
+
+        if args.profile and -evaluator.get_count() % args.profile_interval < num_envs:
+            evaluator.summarize_profile(profiler.summary())
 
         if args.environment == 'local':
             game_env.render()
 
-        current_screen = next_screen
+        current_screens = next_screens
+        live_starts = live_ends
+
+    if sampler is not None:
+        sampler.close()
+    profiler.close()
+    game_env.close()
+    evaluator.close()
+    saver.close()
+    memory.flush()
 
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
+import os
 import random
+import threading
 import torch
+import zlib
 import numpy as np
 
-from collections import deque
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 class UniformReplayMemory:
 
@@ -12,7 +16,7 @@ class UniformReplayMemory:
         self.memory = deque([], memory_size)
         self.last_batch = None
 
-    def add_memory(self, start_state, action, reward, end_state):
+    def add_memory(self, start_state, action, reward, end_state, done = False):
         ''' Add a new complete (s,a,r,s') memory for future replay
 
         Args:
@@ -22,8 +26,13 @@ class UniformReplayMemory:
             reward (float): reward resulting from the action
             end_state (tensor): resulting state after the action was applied,
                 must be a single-screen-tensor [color,width,height]
+            done (bool, optional): whether the action terminated the round
         '''
-        self.memory.append((start_state, action, reward, end_state))
+        self.memory.append((start_state, action, reward, end_state, done))
+
+    def flush(self, background = False):
+        ''' Persist the memory contents (no-op for in-process memories) '''
+        pass
 
     def sample_new_batch(self):
         ''' Pull a fresh batch sample (or leave as None if memory empty) '''
@@ -37,12 +46,13 @@ class UniformReplayMemory:
         Args:
             last_start (tensor, optional): includes an extra start state
                 `last_start`, must be a single-screen-tensor [color,width,height]
+                or a batch of live screen-tensors [envs,color,width,height]
 
         Returns:
             a batch of starting screen-tensors [batch,color,width,height] sampled
             from replay memory plus an optional `last_start` screen-tensor
         '''
-        start_states_list = [] if last_start is None else [last_start]
+        start_states_list = as_screen_list(last_start)
 
         if self.last_batch != None:
             start_states_list += [start for start,*_ in self.last_batch]
@@ -55,19 +65,21 @@ class UniformReplayMemory:
         ''' Returns a sample of start_states with the latest start in index 0
 
         Args:
-            last_action (int, optional): index of the latest action taken
-            last_reward (float, optional): latest reward resulting from the
-                `last_action` taken
+            last_action (int or list, optional): index of the latest action
+                taken (or a list with one index per environment)
+            last_reward (float or list, optional): latest reward resulting from
+                the `last_action` taken (or a list with one per environment)
             last_end_state (tensor, optional): latest end state after an action
                 was applied, must be a single-screen-tensor [color,width,height]
+                or a batch of live screen-tensors [envs,color,width,height]
 
         Returns:
             tuple of replay-sampled tensors of actions [batch], rewards [batch],
             and resulting screen states [batch,color,width,height]
         '''
-        actions = [] if last_action is None else [last_action]
-        rewards = [] if last_reward is None else [last_reward]
-        end_states = [] if last_end_state is None else [last_end_state]
+        actions = as_value_list(last_action)
+        rewards = as_value_list(last_reward)
+        end_states = as_screen_list(last_end_state)
 
         if self.last_batch != None:
             unzip_batch = list(zip(*self.last_batch))
@@ -76,3 +88,921 @@ class UniformReplayMemory:
             end_states += unzip_batch[3]
 
         return torch.LongTensor(actions), torch.FloatTensor(rewards), torch.stack(end_states)
+
+    def get_batch_dones_including(self, last_done = None):
+        ''' Return the done flags of the sample with the latest done first '''
+        dones = [int(bool(d)) for d in as_value_list(last_done)]
+        if self.last_batch != None:
+            dones += [int(bool(done)) for *_, done in self.last_batch]
+        return torch.ByteTensor(dones)
+
+
+class RingReplayMemory:
+    ''' Replay memory that keeps every screen as uint8 inside one preallocated
+        ring buffer, with parallel action/reward/done arrays and a head pointer
+        that wraps around once the memory is full
+
+        Screens are stored as uint8 at 1/4 of the float32 size. Full-size RGB
+        screens from `convert_screen_to_input` are bytes scaled into [0,1] and
+        round-trip exactly, while resized or grayscale screens are rounded to
+        the nearest 1/255 (at most 1/510 off per pixel).
+        Batches are gathered by index in a single call and only the sampled
+        batch is converted back into floats.
+    '''
+
+    def __init__(self, batch_size = 16, memory_size = 1e6):
+        self.batch_size = batch_size
+        self.memory_size = int(memory_size)
+        self.head = 0
+        self.count = 0
+        self.last_batch = None
+
+        # Frame buffers are allocated on the first add once the screen shape
+        # is known (torch.empty leaves untouched pages unallocated by the OS)
+        self.start_frames = None
+        self.end_frames = None
+
+        self.allocate_transitions()
+
+    def __len__(self):
+        return self.count
+
+    def allocate_transitions(self):
+        ''' Allocate the parallel action/reward/done arrays '''
+        self.actions = torch.zeros(self.memory_size, dtype=torch.long)
+        self.rewards = torch.zeros(self.memory_size, dtype=torch.float)
+        self.dones = torch.zeros(self.memory_size, dtype=torch.uint8)
+
+    def flush(self, background = False):
+        ''' Persist the memory contents (no-op for in-process memories) '''
+        pass
+
+    def allocate_frames(self, screen_shape):
+        ''' Allocate the uint8 frame buffers for screens of `screen_shape` '''
+        shape = (self.memory_size,) + tuple(screen_shape)
+        self.start_frames = torch.empty(shape, dtype=torch.uint8)
+        self.end_frames = torch.empty(shape, dtype=torch.uint8)
+
+    def add_memory(self, start_state, action, reward, end_state, done = False):
+        ''' Add a new complete (s,a,r,s') memory for future replay
+
+        Args:
+            start_state (tensor): initial state where an action needed to be
+                decided, must be a single-screen-tensor [color,width,height]
+            action (int): index of the action that was taken
+            reward (float): reward resulting from the action
+            end_state (tensor): resulting state after the action was applied,
+                must be a single-screen-tensor [color,width,height]
+            done (bool, optional): whether the action terminated the round
+
+        Returns:
+            int with the slot index the memory was written into
+        '''
+        if self.start_frames is None:
+            self.allocate_frames(start_state.shape)
+
+        i = self.head
+        self.start_frames[i] = screen_to_uint8(start_state)
+        self.end_frames[i] = screen_to_uint8(end_state)
+        self.actions[i] = int(action)
+        self.rewards[i] = float(reward)
+        self.dones[i] = int(bool(done))
+
+        self.head = (self.head + 1) % self.memory_size
+        self.count = min(self.count + 1, self.memory_size)
+        return i
+
+    def sample_new_batch(self):
+        ''' Pull a fresh batch of slot indices (or leave as None if memory is
+            empty) and make it the batch returned by the getters '''
+        indices = self.sample_indices()
+        if indices is not None:
+            self.set_batch(indices)
+
+    def sample_indices(self):
+        ''' Return a batch of slot indices sampled uniformly with replacement
+            without changing the last batch, or None if memory is empty '''
+        actual_batch_size = min(self.batch_size, self.count)
+        if actual_batch_size > 0:
+            # Filled slots are the `count` slots running up to the head
+            offsets = torch.randint(0, self.count, (actual_batch_size,),
+                dtype=torch.long)
+            return (offsets + self.head - self.count) % self.memory_size
+        return None
+
+    def set_batch(self, indices):
+        ''' Make the slot `indices` the batch returned by the getters '''
+        self.last_batch = indices
+
+    def gather_start_frames(self, indices):
+        ''' Return the uint8 start frames stored at the slot `indices` '''
+        return self.start_frames.index_select(0, indices)
+
+    def gather_end_frames(self, indices):
+        ''' Return the uint8 end frames stored at the slot `indices` '''
+        return self.end_frames.index_select(0, indices)
+
+    def get_batch_start_including(self, last_start = None):
+        ''' Return the sample of start_states with the latest start in index 0
+
+        Args:
+            last_start (tensor, optional): includes an extra start state
+                `last_start`, must be a single-screen-tensor [color,width,height]
+                or a batch of live screen-tensors [envs,color,width,height]
+
+        Returns:
+            a batch of starting screen-tensors [batch,color,width,height] sampled
+            from replay memory plus an optional `last_start` screen-tensor
+        '''
+        sampled = None
+        if self.last_batch is not None:
+            sampled = self.gather_start_frames(self.last_batch)
+        return merge_screen_batch(last_start, sampled)
+
+    def get_batch_post_action_including(self, last_action = None,
+                                    last_reward = None, last_end_state = None,
+                                    gather_end_states = True):
+        ''' Returns a sample of start_states with the latest start in index 0
+
+        Args:
+            last_action (int or list, optional): index of the latest action
+                taken (or a list with one index per environment)
+            last_reward (float or list, optional): latest reward resulting from
+                the `last_action` taken (or a list with one per environment)
+            last_end_state (tensor, optional): latest end state after an action
+                was applied, must be a single-screen-tensor [color,width,height]
+                or a batch of live screen-tensors [envs,color,width,height]
+            gather_end_states (bool, optional): set False to skip gathering the
+                replayed end screens (e.g. when their Q-values are cached), in
+                which case only `last_end_state` is returned as screens
+
+        Returns:
+            tuple of replay-sampled tensors of actions [batch], rewards [batch],
+            and resulting screen states [batch,color,width,height]
+        '''
+        actions = torch.LongTensor([int(a) for a in as_value_list(last_action)])
+        rewards = torch.FloatTensor([float(r) for r in as_value_list(last_reward)])
+        sampled = None
+
+        if self.last_batch is not None:
+            actions = torch.cat([actions, self.actions.index_select(0, self.last_batch)])
+            rewards = torch.cat([rewards, self.rewards.index_select(0, self.last_batch)])
+            if gather_end_states:
+                sampled = self.gather_end_frames(self.last_batch)
+
+        return actions, rewards, merge_screen_batch(last_end_state, sampled)
+
+    def get_batch_dones_including(self, last_done = None):
+        ''' Return the done flags of the sample with the latest done first
+
+        Args:
+            last_done (bool or list, optional): whether the latest action
+                terminated the round (or a list with one per environment)
+
+        Returns:
+            uint8 tensor of done flags [batch] aligned with the other batches
+        '''
+        dones = torch.ByteTensor([int(bool(d)) for d in as_value_list(last_done)])
+        if self.last_batch is not None:
+            dones = torch.cat([dones, self.dones.index_select(0, self.last_batch)])
+        return dones
+
+
+class FrameTableReplayMemory(RingReplayMemory):
+    ''' Ring replay memory that stores every screen once in a frame table
+
+        `cnn_main` passes the previous `next_screen` object as the following
+        `start_state`, so transitions are chained by object identity: the
+        start of a chained transition reuses the frame of the previous end and
+        only the new end screen is written. A transition that ends the round
+        (`done`) closes its chain, so the next round starts with a new frame.
+
+        The frame table is a ring of sequence-numbered frames. Writing a frame
+        evicts the oldest transitions whose start frame was overwritten, so a
+        fully chained memory of N transitions needs only N + `open_chains`
+        frames (unchained transitions use two frames each and therefore keep
+        fewer transitions in the same table).
+
+        Every frame also links to the previous frame of its round, so with
+        `frame_stack` > 1 the stacked start and end states are gathered from
+        the single-frame table instead of being stored.
+    '''
+
+    def __init__(self, batch_size = 16, memory_size = 1e6, open_chains = 1,
+                 frame_stack = 1):
+        super(FrameTableReplayMemory, self).__init__(batch_size, memory_size)
+        self.open_chains = open_chains
+        self.frame_stack = frame_stack
+        self.frame_table_size = self.memory_size + open_chains
+        self.frame_count = 0
+        self.frames = None
+        self.chain_ends = OrderedDict()
+
+        self.start_seqs = torch.zeros(self.memory_size, dtype=torch.long)
+        self.end_seqs = torch.zeros(self.memory_size, dtype=torch.long)
+
+    def allocate_frames(self, screen_shape):
+        ''' Allocate the uint8 frame table for screens of `screen_shape` '''
+        shape = (self.frame_table_size,) + tuple(screen_shape)
+        self.frames = torch.empty(shape, dtype=torch.uint8)
+        self.prev_seqs = torch.full((self.frame_table_size,), -1, dtype=torch.long)
+
+    def oldest_live_seq(self):
+        ''' Return the sequence number of the oldest frame still in the table '''
+        return self.frame_count - self.frame_table_size
+
+    def write_frame(self, screen, prev_seq = -1):
+        ''' Write `screen` into the frame table and return its sequence number,
+            evicting transitions whose start frame gets overwritten
+
+        Args:
+            screen (tensor): single-screen-tensor [color,width,height]
+            prev_seq (int, optional): sequence number of the previous frame
+                of the same round, or -1 if `screen` starts a round
+        '''
+        seq = self.frame_count
+        self.frames[seq % self.frame_table_size] = screen_to_uint8(screen)
+        self.prev_seqs[seq % self.frame_table_size] = prev_seq
+        self.frame_count += 1
+
+        self.evict_unreadable()
+        return seq
+
+    def evict_unreadable(self):
+        ''' Evict the oldest transitions until the start frame of the oldest
+            one left can still be read '''
+        while self.count > 0:
+            tail = (self.head - self.count) % self.memory_size
+            if bool(self.readable_seqs(self.start_seqs[tail:tail + 1])):
+                break
+            self.count -= 1
+
+    def readable_seqs(self, seqs):
+        ''' Return the mask of the frame sequence numbers `seqs` still held
+            in the frame table '''
+        return seqs >= max(self.oldest_live_seq(), 0)
+
+    def read_frames(self, seqs):
+        ''' Return the uint8 frames with the sequence numbers `seqs` '''
+        return self.frames.index_select(0, seqs % self.frame_table_size)
+
+    def pop_chain(self, start_state):
+        ''' Return the frame sequence number of `start_state` if it is the end
+            of an open chain still held in the frame table, otherwise None '''
+        entry = self.chain_ends.pop(id(start_state), None)
+        if entry is None or entry[0] is not start_state:
+            return None
+        if entry[1] < self.oldest_live_seq():
+            return None
+        return entry[1]
+
+    def push_chain(self, end_state, seq):
+        ''' Remember `end_state` as the open end of a chain of transitions '''
+        self.chain_ends[id(end_state)] = (end_state, seq)
+        while len(self.chain_ends) > self.open_chains:
+            self.chain_ends.popitem(last=False)
+
+    def add_memory(self, start_state, action, reward, end_state, done = False):
+        ''' Add a new complete (s,a,r,s') memory for future replay
+
+        Args:
+            start_state (tensor): initial state where an action needed to be
+                decided, must be a single-screen-tensor [color,width,height]
+            action (int): index of the action that was taken
+            reward (float): reward resulting from the action
+            end_state (tensor): resulting state after the action was applied,
+                must be a single-screen-tensor [color,width,height]
+            done (bool, optional): whether the action terminated the round
+
+        Returns:
+            int with the slot index the memory was written into
+        '''
+        if self.frames is None:
+            self.allocate_frames(start_state.shape)
+
+        start_seq = self.pop_chain(start_state)
+        if start_seq is None:
+            start_seq = self.write_frame(start_state)
+        end_seq = self.write_frame(end_state, start_seq)
+        if not done:
+            self.push_chain(end_state, end_seq)
+
+        i = self.head
+        self.start_seqs[i] = start_seq
+        self.end_seqs[i] = end_seq
+        self.actions[i] = int(action)
+        self.rewards[i] = float(reward)
+        self.dones[i] = int(bool(done))
+
+        self.head = (self.head + 1) % self.memory_size
+        self.count = min(self.count + 1, self.memory_size)
+        return i
+
+    def gather_stacked_frames(self, seqs):
+        ''' Return the uint8 frames `seqs` [batch] each stacked along the color
+            channels after the `frame_stack - 1` frames preceding it in its round
+
+        Stacks are gathered from the single-frame table by following the
+        previous-frame links, so nothing is stored more than once. Where a
+        round has fewer preceding frames (or they were overwritten) the
+        earliest available frame is repeated, like the live FrameStacker.
+
+        Returns:
+            uint8 tensor [batch,frame_stack*color,width,height]
+        '''
+        stack = [seqs]
+        for _ in range(self.frame_stack - 1):
+            prev = self.prev_seqs.index_select(0, stack[0] % self.frame_table_size)
+            stack.insert(0, torch.where(self.readable_seqs(prev), prev, stack[0]))
+
+        frames = self.read_frames(torch.stack(stack, 1).view(-1))
+        return frames.view((-1, self.frame_stack * frames.size(1)) + frames.shape[2:])
+
+    def gather_start_frames(self, indices):
+        ''' Return the uint8 start frames of the transitions at `indices` '''
+        return self.gather_stacked_frames(self.start_seqs.index_select(0, indices))
+
+    def gather_end_frames(self, indices):
+        ''' Return the uint8 end frames of the transitions at `indices` '''
+        return self.gather_stacked_frames(self.end_seqs.index_select(0, indices))
+
+
+class CompressedReplayMemory(FrameTableReplayMemory):
+    ''' Frame table replay memory that keeps every frame compressed
+
+        Each frame is compressed on insert with a fast codec (zlib level 1 or
+        lz4), and with `delta` the frames after the first of a round store
+        only their difference to the previous frame, which compresses far
+        better on mostly static screens. Every `keyframe_interval`-th frame
+        of a round is stored whole so no frame depends on a long chain.
+        Transitions are evicted once the keyframe their start frame depends
+        on is overwritten.
+
+        Sampled frames are decompressed in parallel on a thread pool of
+        `decode_threads` (both codecs release the GIL while decoding), each
+        task decoding one chain from its keyframe so stacked frames of the
+        same round are decoded once.
+    '''
+
+    def __init__(self, batch_size = 16, memory_size = 1e6, open_chains = 1,
+                 frame_stack = 1, codec = 'zlib', delta = False,
+                 keyframe_interval = 8, decode_threads = 4):
+        super(CompressedReplayMemory, self).__init__(batch_size, memory_size,
+                                                     open_chains, frame_stack)
+        self.compress, self.decompress = get_codec(codec)
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval if delta else 1
+        self.decode_threads = decode_threads
+        self.executor = None
+        self.compressed_bytes = 0
+
+        # Raw frames of the latest chain ends, to take deltas against
+        self.recent_frames = OrderedDict()
+
+    def allocate_frames(self, screen_shape):
+        ''' Allocate the compressed frame table for screens of `screen_shape` '''
+        self.frame_shape = tuple(screen_shape)
+        self.frames = [None] * self.frame_table_size
+        self.prev_seqs = torch.full((self.frame_table_size,), -1, dtype=torch.long)
+        self.key_seqs = torch.zeros(self.frame_table_size, dtype=torch.long)
+        self.depths = torch.zeros(self.frame_table_size, dtype=torch.long)
+
+        # NumPy views share memory with the tensors for fast scalar access
+        self.prev_array = self.prev_seqs.numpy()
+        self.key_array = self.key_seqs.numpy()
+        self.depth_array = self.depths.numpy()
+
+    def write_frame(self, screen, prev_seq = -1):
+        ''' Compress `screen` into the frame table and return its sequence
+            number, evicting transitions that can no longer be decoded
+
+        Args:
+            screen (tensor): single-screen-tensor [color,width,height]
+            prev_seq (int, optional): sequence number of the previous frame
+                of the same round, or -1 if `screen` starts a round
+        '''
+        seq = self.frame_count
+        slot = seq % self.frame_table_size
+        frame = screen_to_uint8(screen).contiguous().numpy()
+
+        previous = self.recent_frames.pop(prev_seq, None)
+        depth = 0
+        if previous is not None and prev_seq >= 0:
+            depth = (int(self.depth_array[prev_seq % self.frame_table_size]) + 1) % \
+                self.keyframe_interval
+
+        if self.frames[slot] is not None:
+            self.compressed_bytes -= len(self.frames[slot])
+        if depth == 0:
+            self.frames[slot] = self.compress(frame.tobytes())
+            self.key_array[slot] = seq
+        else:
+            self.frames[slot] = self.compress((frame - previous).tobytes())
+            self.key_array[slot] = self.key_array[prev_seq % self.frame_table_size]
+        self.compressed_bytes += len(self.frames[slot])
+        self.prev_array[slot] = prev_seq
+        self.depth_array[slot] = depth
+        self.frame_count += 1
+
+        if self.delta:
+            self.recent_frames[seq] = frame
+            while len(self.recent_frames) > 2 * self.open_chains:
+                self.recent_frames.popitem(last=False)
+
+        self.evict_unreadable()
+        return seq
+
+    def readable_seqs(self, seqs):
+        ''' Return the mask of the frame sequence numbers `seqs` whose frame
+            and keyframe are still held in the frame table '''
+        oldest = max(self.oldest_live_seq(), 0)
+        keys = self.key_seqs.index_select(0, seqs % self.frame_table_size)
+        return (seqs >= oldest) & (keys >= oldest)
+
+    def decode_chains(self, chains, positions, out):
+        ''' Decode each chain of sequence numbers (latest first) from its
+            keyframe onward, writing the frames at `positions` into `out` '''
+        for chain in chains:
+            frame = None
+            for seq in reversed(chain):
+                data = np.frombuffer(self.decompress(self.frames[seq % self.frame_table_size]),
+                                     dtype=np.uint8)
+                frame = data if frame is None else frame + data
+                for i in positions.get(seq, []):
+                    out[i] = frame.reshape(self.frame_shape)
+
+    def read_frames(self, seqs):
+        ''' Return the uint8 frames with the sequence numbers `seqs`,
+            decompressed in parallel '''
+        seqs = seqs.tolist()
+        positions = {}
+        for i, seq in enumerate(seqs):
+            positions.setdefault(seq, []).append(i)
+
+        # Latest frames first, so frames preceding them in a round are
+        # decoded on the way instead of through chains of their own
+        chains, covered = [], set()
+        for seq in sorted(positions, reverse=True):
+            if seq in covered:
+                continue
+            chain = [seq]
+            while self.depth_array[chain[-1] % self.frame_table_size] > 0:
+                chain.append(int(self.prev_array[chain[-1] % self.frame_table_size]))
+            covered.update(chain)
+            chains.append(chain)
+
+        frames = torch.empty((len(seqs),) + self.frame_shape, dtype=torch.uint8)
+        out = frames.numpy()
+        if self.decode_threads <= 1 or len(chains) == 1:
+            self.decode_chains(chains, positions, out)
+            return frames
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = self.decode_threads)
+        tasks = [self.executor.submit(self.decode_chains, chains[t::self.decode_threads],
+                                      positions, out)
+                 for t in range(min(self.decode_threads, len(chains)))]
+        for task in tasks:
+            task.result()
+        return frames
+
+    def compression_ratio(self):
+        ''' Return the raw size of the stored frames over their compressed size '''
+        stored = min(self.frame_count, self.frame_table_size)
+        if stored == 0:
+            return float('nan')
+        return stored * int(np.prod(self.frame_shape)) / self.compressed_bytes
+
+
+class MemoryMappedReplayMemory(RingReplayMemory):
+    ''' Ring replay memory whose arrays live in memory-mapped files on disk
+
+        Frames, actions, rewards and done flags are kept in fixed-layout files
+        inside `folder`, next to a small int64 header holding the head pointer,
+        the fill count and the frame shape. Large memories are then backed by
+        the page cache instead of the process heap, and re-opening the same
+        folder after a restart resumes with the memory as it was last flushed.
+        Re-opening it with another memory_size, or with screens of another
+        shape than the stored frames, raises a ValueError.
+
+        Header layout: [magic, version, memory_size, head, count, *frame_shape]
+    '''
+
+    HEADER_MAGIC = 0x52455452524550 # 'RETRREP'
+    HEADER_VERSION = 1
+    HEADER_SIZE = 8
+
+    def __init__(self, folder, batch_size = 16, memory_size = 1e6, screen_shape = None):
+        self.folder = os.path.expanduser(folder)
+        self.mapped_arrays = {}
+        self.flush_thread = None
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.header = self.open_array('header', np.int64, (self.HEADER_SIZE,))
+        is_existing = (self.header[0] == self.HEADER_MAGIC)
+
+        if is_existing and self.header[2] != int(memory_size):
+            raise ValueError("Replay memory in " + self.folder +
+                " was created with a different memory_size")
+
+        stored_shape = tuple(int(d) for d in self.header[5:] if d > 0)
+        if is_existing and self.header[4] > 0 and screen_shape is not None and \
+                stored_shape != tuple(screen_shape):
+            raise ValueError("Replay memory in " + self.folder +
+                " was created with a different screen shape")
+
+        super(MemoryMappedReplayMemory, self).__init__(batch_size, memory_size)
+
+        if is_existing:
+            self.head = int(self.header[3])
+            self.count = int(self.header[4])
+            if self.count > 0:
+                self.allocate_frames(stored_shape)
+        else:
+            self.header[:] = 0
+            self.header[0] = self.HEADER_MAGIC
+            self.header[1] = self.HEADER_VERSION
+            self.header[2] = self.memory_size
+            self.header.flush()
+
+    def open_array(self, name, dtype, shape):
+        ''' Map the file `name` inside the folder as a numpy array, reusing the
+            existing file if it already has the expected size '''
+        path = os.path.join(self.folder, name + '.bin')
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        is_reusable = os.path.exists(path) and os.path.getsize(path) == nbytes
+
+        array = np.memmap(path, dtype=dtype, shape=shape,
+            mode='r+' if is_reusable else 'w+')
+        self.mapped_arrays[name] = array
+        return array
+
+    def allocate_transitions(self):
+        ''' Map the parallel action/reward/done arrays '''
+        shape = (self.memory_size,)
+        self.actions = torch.from_numpy(self.open_array('actions', np.int64, shape))
+        self.rewards = torch.from_numpy(self.open_array('rewards', np.float32, shape))
+        self.dones = torch.from_numpy(self.open_array('dones', np.uint8, shape))
+
+    def allocate_frames(self, screen_shape):
+        ''' Map the uint8 frame files for screens of `screen_shape` '''
+        if len(screen_shape) > self.HEADER_SIZE - 5:
+            raise ValueError("Screen shape has too many dimensions to store")
+
+        shape = (self.memory_size,) + tuple(screen_shape)
+        self.start_frames = torch.from_numpy(
+            self.open_array('start_frames', np.uint8, shape))
+        self.end_frames = torch.from_numpy(
+            self.open_array('end_frames', np.uint8, shape))
+        self.header[5:] = 0
+        self.header[5:5+len(screen_shape)] = screen_shape
+
+    def add_memory(self, start_state, action, reward, end_state, done = False):
+        ''' Add a new (s,a,r,s') memory, rejecting screens of another shape
+            than the frames stored in the folder '''
+        if self.start_frames is not None and \
+                tuple(start_state.shape) != tuple(self.start_frames.shape[1:]):
+            raise ValueError("Replay memory in " + self.folder +
+                " holds screens of a different shape")
+        return super(MemoryMappedReplayMemory, self).add_memory(
+            start_state, action, reward, end_state, done)
+
+    def flush(self, background = False):
+        ''' Flush the mapped transitions onto disk, then advance the on-disk
+            header to the slots they hold
+
+        Args:
+            background (bool, optional): flush on a background thread instead,
+                skipped if the previous background flush is still running
+        '''
+        if background:
+            if self.flush_thread is None or not self.flush_thread.is_alive():
+                self.flush_thread = threading.Thread(target=self.flush, daemon=True)
+                self.flush_thread.start()
+            return
+        if self.flush_thread is not None and \
+                self.flush_thread is not threading.current_thread():
+            self.flush_thread.join()
+
+        head, count = self.head, self.count
+        for name, array in self.mapped_arrays.items():
+            if name != 'header':
+                array.flush()
+
+        # Header only moves once the slots it covers are on disk, so a crash
+        # never exposes a slot that was not written out (slots overwritten
+        # since the last flush may still be torn after the ring wraps)
+        self.header[3] = head
+        self.header[4] = count
+        self.header.flush()
+
+
+class SumTree:
+    ''' Binary sum-tree over `capacity` leaf priorities stored as a flat heap
+        (node i has children 2i and 2i+1, leaves start at `leaf_offset`)
+
+        Lookups and updates walk one tree level at a time but are vectorized
+        across the whole batch, so each costs O(log n) numpy operations
+        regardless of the batch size.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.depth = max(1, int(np.ceil(np.log2(self.capacity))))
+        self.leaf_offset = 2 ** self.depth
+        self.tree = np.zeros(2 * self.leaf_offset, dtype=np.float64)
+
+    def total(self):
+        ''' Return the sum of all leaf priorities '''
+        return self.tree[1]
+
+    def get(self, indices):
+        ''' Return the leaf priorities at `indices` '''
+        return self.tree[np.asarray(indices) + self.leaf_offset]
+
+    def update(self, indices, priorities):
+        ''' Set the leaf priorities at `indices` and refresh their ancestors
+
+        Args:
+            indices (np.array): leaf indices to update
+            priorities (np.array): new priority for each leaf index
+        '''
+        nodes = np.asarray(indices, dtype=np.int64) + self.leaf_offset
+        self.tree[nodes] = priorities
+
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        ''' Return the leaf index holding each prefix-sum value in `values`
+
+        Args:
+            values (np.array): prefix sums, each within [0, total())
+
+        Returns:
+            np.array of leaf indices, one per value
+        '''
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+
+        return np.minimum(nodes - self.leaf_offset, self.capacity - 1)
+
+
+class PrioritizedReplayMemory(RingReplayMemory):
+    ''' Ring replay memory sampling transitions in proportion to priority^alpha
+
+        Priorities come from the per-sample loss of each replayed transition
+        and are kept in a `SumTree`, so insertion, stratified sampling and
+        batched priority updates are all O(log n). New transitions enter with
+        the largest priority seen so far so they are replayed at least once.
+        Importance-sampling weights (N * P(i))^-beta, normalized by their
+        maximum, correct for the non-uniform sampling.
+    '''
+
+    def __init__(self, batch_size = 16, memory_size = 1e6, alpha = 0.6,
+                 beta = 0.4, min_priority = 1e-6):
+        super(PrioritizedReplayMemory, self).__init__(batch_size, memory_size)
+        self.alpha = alpha
+        self.beta = beta
+        self.min_priority = min_priority
+        self.max_priority = 1.0
+        self.tree = SumTree(self.memory_size)
+        self.last_weights = None
+
+    def add_memory(self, start_state, action, reward, end_state, done = False):
+        ''' Add a new (s,a,r,s') memory with the maximum priority seen so far '''
+        slot = super(PrioritizedReplayMemory, self).add_memory(
+            start_state, action, reward, end_state, done)
+        self.tree.update([slot], [self.max_priority ** self.alpha])
+        return slot
+
+    def sample_indices(self):
+        ''' Return a batch of slot indices stratified over the total priority
+            without changing the last batch, or None if memory is empty '''
+        actual_batch_size = min(self.batch_size, self.count)
+        if actual_batch_size > 0:
+            total = self.tree.total()
+            segment = total / actual_batch_size
+            values = (np.arange(actual_batch_size) +
+                np.random.uniform(size=actual_batch_size)) * segment
+            return torch.from_numpy(
+                self.tree.find(np.minimum(values, np.nextafter(total, 0))))
+        return None
+
+    def set_batch(self, indices):
+        ''' Make the slot `indices` the last batch and compute its importance
+            weights from the current priorities '''
+        total = self.tree.total()
+        probabilities = self.tree.get(indices.numpy()) / total
+        weights = (self.count * np.maximum(probabilities, 1e-12)) ** -self.beta
+
+        self.last_batch = indices
+        self.last_weights = torch.from_numpy(
+            (weights / weights.max()).astype(np.float32))
+
+    def get_batch_weights_including(self, last_weight = None):
+        ''' Return the importance-sampling weights of the last batch
+
+        Args:
+            last_weight (float or list, optional): weight of the extra latest
+                transition placed first (or a list with one per environment)
+
+        Returns:
+            tensor of weights [batch] aligned with the other batch tensors
+        '''
+        weights = torch.FloatTensor([float(w) for w in as_value_list(last_weight)])
+        if self.last_batch is not None:
+            weights = torch.cat([weights, self.last_weights])
+        return weights
+
+    def update_priorities(self, priorities):
+        ''' Update the priorities of the last sampled batch
+
+        Args:
+            priorities (tensor): new priority [batch] for each transition of
+                the last batch, e.g. the per-sample loss of the taken action
+        '''
+        if self.last_batch is None:
+            return
+        priorities = np.abs(priorities.detach().cpu().numpy().astype(np.float64))
+        priorities = np.maximum(priorities, self.min_priority)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(self.last_batch.numpy(), priorities ** self.alpha)
+
+
+class SharedReplayMemory(RingReplayMemory):
+    ''' Ring replay memory held in shared memory so several actor processes
+        can add transitions while a learner process samples from it
+
+        Frames are allocated up front since every process needs the same
+        buffers, and the head/count pointers live in a shared tensor. All
+        reads and writes hold a re-entrant process lock, so the learner can
+        also hold `lock` across several getters to read a consistent batch.
+    '''
+
+    def __init__(self, screen_shape, lock, batch_size = 16, memory_size = 1e6):
+        self.lock = lock
+        self.pointers = torch.zeros(2, dtype=torch.long).share_memory_()
+        super(SharedReplayMemory, self).__init__(batch_size, memory_size)
+        self.allocate_frames(screen_shape)
+        self.start_frames.share_memory_()
+        self.end_frames.share_memory_()
+
+    @property
+    def head(self):
+        return int(self.pointers[0])
+
+    @head.setter
+    def head(self, value):
+        self.pointers[0] = value
+
+    @property
+    def count(self):
+        return int(self.pointers[1])
+
+    @count.setter
+    def count(self, value):
+        self.pointers[1] = value
+
+    def allocate_transitions(self):
+        ''' Allocate the parallel action/reward/done arrays in shared memory '''
+        super(SharedReplayMemory, self).allocate_transitions()
+        for t in [self.actions, self.rewards, self.dones]:
+            t.share_memory_()
+
+    def add_memory(self, start_state, action, reward, end_state, done = False):
+        with self.lock:
+            return super(SharedReplayMemory, self).add_memory(
+                start_state, action, reward, end_state, done)
+
+    def sample_new_batch(self):
+        with self.lock:
+            super(SharedReplayMemory, self).sample_new_batch()
+
+    def get_batch_start_including(self, last_start = None):
+        with self.lock:
+            return super(SharedReplayMemory, self).get_batch_start_including(
+                last_start)
+
+    def get_batch_post_action_including(self, last_action = None,
+                                    last_reward = None, last_end_state = None,
+                                    gather_end_states = True):
+        with self.lock:
+            return super(SharedReplayMemory, self).get_batch_post_action_including(
+                last_action, last_reward, last_end_state, gather_end_states)
+
+    def get_batch_dones_including(self, last_done = None):
+        with self.lock:
+            return super(SharedReplayMemory, self).get_batch_dones_including(
+                last_done)
+
+
+def screen_to_uint8(screen):
+    ''' Convert a [0,1] float screen-tensor into its uint8 storage form '''
+    return screen.detach().mul(255).round().byte()
+
+
+def as_value_list(value):
+    ''' Return a list of live values: empty for None, the values of a list,
+        tuple or array, or otherwise a list holding the single `value` '''
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    return [value]
+
+
+def as_screen_list(screen):
+    ''' Return a list of live screens from None, a single-screen-tensor
+        [color,width,height] or a batch of screens [envs,color,width,height] '''
+    if screen is None:
+        return []
+    if screen.dim() == 4:
+        return list(screen)
+    return [screen]
+
+
+def merge_screen_batch(live_screen, sampled_frames):
+    ''' Build a float screen batch with the optional `live_screen` first
+        followed by the uint8 `sampled_frames`, converting only the sample
+
+    Args:
+        live_screen (tensor, optional): single-screen-tensor [color,width,height]
+            or batch of live screen-tensors [envs,color,width,height]
+        sampled_frames (tensor, optional): uint8 frames [batch,color,width,height]
+
+    Returns:
+        float screen-tensor batch [batch,color,width,height] scaled into [0,1]
+    '''
+    if live_screen is not None and live_screen.dim() == 3:
+        live_screen = live_screen.unsqueeze(0)
+    if sampled_frames is None:
+        return live_screen
+
+    offset = 0 if live_screen is None else live_screen.size(0)
+    out = torch.empty((sampled_frames.size(0) + offset,) + sampled_frames.shape[1:])
+    if live_screen is not None:
+        out[:offset] = live_screen
+    out[offset:].copy_(sampled_frames).div_(255)
+    return out
+
+
+def get_codec(codec):
+    ''' Return the (compress, decompress) pair of the fast codec `codec` '''
+    if codec == 'zlib':
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    elif codec == 'lz4':
+        import lz4.frame # Optional dependency, only needed for this codec
+        return lz4.frame.compress, lz4.frame.decompress
+    else:
+        raise ValueError("No codec available for the given codec")
+
+
+def get_replay_memory(replay_type, batch_size = 16, memory_size = 1e6,
+                      replay_folder = None, priority_alpha = 0.6,
+                      priority_beta = 0.4, num_envs = 1, frame_stack = 1,
+                      codec = 'zlib', delta = False, decode_threads = 4,
+                      screen_shape = None):
+    ''' Return the replay memory implementation matching `replay_type` '''
+    if frame_stack > 1 and replay_type not in ['dedup', 'compressed']:
+        raise ValueError("Frame stacking needs the single-frame store of replay_type "
+                         "'dedup' or 'compressed'")
+
+    if replay_type == 'uniform':
+        return UniformReplayMemory(batch_size = batch_size,
+                                   memory_size = int(memory_size))
+    elif replay_type == 'ring':
+        return RingReplayMemory(batch_size = batch_size,
+                                memory_size = memory_size)
+    elif replay_type == 'dedup':
+        return FrameTableReplayMemory(batch_size = batch_size,
+                                      memory_size = memory_size,
+                                      open_chains = num_envs,
+                                      frame_stack = frame_stack)
+    elif replay_type == 'compressed':
+        return CompressedReplayMemory(batch_size = batch_size,
+                                      memory_size = memory_size,
+                                      open_chains = num_envs,
+                                      frame_stack = frame_stack,
+                                      codec = codec,
+                                      delta = delta,
+                                      decode_threads = decode_threads)
+    elif replay_type == 'mmap':
+        return MemoryMappedReplayMemory(folder = replay_folder,
+                                        batch_size = batch_size,
+                                        memory_size = memory_size,
+                                        screen_shape = screen_shape)
+    elif replay_type == 'prioritized':
+        return PrioritizedReplayMemory(batch_size = batch_size,
+                                       memory_size = memory_size,
+                                       alpha = priority_alpha,
+                                       beta = priority_beta)
+    else:
+        raise ValueError("No replay memory available for the given replay_type")
@@ -4,21 +4,21 @@ import numpy as np
 
 from random import random, randint
 from torch import nn
-from torch.autograd import Variable
 
-from torchvision.transforms.functional import to_pil_image
-from torchvision.transforms.functional import to_tensor
+from cnn_preprocess import ScreenPreprocessor
+from retro_s3 import load_pickled
 
 
 class BasicConvolutionNetwork(nn.Module):
 
     def __init__(self, epsilon = 0.05, right_bias = 0, image_to_grayscale = False,
-                image_dimension = (100,100)):
+                image_dimension = (100,100), frame_stack = 1):
         ''' Initialize DQN network '''
         super(BasicConvolutionNetwork, self).__init__()
 
         self.image_dimension = image_dimension
         self.image_to_grayscale = image_to_grayscale
+        self.frame_stack = frame_stack
         self.epsilon = epsilon
         self.right_bias = right_bias
 
@@ -47,7 +47,10 @@ class BasicConvolutionNetwork(nn.Module):
 
     def __init_network__(self):
         ''' Create the actual neural network after basic initialization '''
-        input_dimension = 1 if self.image_to_grayscale else 3
+        # Stacked screens are concatenated along the color channels
+        input_dimension = (1 if self.image_to_grayscale else 3) * self.frame_stack
+        self.preprocessor = ScreenPreprocessor(self.image_to_grayscale,
+                                               self.image_dimension)
 
         if self.image_dimension == (320,224):
             self.conv_layer = nn.Sequential(
@@ -84,24 +87,25 @@ class BasicConvolutionNetwork(nn.Module):
         # Increase bias to move rightwards
         self.fc_layer[0].bias.data[10].add_(self.right_bias)
 
-    def convert_screen_to_input(self, obs):
+    def convert_screen_to_input(self, obs, out = None):
         ''' Convert the screen from an image into an array suitable for NN
 
         Args:
-            NumPy array [height,width,color] where color is RGB (3 dimensions)
+            NumPy array [height,width,color] where color is RGB (3 dimensions),
+                or a batch of them [batch,height,width,color]
+            out (tensor, optional): buffer to write the converted screens into
 
         Returns:
             a single-screen tensor [color, width, height] where color is either
-            RGB (3 dimensions) or grayscale (1 dimension)
+            RGB (3 dimensions) or grayscale (1 dimension), or a batch of them
         '''
-        pil_image = to_pil_image(obs)
-        if self.image_to_grayscale:
-            #obs = self.numpy_rgb_to_grayscale(obs)
-            pil_image = pil_image.convert('L')
-        if self.image_dimension != (320,224):
-            pil_image = pil_image.resize(self.image_dimension)
-        nn_input = Variable(to_tensor(pil_image))
-        return nn_input
+        return self.preprocessor(obs, out)
+
+    def get_input_shape(self, batch_size = None):
+        ''' Return the network input shape [color*frame_stack,height,width],
+            with a leading batch dimension if `batch_size` is given '''
+        shape = self.preprocessor.output_shape(batch_size)
+        return shape[:-3] + (shape[-3] * self.frame_stack,) + shape[-2:]
 
     def forward(self, x):
         out = self.conv_layer(x)
@@ -198,22 +202,40 @@ class BasicConvolutionNetwork(nn.Module):
             if value == 1
         ])
 
-    def save(self, path_or_buffer):
-        ''' Save model to a local file path or buffer '''
-        torch.save({
-            'model': self.state_dict(),
+    def get_state(self, snapshot = False):
+        ''' Return the dictionary written by `save`
+
+        Args:
+            snapshot (bool, optional): copy the parameters onto the CPU so the
+                state stays fixed while training continues
+        '''
+        model_state = self.state_dict()
+        if snapshot:
+            model_state = type(model_state)(
+                (k, v.detach().to('cpu', copy=True)) for k, v in model_state.items())
+        return {
+            'model': model_state,
             'epsilon': self.epsilon,
             'right_bias': self.right_bias,
             'image_dimension': self.image_dimension,
-            'image_to_grayscale': self.image_to_grayscale
-        }, path_or_buffer)
+            'image_to_grayscale': self.image_to_grayscale,
+            'frame_stack': self.frame_stack
+        }
+
+    def save(self, path_or_buffer):
+        ''' Save model to a local file path or buffer '''
+        torch.save(self.get_state(), path_or_buffer)
 
     def load(self, path_or_buffer):
         ''' Load model from a local file path or buffer '''
-        loaded_dict = torch.load(path_or_buffer)
+        self.load_state(load_pickled(path_or_buffer))
+
+    def load_state(self, loaded_dict):
+        ''' Load model from a dictionary as returned by `get_state` '''
         self.epsilon = loaded_dict['epsilon']
         self.right_bias = loaded_dict['right_bias']
         self.image_dimension = loaded_dict['image_dimension']
         self.image_to_grayscale = loaded_dict['image_to_grayscale']
+        self.frame_stack = loaded_dict.get('frame_stack', 1)
         self.__init_network__()
         self.load_state_dict(loaded_dict['model'])
@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# ITU-R 601-2 luma weights (as used by PIL's convert('L')) pre-scaled into [0,1]
+GRAYSCALE_WEIGHTS = [[0.299 / 255], [0.587 / 255], [0.114 / 255]]
+
+
+class ScreenPreprocessor:
+    ''' Convert emulator frames into network inputs using tensor operations
+        only: grayscale, area-resize and scaling into [0,1] without PIL
+
+        Accepts a single frame or a batch of frames (e.g. from a vectorized
+        environment) and can write the result into a caller-provided buffer.
+    '''
+
+    def __init__(self, image_to_grayscale = False, image_dimension = (320,224)):
+        self.image_to_grayscale = image_to_grayscale
+        self.image_dimension = tuple(image_dimension)
+        self.channels = 1 if image_to_grayscale else 3
+        self.gray_weights = torch.FloatTensor(GRAYSCALE_WEIGHTS)
+
+    def output_shape(self, batch_size = None):
+        ''' Return the screen-tensor shape [color,height,width], with a leading
+            batch dimension if `batch_size` is given '''
+        width, height = self.image_dimension
+        shape = (self.channels, height, width)
+        return shape if batch_size is None else (batch_size,) + shape
+
+    def __call__(self, frames, out = None):
+        return self.convert(frames, out)
+
+    def convert(self, frames, out = None):
+        ''' Convert frames into screen-tensors suitable for the network
+
+        Args:
+            frames (np.array or tensor): uint8 frame [height,width,color] or
+                batch of frames [batch,height,width,color] with RGB color
+            out (tensor, optional): float buffer with the output shape to write
+                the result into instead of allocating a new tensor
+
+        Returns:
+            float screen-tensor [color,height,width] (or a batch of them
+            [batch,color,height,width]) scaled into [0,1]
+        '''
+        if isinstance(frames, np.ndarray):
+            frames = torch.from_numpy(np.ascontiguousarray(frames))
+
+        is_single = (frames.dim() == 3)
+        if is_single:
+            frames = frames.unsqueeze(0)
+
+        if out is None:
+            out = torch.empty(self.output_shape(None if is_single else frames.size(0)))
+        batch_out = out.unsqueeze(0) if is_single else out
+
+        width, height = self.image_dimension
+        is_resize = (frames.size(1), frames.size(2)) != (height, width)
+
+        if self.image_to_grayscale:
+            # Weighted channel sum also scales into [0,1] in the same matmul
+            x = torch.matmul(frames.float(), self.gray_weights).permute(0,3,1,2)
+            if is_resize:
+                x = F.adaptive_avg_pool2d(x, (height, width))
+            batch_out.copy_(x)
+        elif is_resize:
+            x = F.adaptive_avg_pool2d(frames.permute(0,3,1,2).float(), (height, width))
+            torch.mul(x, 1 / 255, out=batch_out)
+        else:
+            # copy_ converts uint8 to float while permuting in a single pass
+            batch_out.copy_(frames.permute(0,3,1,2)).mul_(1 / 255)
+
+        return out
+
+
+class FrameStacker:
+    ''' Rolling stack of the latest `frame_stack` screens of each environment
+
+        Every new screen is written into two slots, p and p + K, of a buffer
+        holding 2K screens per environment, so the latest K screens always
+        sit in K consecutive slots. The stack is then a view of the buffer
+        and nothing is reallocated or shifted between steps. Environments
+        that start a new round get their stack filled with the first screen.
+        The returned stack is overwritten by the next `push` or `reset`.
+    '''
+
+    def __init__(self, frame_stack, screen_shape, num_envs = 1):
+        self.frame_stack = frame_stack
+        self.screen_shape = tuple(screen_shape)
+        self.buffer = torch.zeros((num_envs, 2 * frame_stack) + self.screen_shape)
+        self.position = 0
+
+    def get(self):
+        ''' Return the stacks [envs,frame_stack*color,height,width] as a view '''
+        window = self.buffer[:, self.position:self.position + self.frame_stack]
+        return window.reshape((window.size(0), -1) + self.screen_shape[1:])
+
+    def reset(self, screens, indices = None):
+        ''' Fill the stacks of the environment `indices` (all by default) with
+            their first screen from the batch `screens` [envs,color,h,w] '''
+        if indices is None:
+            self.buffer.copy_(screens.unsqueeze(1).expand_as(self.buffer))
+        else:
+            for i in indices:
+                self.buffer[i].copy_(screens[i].unsqueeze(0).expand_as(self.buffer[i]))
+        return self.get()
+
+    def push(self, screens, dones = None):
+        ''' Add the batch `screens` [envs,color,h,w] to the stacks, restarting
+            the stacks of environments whose previous round was `done` '''
+        p = self.position
+        self.buffer[:, p].copy_(screens)
+        self.buffer[:, p + self.frame_stack].copy_(screens)
+        self.position = (p + 1) % self.frame_stack
+
+        if dones is not None and np.any(dones):
+            self.reset(screens, np.flatnonzero(dones))
+        return self.get()
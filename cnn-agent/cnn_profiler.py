@@ -0,0 +1,136 @@
+import numpy as np
+import torch
+
+from time import perf_counter
+
+
+class PhaseTimer:
+    ''' Context manager timing one phase into a rolling window of samples '''
+
+    __slots__ = ('samples', 'window', 'index', 'count', 'total', 'start', 'sync')
+
+    def __init__(self, window, sync = None):
+        self.samples = [0.0] * window
+        self.window = window
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.start = 0.0
+        self.sync = sync
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.sync is not None:
+            self.sync()
+        elapsed = perf_counter() - self.start
+        self.samples[self.index] = elapsed
+        self.index = (self.index + 1) % self.window
+        self.count += 1
+        self.total += elapsed
+
+    def get_samples(self):
+        ''' Return the samples currently held in the rolling window '''
+        return self.samples[:min(self.count, self.window)]
+
+
+class NullPhase:
+    ''' No-op stand-in for PhaseTimer when profiling is turned off '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+class PhaseProfiler:
+    ''' Time each phase of a training step with monotonic timers and keep a
+        rolling window of samples per phase for p50/p95/p99 breakdowns
+
+        Optionally records a `torch.profiler` trace over the step window
+        [trace_start, trace_stop) and exports it as a Chrome trace file.
+    '''
+
+    def __init__(self, enabled = False, window = 1024, device = None,
+                 trace_steps = None, trace_file = 'profile_trace.json'):
+        self.enabled = enabled
+        self.window = window
+        self.phases = {}
+        self.trace_steps = trace_steps
+        self.trace_file = trace_file
+        self.trace = None
+
+        # CUDA kernels run asynchronously, so wait for them to be attributed
+        # to the phase that launched them
+        self.sync = None
+        if device is not None and device.type == 'cuda':
+            self.sync = torch.cuda.synchronize
+
+    def phase(self, name):
+        ''' Return the timer context manager of the phase `name` '''
+        if not self.enabled:
+            return NULL_PHASE
+        timer = self.phases.get(name)
+        if timer is None:
+            timer = self.phases[name] = PhaseTimer(self.window, self.sync)
+        return timer
+
+    def step(self, count):
+        ''' Start or stop the torch.profiler trace when `count` enters or
+            leaves the trace step window '''
+        if self.trace_steps is None:
+            return
+        start, stop = self.trace_steps
+        if self.trace is None and start <= count < stop:
+            from torch.profiler import profile, ProfilerActivity
+            activities = [ProfilerActivity.CPU]
+            if self.sync is not None:
+                activities.append(ProfilerActivity.CUDA)
+            self.trace = profile(activities = activities, record_shapes = True)
+            self.trace.__enter__()
+        elif self.trace is not None and count >= stop:
+            self.stop_trace()
+
+    def stop_trace(self):
+        ''' Stop the torch.profiler trace and export it as a Chrome trace '''
+        self.trace.__exit__(None, None, None)
+        self.trace.export_chrome_trace(self.trace_file)
+        self.trace = None
+        self.trace_steps = None
+
+    def close(self):
+        ''' Export the trace if the run ended inside the trace step window '''
+        if self.trace is not None:
+            self.stop_trace()
+
+    def summary(self):
+        ''' Return a per-phase breakdown in milliseconds
+
+        Returns:
+            list of dictionaries with phase, count, mean, p50, p95, p99 and the
+            share of the total time spent in each phase (counting every call,
+            so phases entered several times per step weigh accordingly)
+        '''
+        timers = {name: timer for name, timer in self.phases.items() if timer.count > 0}
+        total = sum(timer.total for timer in timers.values())
+
+        rows = []
+        for name, timer in timers.items():
+            samples = timer.get_samples()
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            rows.append({
+                'phase': name,
+                'count': timer.count,
+                'mean_ms': 1e3 * np.mean(samples),
+                'p50_ms': 1e3 * p50,
+                'p95_ms': 1e3 * p95,
+                'p99_ms': 1e3 * p99,
+                'share': timer.total / total if total > 0 else 0.0
+            })
+        return rows
@@ -0,0 +1,265 @@
+import multiprocessing as mp
+import numpy as np
+import os
+import queue
+
+from warnings import warn
+
+# 3x5 bitmap font of the Q-value labels, '#' marks a lit pixel
+VALUE_FONT = {
+    '0': ['###', '#.#', '#.#', '#.#', '###'],
+    '1': ['.#.', '##.', '.#.', '.#.', '###'],
+    '2': ['###', '..#', '###', '#..', '###'],
+    '3': ['###', '..#', '.##', '..#', '###'],
+    '4': ['#.#', '#.#', '###', '..#', '..#'],
+    '5': ['###', '#..', '###', '..#', '###'],
+    '6': ['###', '#..', '###', '#.#', '###'],
+    '7': ['###', '..#', '..#', '.#.', '.#.'],
+    '8': ['###', '#.#', '###', '#.#', '###'],
+    '9': ['###', '#.#', '###', '..#', '###'],
+    '.': ['...', '...', '...', '...', '.#.'],
+    '-': ['...', '...', '###', '...', '...'],
+    'n': ['...', '...', '##.', '#.#', '#.#'],
+    'a': ['...', '.##', '#.#', '#.#', '.##'],
+    'i': ['.#.', '...', '##.', '.#.', '###'],
+    'f': ['.##', '#..', '###', '#..', '#..']
+}
+
+# 7x7 glyphs of the buttons each Q-value cell stands for
+DIRECTION_GLYPHS = {
+    'left':  ['...#...', '..##...', '.######', '#######', '.######', '..##...', '...#...'],
+    'right': ['...#...', '...##..', '######.', '#######', '######.', '...##..', '...#...'],
+    'up':    ['...#...', '..###..', '.#####.', '#######', '..###..', '..###..', '..###..'],
+    'down':  ['..###..', '..###..', '..###..', '#######', '.#####.', '..###..', '...#...'],
+    'A':     ['..###..', '.#...#.', '#.....#', '#######', '#.....#', '#.....#', '#.....#']
+}
+
+# Glyph drawn over each (row, column) of the 6x3 Q grid: movement without
+# A (jump) on the top three rows and with A on the bottom three
+GRID_GLYPHS = {
+    (0,1): 'up', (1,0): 'left', (1,2): 'right', (2,1): 'down',
+    (3,1): 'up', (4,0): 'left', (4,1): 'A', (4,2): 'right', (5,1): 'down'
+}
+
+# Anchor colors of viridis, the colormap matplotlib draws the Q grid with
+VIRIDIS_ANCHORS = [(68,1,84), (59,82,139), (33,145,140), (94,201,98), (253,231,37)]
+
+
+def format_q_tensor(q_values):
+    ''' Convert Q-estimates (a tensor or array of the 18 actions, optionally
+        with a leading batch dimension of one) into a 6x3 NumPy array,
+        arranged for plotting, that has movement without A (jump) on top and
+        movement with A on bottom '''
+    if hasattr(q_values, 'detach'):
+        q_values = q_values.detach().cpu().float().numpy()
+    q_array = np.asarray(q_values, dtype=np.float32).reshape(-1)
+
+    out_no_A = q_array[::2].reshape(3,3)
+    out_with_a = q_array[1::2].reshape(3,3)
+
+    out_stacked = np.concatenate([out_no_A, out_with_a], axis=0)
+    return out_stacked
+
+
+def format_screen(screen):
+    ''' Convert a screen into a uint8 NumPy image [height,width,color]
+
+    Args:
+        screen: a [0,1] screen-tensor or float array [color,height,width], or
+            a uint8 array in either [color,height,width] or
+            [height,width,color] order, with one or three colors
+    '''
+    if hasattr(screen, 'detach'):
+        screen = screen.detach().cpu().numpy()
+    screen = np.asarray(screen)
+    if screen.dtype != np.uint8:
+        screen = np.clip(np.rint(screen * 255), 0, 255).astype(np.uint8)
+    if screen.ndim == 2:
+        screen = screen[:, :, None]
+    if screen.shape[0] in (1, 3) and screen.shape[-1] not in (1, 3):
+        screen = screen.transpose(1, 2, 0)
+    if screen.shape[-1] == 1:
+        screen = screen.repeat(3, axis=2)
+    return np.ascontiguousarray(screen)
+
+
+def to_clip_frame(screen, Q_estimate):
+    ''' Return the picklable (uint8 image, 6x3 Q array) pair of one step,
+        as ClipEncoder takes them '''
+    return format_screen(screen), format_q_tensor(Q_estimate)
+
+
+def glyph_mask(pattern, scale = 1):
+    ''' Return the boolean mask of a bitmap `pattern` enlarged `scale` times '''
+    mask = np.array([[c == '#' for c in row] for row in pattern])
+    return np.kron(mask, np.ones((scale, scale), dtype=bool))
+
+
+def colormap_lut(anchors = VIRIDIS_ANCHORS, size = 256):
+    ''' Return a [size,3] uint8 lookup table interpolating the anchor colors '''
+    anchors = np.array(anchors, dtype=np.float32)
+    positions = np.linspace(0, 1, len(anchors))
+    levels = np.linspace(0, 1, size)
+    lut = [np.interp(levels, positions, anchors[:,c]) for c in range(3)]
+    return np.rint(np.stack(lut, axis=1)).astype(np.uint8)
+
+
+class DiagnosticRenderer:
+    ''' Draw the diagnostic frame of MPLPlotter straight into a uint8 canvas
+
+        The screen sits on the left and the 6x3 Q-value heatmap on the right,
+        with the faint button glyph and the value of each action drawn over
+        its cell. All glyphs are rendered into masks once, so drawing a frame
+        is a handful of array copies and masked writes instead of a
+        matplotlib figure. The canvas is padded to multiples of 16 pixels,
+        which video encoders need, and is reused between calls.
+    '''
+
+    def __init__(self, screen_shape, cell_size = None, gap = 8):
+        self.screen_shape = tuple(screen_shape[:2])
+        height, width = self.screen_shape
+        self.cell_size = cell_size or max(height // 6, 16)
+        self.grid_top = 0
+        self.grid_left = width + gap
+
+        canvas_height = max(height, 6 * self.cell_size)
+        canvas_width = self.grid_left + 3 * self.cell_size
+        self.canvas = np.zeros((-(-canvas_height // 16) * 16,
+                                -(-canvas_width // 16) * 16, 3), dtype=np.uint8)
+
+        self.lut = colormap_lut()
+        self.value_masks = {c: glyph_mask(p, max(self.cell_size // 24, 1))
+                            for c, p in VALUE_FONT.items()}
+        self.direction_masks = {c: glyph_mask(p, max(self.cell_size // 10, 1))
+                                for c, p in DIRECTION_GLYPHS.items()}
+
+    def draw_mask(self, mask, center_y, center_x, color, alpha = 1.0):
+        ''' Draw `mask` centered on the canvas pixel (center_y, center_x) '''
+        top = center_y - mask.shape[0] // 2
+        left = center_x - mask.shape[1] // 2
+        if top < 0 or left < 0:
+            return
+        region = self.canvas[top:top + mask.shape[0], left:left + mask.shape[1]]
+        mask = mask[:region.shape[0], :region.shape[1]] # Crop at the edges
+        if alpha == 1.0:
+            region[mask] = color
+        else:
+            region[mask] = (region[mask] * (1 - alpha) +
+                            np.array(color) * alpha).astype(np.uint8)
+
+    def draw_text(self, text, center_y, center_x, color):
+        ''' Draw `text` in the value font centered on (center_y, center_x) '''
+        masks = [self.value_masks[c] for c in text if c in self.value_masks]
+        if len(masks) == 0:
+            return
+        spacing = masks[0].shape[1] // 3
+        widths = [m.shape[1] + spacing for m in masks]
+        left = center_x - (sum(widths) - spacing) // 2
+        for mask, width in zip(masks, widths):
+            self.draw_mask(mask, center_y, left + mask.shape[1] // 2, color)
+            left += width
+
+    def render(self, screen, q_array):
+        ''' Draw one diagnostic frame
+
+        Args:
+            screen: the screen in any form `format_screen` takes
+            q_array (array): 6x3 Q-values as returned by `format_q_tensor`
+
+        Returns:
+            the uint8 canvas [height,width,color], overwritten by the next call
+        '''
+        screen = format_screen(screen)
+        height, width = self.screen_shape
+        self.canvas[:] = 0
+        self.canvas[:height, :width] = screen[:height, :width]
+
+        q_array = np.asarray(q_array, dtype=np.float32).reshape(6,3)
+        low, high = np.nanmin(q_array), np.nanmax(q_array)
+        levels = np.zeros(q_array.shape, dtype=np.uint8)
+        if high > low:
+            scaled = np.nan_to_num((q_array - low) / (high - low))
+            levels = np.rint(scaled * 255).astype(np.uint8)
+
+        size = self.cell_size
+        heatmap = self.lut[levels].repeat(size, axis=0).repeat(size, axis=1)
+        self.canvas[self.grid_top:self.grid_top + 6 * size,
+                    self.grid_left:self.grid_left + 3 * size] = heatmap
+
+        for r in range(6):
+            for c in range(3):
+                center_y = self.grid_top + r * size + size // 2
+                center_x = self.grid_left + c * size + size // 2
+                glyph = GRID_GLYPHS.get((r,c))
+                if glyph is not None:
+                    self.draw_mask(self.direction_masks[glyph], center_y, center_x,
+                                   (128,128,128), alpha = 0.3)
+                self.draw_text("{:5.2f}".format(q_array[r,c]).strip(),
+                               center_y, center_x, (255,255,255))
+
+        return self.canvas
+
+
+def run_clip_encoder(jobs, output_folder, clip_format, fps):
+    ''' Worker loop rendering and encoding the clips put on `jobs` until it
+        receives None '''
+    import imageio # Only the worker pays for the encoder
+
+    os.makedirs(output_folder, exist_ok = True)
+    renderer = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        name, frames = job
+        if renderer is None or renderer.screen_shape != frames[0][0].shape[:2]:
+            renderer = DiagnosticRenderer(frames[0][0].shape[:2])
+
+        path = os.path.join(output_folder, name + '.' + clip_format)
+        options = {'duration': 1 / fps} if clip_format == 'gif' else {'fps': fps}
+        try:
+            with imageio.get_writer(path, mode='I', **options) as writer:
+                for screen, q_array in frames:
+                    writer.append_data(renderer.render(screen, q_array))
+        except Exception as e: # Keep the worker alive, drop the clip
+            warn("Clip encoding failed: " + repr(e))
+
+
+class ClipEncoder:
+    ''' Render and encode diagnostic clips as GIF or MP4 in a worker process
+
+        `submit` only puts the frames on a bounded queue and returns; when
+        the worker falls behind, new clips are dropped rather than making
+        the caller wait.
+    '''
+
+    def __init__(self, output_folder, clip_format = 'gif', fps = 10, max_pending = 4):
+        if clip_format not in ['gif', 'mp4']:
+            raise ValueError("No clip encoder available for the given clip_format")
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue(max_pending)
+        self.dropped_count = 0
+        self.process = context.Process(target=run_clip_encoder, daemon=True,
+            args=(self.jobs, os.path.expanduser(output_folder), clip_format, fps))
+        self.process.start()
+
+    def submit(self, name, frames):
+        ''' Queue a clip for encoding
+
+        Args:
+            name (str): file name of the clip, without extension
+            frames (list): (uint8 image, 6x3 Q array) pairs as returned by
+                `to_clip_frame`
+        '''
+        if len(frames) == 0:
+            return
+        try:
+            self.jobs.put_nowait((name, frames))
+        except queue.Full:
+            self.dropped_count += 1
+
+    def close(self):
+        ''' Encode the queued clips, then stop the worker '''
+        self.jobs.put(None)
+        self.process.join()
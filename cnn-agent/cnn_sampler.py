@@ -0,0 +1,155 @@
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cnn_memory import merge_screen_batch, as_value_list
+
+
+class PrefetchedBatch:
+    ''' Replay batch gathered ahead of time into reusable buffers
+
+        Every buffer keeps its first `num_envs` rows free for the live
+        transitions, so the getters only write the live rows in front of the
+        already converted sample instead of concatenating. The getters mirror
+        those of the replay memories and return views of the buffers, which
+        are overwritten the next time this batch is filled.
+    '''
+
+    def __init__(self, num_envs, pin_memory = False):
+        self.num_envs = num_envs
+        self.pin_memory = pin_memory
+        self.indices = None
+        self.buffers = {}
+
+    def get_buffer(self, name, shape, dtype):
+        ''' Return the first shape[0] rows of the reusable buffer `name`,
+            (re)allocating it only if it is missing or too small '''
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape[1:] != shape[1:] or buffer.size(0) < shape[0]:
+            buffer = torch.empty(shape, dtype=dtype)
+            if self.pin_memory: # Page-locked for faster copies onto the GPU
+                buffer = buffer.pin_memory()
+            self.buffers[name] = buffer
+        return buffer[:shape[0]]
+
+    def fill(self, memory, indices, gather_end_states = True):
+        ''' Gather the transitions at the slot `indices` of `memory` (or none
+            if `indices` is None) and convert their screens into floats '''
+        self.indices = indices
+        if indices is None:
+            return
+
+        rows = self.num_envs + len(indices)
+        sampled = slice(self.num_envs, rows)
+
+        frames = memory.gather_start_frames(indices)
+        self.start_states = self.get_buffer('start_states',
+            (rows,) + frames.shape[1:], torch.float)
+        self.start_states[sampled].copy_(frames).div_(255)
+
+        self.end_states = None
+        if gather_end_states:
+            frames = memory.gather_end_frames(indices)
+            self.end_states = self.get_buffer('end_states',
+                (rows,) + frames.shape[1:], torch.float)
+            self.end_states[sampled].copy_(frames).div_(255)
+
+        self.actions = self.get_buffer('actions', (rows,), torch.long)
+        self.rewards = self.get_buffer('rewards', (rows,), torch.float)
+        self.dones = self.get_buffer('dones', (rows,), torch.uint8)
+        torch.index_select(memory.actions, 0, indices, out=self.actions[sampled])
+        torch.index_select(memory.rewards, 0, indices, out=self.rewards[sampled])
+        torch.index_select(memory.dones, 0, indices, out=self.dones[sampled])
+
+    def get_batch_start_including(self, last_start = None):
+        ''' Return the batch of start states with the live `last_start`
+            batch [envs,color,width,height] first '''
+        if self.indices is None:
+            return merge_screen_batch(last_start, None)
+        self.start_states[:self.num_envs] = last_start
+        return self.start_states
+
+    def get_batch_post_action_including(self, last_action = None,
+                                    last_reward = None, last_end_state = None,
+                                    gather_end_states = True):
+        ''' Return the batches of actions, rewards and end states with the
+            live transitions first, as `RingReplayMemory` does '''
+        if self.indices is None:
+            return (torch.LongTensor([int(a) for a in as_value_list(last_action)]),
+                    torch.FloatTensor([float(r) for r in as_value_list(last_reward)]),
+                    merge_screen_batch(last_end_state, None))
+
+        self.actions[:self.num_envs] = torch.LongTensor(
+            [int(a) for a in as_value_list(last_action)])
+        self.rewards[:self.num_envs] = torch.FloatTensor(
+            [float(r) for r in as_value_list(last_reward)])
+
+        end_states = merge_screen_batch(last_end_state, None)
+        if gather_end_states:
+            self.end_states[:self.num_envs] = last_end_state
+            end_states = self.end_states
+        return self.actions, self.rewards, end_states
+
+    def get_batch_dones_including(self, last_done = None):
+        ''' Return the done flags with the live `last_done` flags first '''
+        dones = torch.ByteTensor([int(bool(d)) for d in as_value_list(last_done)])
+        if self.indices is None:
+            return dones
+        self.dones[:self.num_envs] = dones
+        return self.dones
+
+
+class PrefetchingSampler:
+    ''' Sample and gather the next replay batch on a background thread while
+        the emulators step, so batch assembly leaves the per-step latency
+
+        Two `PrefetchedBatch` buffers alternate: the training step reads one
+        while the other is being filled. `prefetch` starts filling the next
+        batch, `wait` must be called before the memory is written again
+        (added to or re-prioritized), and `next_batch` swaps the ready batch
+        in and makes it the memory's last batch, so priorities, weights and
+        cached target values follow the prefetched slots.
+    '''
+
+    def __init__(self, memory, num_envs, pin_memory = False, gather_end_states = True):
+        self.memory = memory
+        self.gather_end_states = gather_end_states
+        self.batches = [PrefetchedBatch(num_envs, pin_memory) for _ in range(2)]
+        self.next_index = 0
+        self.pending = None
+        self.ready = None
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+
+    def fill_next(self):
+        ''' Fill the next of the alternating batches with a fresh sample '''
+        batch = self.batches[self.next_index]
+        self.next_index = 1 - self.next_index
+        batch.fill(self.memory, self.memory.sample_indices(), self.gather_end_states)
+        return batch
+
+    def prefetch(self):
+        ''' Start gathering the next batch in the background '''
+        self.wait()
+        if self.ready is None:
+            self.pending = self.executor.submit(self.fill_next)
+
+    def wait(self):
+        ''' Wait until the batch being gathered is ready, after which the
+            memory may be written to again '''
+        if self.pending is not None:
+            self.ready = self.pending.result()
+            self.pending = None
+
+    def next_batch(self):
+        ''' Return the prefetched batch (gathering one now if none is ready)
+            and make its slots the memory's last batch '''
+        self.wait()
+        batch = self.ready if self.ready is not None else self.fill_next()
+        self.ready = None
+        if batch.indices is not None:
+            self.memory.set_batch(batch.indices)
+        return batch
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,103 @@
+import copy
+import torch
+
+from cnn_memory import merge_screen_batch
+
+
+class TargetNetwork:
+    ''' Persistent forecast copy of the online network refreshed in place
+
+        The copy is built once; `sync` then copies the online parameters into
+        the existing tensors without serializing or reallocating anything, and
+        `soft_update` applies a Polyak average target += tau * (online - target)
+        as one fused in-place operation over all parameters.
+    '''
+
+    def __init__(self, model, tau = 0):
+        self.tau = tau
+        self.model = copy.deepcopy(model)
+        self.model.eval()
+        self.model.turn_off_gradients()
+        self.tensors = list(self.model.state_dict().values())
+
+    def forward(self, x):
+        return self.model.forward(x)
+
+    def sync(self, model):
+        ''' Copy every online parameter of `model` into the target in place '''
+        with torch.no_grad():
+            for target, online in zip(self.tensors, model.state_dict().values()):
+                target.copy_(online)
+
+    def soft_update(self, model):
+        ''' Move the target towards `model` by `tau` in place (Polyak update) '''
+        online = list(model.state_dict().values())
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(self.tensors, online, self.tau)
+            else:
+                for target, o in zip(self.tensors, online):
+                    target.lerp_(o, self.tau)
+
+
+class TargetValueCache:
+    ''' Cache of forecast-model Q-values for the end screen of each replay
+        slot, valid until the forecast model is refreshed
+
+        Every cached row carries the version it was computed under, so a
+        forecast refresh invalidates the whole cache by bumping the version.
+        Only cache misses among the sampled slots are gathered, converted and
+        sent through the forecast model, in one batched call.
+    '''
+
+    def __init__(self, memory_size, action_count, device = torch.device('cpu')):
+        self.device = device
+        self.values = torch.zeros(int(memory_size), action_count, device=device)
+        self.versions = torch.full((int(memory_size),), -1, dtype=torch.long)
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate_all(self):
+        ''' Invalidate every cached value, e.g. after a forecast model refresh '''
+        self.version += 1
+
+    def invalidate_slot(self, slot):
+        ''' Invalidate the cached value of a replay slot that was overwritten '''
+        self.versions[slot] = -1
+
+    def forecast_batch_including(self, forecast_model, memory, last_end_state = None):
+        ''' Return forecast Q-values for the live end states followed by the
+            end states of the replay memory's last sampled batch
+
+        Args:
+            forecast_model (nn.Module): frozen model estimating future Q-values
+            memory (RingReplayMemory): replay memory holding the last batch
+            last_end_state (tensor, optional): live end state(s), either a
+                single-screen-tensor or a batch [envs,color,width,height]
+
+        Returns:
+            tensor of Q-values [batch,actions] with the live states first
+        '''
+        Q_futures = []
+        if last_end_state is not None:
+            live = merge_screen_batch(last_end_state, None)
+            Q_futures.append(forecast_model.forward(live.to(self.device)))
+
+        slots = memory.last_batch
+        if slots is not None:
+            is_hit = self.versions.index_select(0, slots) == self.version
+            miss_slots = slots[(is_hit == 0).nonzero().view(-1)]
+            self.misses += len(miss_slots)
+            self.hits += len(slots) - len(miss_slots)
+
+            if len(miss_slots) > 0:
+                screens = merge_screen_batch(None, memory.gather_end_frames(miss_slots))
+                with torch.no_grad():
+                    values = forecast_model.forward(screens.to(self.device))
+                self.values.index_copy_(0, miss_slots.to(self.device), values.detach())
+                self.versions[miss_slots] = self.version
+
+            Q_futures.append(self.values.index_select(0, slots.to(self.device)))
+
+        return torch.cat(Q_futures)
@@ -0,0 +1,135 @@
+import multiprocessing as mp
+import numpy as np
+import torch
+import retro_utils as util
+
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from cnn_model import BasicConvolutionNetwork
+from retro_vec_env import DummyVecEnv
+from cnn_inference import InferenceEngine, collect_screens, get_frame_stacker
+
+
+def validate_level(model_state, game, state, environment, episode_steps,
+                   frame_skip = 1, env_options = None, engine_options = None):
+    ''' Play one episode of at most `episode_steps` steps on a single level
+
+    Args:
+        model_state (dict): network state as returned by `get_state()`
+        game (str): retro game of the level, e.g. 'SonicTheHedgehog-Genesis'
+        state (str): retro state of the level, e.g. 'GreenHillZone.Act2'
+        engine_options (dict, optional): play through an InferenceEngine
+            with these options ('quantize', 'calibration_steps')
+
+    Returns:
+        dictionary with the level, total reward, steps played, furthest
+        horizontal position and progress through the level in [0,1]
+    '''
+    torch.set_num_threads(1) # Levels run concurrently, one core each
+    model = BasicConvolutionNetwork()
+    model.load_state(model_state)
+    model.eval()
+    model.turn_off_gradients()
+
+    start = time()
+    game_env = util.get_environment(environment, frame_skip, env_options,
+                                    game = game, state = state)
+    try:
+        forward = model.forward
+        if engine_options is not None:
+            calibration_screens = None
+            if engine_options['quantize'] == 'static':
+                calibration_screens = collect_screens(model, DummyVecEnv(game_env),
+                                                      engine_options['calibration_steps'])
+            forward = InferenceEngine(model, quantize = engine_options['quantize'],
+                calibration_screens = calibration_screens).forward
+
+        stacker = get_frame_stacker(model, 1)
+        screen = model.convert_screen_to_input(game_env.reset()).unsqueeze(0)
+        if stacker is not None:
+            screen = stacker.reset(screen)
+
+        total_reward, max_x, end_x, step = 0.0, 0, None, 0
+        for step in range(1, episode_steps + 1):
+            with torch.no_grad():
+                Q_estimate = forward(screen)[0]
+            action = model.get_action(Q_estimate)
+
+            obs, reward, done, info = game_env.step(model.convert_action_to_buttons(action))
+            total_reward += reward
+            max_x = max(max_x, info.get('x', 0))
+            end_x = info.get('screen_x_end', end_x)
+            if done:
+                break
+            screen = model.convert_screen_to_input(obs).unsqueeze(0)
+            if stacker is not None:
+                screen = stacker.push(screen)
+    finally:
+        game_env.close()
+
+    return {
+        'game': game,
+        'state': state,
+        'reward': float(total_reward),
+        'steps': step,
+        'max_x': int(max_x),
+        'progress': float(min(max_x / end_x, 1.0)) if end_x else float('nan'),
+        'seconds': time() - start
+    }
+
+
+def summarize_levels(results):
+    ''' Merge per-level results into mean reward and progress over levels '''
+    return {
+        'levels': len(results),
+        'mean_reward': float(np.mean([r['reward'] for r in results])),
+        'mean_progress': float(np.nanmean([r['progress'] for r in results])),
+        'total_steps': int(sum(r['steps'] for r in results))
+    }
+
+
+def run_validation(args, model, s3 = None):
+    ''' Validate `model` on every level in `args.levels` concurrently
+
+    Each level plays one episode in its own worker process (the emulator
+    only allows one instance per process). The per-level results and their
+    summary are printed and, if `s3` is given, stored as CSV under the log
+    folder.
+
+    Returns:
+        tuple of the list of per-level results and their summary dictionary
+    '''
+    if args.environment == 'remote':
+        raise ValueError("Remote environment cannot run the validation levels")
+
+    engine_options = None
+    if args.inference_engine:
+        engine_options = {'quantize': args.quantize,
+                          'calibration_steps': args.calibration_steps}
+
+    model_state = model.get_state(snapshot = True)
+    workers = args.validation_workers or len(args.levels)
+    start = time()
+
+    with ProcessPoolExecutor(max_workers = min(workers, len(args.levels)),
+                             mp_context = mp.get_context('spawn')) as pool:
+        futures = [
+            pool.submit(validate_level, model_state, game, state, args.environment,
+                        args.episode_steps, args.frame_skip,
+                        util.get_environment_options(args), engine_options)
+            for game, state in args.levels
+        ]
+        results = [f.result() for f in futures]
+
+    summary = dict(summarize_levels(results), seconds = time() - start)
+    for r in results:
+        print("{game:<28} {state:<24} reward {reward:>9.1f}  progress {progress:>6.1%}"
+              "  steps {steps:>5}".format(**r))
+    print("Validation summary:", summary)
+
+    if s3 is not None:
+        s3.save_memory(results, args.log_folder + '/validation_levels.csv')
+        s3.save_memory([summary], args.log_folder + '/validation_summary.csv')
+
+    return results, summary
@@ -1,15 +1,22 @@
 import imageio
-import imageio
 import io
 
-import numpy as np
 from matplotlib import pyplot as plt
 
+from cnn_render import format_q_tensor
+
 
 class MPLPlotter:
+    ''' Draws diagnostic figures of selective memory entries with matplotlib
+
+        Slow (a full figure per frame) and meant for one-off plots; clips
+        are rendered by `cnn_render.DiagnosticRenderer` instead.
+    '''
 
-    def __init_(self):
-        raise ValueError("I AM NOT IMPLEMENTED AND PROBABLY DO NOT WORK!")
+    def __init__(self, log_folder = '', memory = None, counter = 0):
+        self.log_folder = log_folder
+        self.memory = memory if memory is not None else []
+        self.counter = counter
 
     def output_tracking_image(self, counter_index = None, filename = None):
         ''' Output the tracking image for the given index to a file or screen '''
@@ -67,13 +74,7 @@ class MPLPlotter:
         ''' Convert Q-estimate tensor into a NumpyArray, arranged for plotting,
             that has movement without A (jump) on top and movement with A on
             bottom '''
-        q_array = q_tensor.detach().numpy()[0,:]
-
-        out_no_A = q_array[::2].reshape(3,3)
-        out_with_a = q_array[1::2].reshape(3,3)
-
-        out_stacked = np.concatenate([out_no_A, out_with_a], axis=0)
-        return out_stacked
+        return format_q_tensor(q_tensor)
 
     def draw_diagnostic_figure(self, screen_array, q_array):
         ''' Draw the actual diagnostic figure using the raw inputs '''
@@ -0,0 +1,72 @@
+import importlib
+import threading
+
+
+class BackendRegistry:
+    ''' Registry of named backends given as "module:attribute" paths
+
+        Backend modules (and their dependencies such as boto3 or redis) are
+        only imported when a backend is first created, so runs that never
+        touch S3 or Redis never pay for importing them.
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.paths = {}
+
+    def register(self, name, path):
+        ''' Register the backend `name` as the "module:attribute" `path` '''
+        self.paths[name] = path
+
+    def load(self, name):
+        ''' Import and return the class or function of the backend `name` '''
+        if name not in self.paths:
+            raise ValueError("No " + self.kind + " backend available for the given name")
+        module_name, attribute = self.paths[name].split(':')
+        return getattr(importlib.import_module(module_name), attribute)
+
+    def create(self, name, *args, **kwargs):
+        ''' Import the backend `name` and create it with the given arguments '''
+        return self.load(name)(*args, **kwargs)
+
+    def lazy(self, name, *args, **kwargs):
+        ''' Return a LazyBackend creating the backend `name` on first use '''
+        return LazyBackend(lambda: self.create(name, *args, **kwargs))
+
+
+class LazyBackend:
+    ''' Stand-in for a backend that is only imported and created the first
+        time one of its attributes is used, from any thread '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def get_backend(self):
+        ''' Return the backend, creating it on the first call '''
+        with self._lock:
+            if self._backend is None:
+                self._backend = self._factory()
+            return self._backend
+
+    def __getattr__(self, name):
+        return getattr(self.get_backend(), name)
+
+
+# Storage clients for models, checkpoints and metric files
+STORAGE = BackendRegistry('storage')
+STORAGE.register('s3', 'retro_s3:RetroS3Client')
+STORAGE.register('local', 'retro_s3:RetroLocalClient')
+
+# Clients of the metric stores that are not storage clients
+METRICS = BackendRegistry('metrics')
+METRICS.register('redis', 'redis:StrictRedis')
+
+
+def get_storage_client(storage_system, root_dir = 'model_outputs/'):
+    ''' Return the S3 or local-directory storage client as requested, which
+        is only imported and created once it is first used '''
+    if storage_system not in STORAGE.paths:
+        raise ValueError("No storage client available for the given storage_system")
+    return STORAGE.lazy(storage_system, root_dir = root_dir)
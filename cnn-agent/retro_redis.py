@@ -0,0 +1,197 @@
+import zlib
+import numpy as np
+
+from collections import OrderedDict
+from time import time
+
+# Column name and storage dtype of every common metric
+COMMON_COLUMNS = OrderedDict([
+    ('counter', np.int64),
+    ('action', np.int16),
+    ('reward', np.float32),
+    ('loss', np.float32)
+])
+
+
+def stream_id(counter):
+    ''' Return the Redis Stream entry id used for a step counter '''
+    return '{}-1'.format(int(counter))
+
+
+class RedisMetricsStore:
+    ''' Columnar metric storage in Redis Streams
+
+        Every flush of common metrics becomes a single XADD entry holding one
+        packed binary column per metric, keyed by the first step counter of
+        the batch, so the command count no longer grows with the batch size.
+        Each selective diagnostic becomes one entry keyed by its counter,
+        with Q-values as float32 bytes and the screen and its context
+        screens as zlib-compressed uint8 blobs. Ranges of steps can be read
+        back by counter.
+
+        Stream entry ids must increase, so every run writes to streams of its
+        own `run_id` (by default the start time in milliseconds) and a
+        restarted run with the same name never collides with earlier ones.
+        The metrics are packed binary, so the client must return bytes
+        (created without `decode_responses`).
+    '''
+
+    def __init__(self, redis_client, name, run_id = None):
+        connection_kwargs = getattr(getattr(redis_client, 'connection_pool', None),
+                                    'connection_kwargs', {})
+        if connection_kwargs.get('decode_responses'):
+            raise ValueError("RedisMetricsStore needs a client without decode_responses")
+        self.redis = redis_client
+        self.name = name
+        self.run_id = str(run_id if run_id is not None else int(time() * 1000))
+        self.metrics_key = '{}:{}:metrics'.format(name, self.run_id)
+        self.selective_key = '{}:{}:selective'.format(name, self.run_id)
+
+    def register(self):
+        ''' Add this model to the list of models with stored metrics, and
+            this run to the list of its runs '''
+        pipe = self.redis.pipeline()
+        pipe.rpush('model_names', self.name)
+        pipe.rpush(self.name + ':runs', self.run_id)
+        pipe.execute()
+
+    def get_runs(self):
+        ''' Return the run ids stored under this name, oldest first '''
+        return [r.decode() if isinstance(r, bytes) else r
+                for r in self.redis.lrange(self.name + ':runs', 0, -1)]
+
+    def write_common(self, memory):
+        ''' Write a batch of common metric dictionaries as one stream entry
+
+        Args:
+            memory (list): dictionaries with counter, action, reward and loss
+        '''
+        if len(memory) == 0:
+            return
+        fields = {
+            column: np.array([np.nan if m[column] is None else m[column]
+                              for m in memory], dtype=dtype).tobytes()
+            for column, dtype in COMMON_COLUMNS.items()
+        }
+        pipe = self.redis.pipeline()
+        pipe.xadd(self.metrics_key, fields, id=stream_id(memory[0]['counter']))
+        pipe.incrby('{}:{}:count'.format(self.name, self.run_id), len(memory))
+        pipe.execute()
+
+    def write_selective(self, memory):
+        ''' Write selective diagnostics, one stream entry per notable step
+
+        Args:
+            memory (list): dictionaries with counter, reason, Q_estimate,
+                Q_future, screen (a uint8 screen-tensor or None) and context
+                (list of uint8 screen-tensor and Q_estimate pairs)
+        '''
+        pipe = self.redis.pipeline()
+        for m in memory:
+            fields = {
+                'reason': m.get('reason', ''),
+                'q_estimate': tensor_to_bytes(m['Q_estimate'], np.float32),
+                'q_future': tensor_to_bytes(m['Q_future'], np.float32),
+                'screen': b'',
+                'screen_shape': '',
+                'context': b'',
+                'context_shape': '',
+                'context_q': b''
+            }
+            if m['screen'] is not None:
+                screen = m['screen'].cpu().numpy()
+                fields['screen'] = zlib.compress(screen.tobytes(), 1)
+                fields['screen_shape'] = ','.join(str(d) for d in screen.shape)
+            context = m.get('context', [])
+            if len(context) > 0:
+                screens = np.stack([s.cpu().numpy() for s, _ in context])
+                fields['context'] = zlib.compress(screens.tobytes(), 1)
+                fields['context_shape'] = ','.join(str(d) for d in screens.shape)
+                fields['context_q'] = b''.join(tensor_to_bytes(q, np.float32)
+                                               for _, q in context)
+            pipe.xadd(self.selective_key, fields, id=stream_id(m['counter']))
+        pipe.execute()
+
+    def read_metrics(self, start, stop):
+        ''' Return the common metrics of steps with start <= counter < stop
+
+        Returns:
+            dictionary of numpy arrays, one per metric column
+        '''
+        # The entry holding `start` is keyed by the counter it begins with
+        entries = self.redis.xrevrange(self.metrics_key, max=stream_id(start),
+                                       min='-', count=1)
+        if stop - 1 > start:
+            entries += self.redis.xrange(self.metrics_key,
+                min=stream_id(start + 1), max=stream_id(stop - 1))
+
+        columns = {c: [] for c in COMMON_COLUMNS}
+        for _, fields in entries:
+            for column, dtype in COMMON_COLUMNS.items():
+                columns[column].append(np.frombuffer(
+                    get_field(fields, column), dtype=dtype))
+
+        columns = {c: np.concatenate(v) if len(v) > 0 else
+                   np.array([], dtype=COMMON_COLUMNS[c]) for c, v in columns.items()}
+        in_range = (columns['counter'] >= start) & (columns['counter'] < stop)
+        return {c: v[in_range] for c, v in columns.items()}
+
+    def read_selective(self, start, stop):
+        ''' Return the selective diagnostics of steps with start <= counter < stop
+
+        Returns:
+            list of dictionaries with counter, reason, Q_estimate, Q_future
+            (float32 arrays), screen (uint8 array or None), context (uint8
+            array [screens,color,height,width] or None) and context_Q
+            (float32 array [screens,actions] or None)
+        '''
+        if stop <= start:
+            return []
+        entries = self.redis.xrange(self.selective_key,
+            min=stream_id(start), max=stream_id(stop - 1))
+
+        diagnostics = []
+        for entry_id, fields in entries:
+            if isinstance(entry_id, bytes):
+                entry_id = entry_id.decode()
+            screen = read_screens(fields, 'screen')
+            context = read_screens(fields, 'context')
+            context_Q = None
+            if context is not None:
+                context_Q = np.frombuffer(get_field(fields, 'context_q'),
+                                          dtype=np.float32).reshape(len(context), -1)
+            diagnostics.append({
+                'counter': int(entry_id.split('-')[0]),
+                'reason': get_field(fields, 'reason', b'').decode(),
+                'Q_estimate': np.frombuffer(get_field(fields, 'q_estimate'), dtype=np.float32),
+                'Q_future': np.frombuffer(get_field(fields, 'q_future'), dtype=np.float32),
+                'screen': screen,
+                'context': context,
+                'context_Q': context_Q
+            })
+        return diagnostics
+
+
+def read_screens(fields, name):
+    ''' Return the uint8 screens stored in the field `name` (None if empty) '''
+    shape = get_field(fields, name + '_shape', b'') # Older entries lack context
+    if len(shape) == 0:
+        return None
+    shape = tuple(int(d) for d in shape.decode().split(','))
+    return np.frombuffer(zlib.decompress(get_field(fields, name)),
+                         dtype=np.uint8).reshape(shape)
+
+
+def tensor_to_bytes(tensor, dtype):
+    ''' Return the packed bytes of a tensor (empty bytes for None) '''
+    if tensor is None:
+        return b''
+    return tensor.detach().cpu().numpy().astype(dtype).tobytes()
+
+
+def get_field(fields, name, default = None):
+    ''' Return a stream entry field whether the client decodes keys or not,
+        or `default` if the entry has no such field '''
+    if name.encode() in fields:
+        return fields[name.encode()]
+    return fields[name] if default is None else fields.get(name, default)
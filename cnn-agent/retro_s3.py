@@ -1,23 +1,54 @@
-import boto3
 import io
+import os
+import re
 import torch
 import csv
+import glob
+import shutil
+import hashlib
+import tempfile
+import threading
+import zlib
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from time import time
+from warnings import warn
+
+CHUNKED_FORMAT = 'chunked-v1'
 
 class RetroS3Client:
 
     def __init__(self, bucket = 'retro-competition-8bitbandit',
-                        root_dir = 'model_outputs/'):
+                        root_dir = 'model_outputs/',
+                        multipart_threshold = 8 * 1024 * 1024):
+        # boto3 is imported here so local-only runs never load it
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
         self.s3_client = boto3.client('s3')
         self.bucket = bucket
         self.root_dir = root_dir
         if self.root_dir[-1] != '/': # Add trailling / if not present
             self.root_dir += '/'
+        self.stored_chunks = set()
+
+        # Large checkpoints are split into concurrently uploaded parts
+        self.transfer_config = TransferConfig(
+            multipart_threshold = multipart_threshold,
+            multipart_chunksize = multipart_threshold)
 
     def save_buffer(self, buffer, file_name):
         ''' Save a buffer onto S3 with the given file name '''
         buffer.seek(0)
+        self.s3_client.upload_fileobj(buffer, self.bucket,
+            self.root_dir + file_name, Config = self.transfer_config)
+
+    def save_bytes(self, body, file_name):
+        ''' Save raw bytes onto S3 with the given file name '''
         self.s3_client.put_object(
-            Body = buffer,
+            Body = body,
             Bucket = self.bucket,
             Key = self.root_dir + file_name)
 
@@ -26,10 +57,7 @@ class RetroS3Client:
         with io.StringIO() as str_buffer:
             dw = csv.DictWriter(str_buffer, list_of_dicts[0].keys())
             dw.writerows(list_of_dicts)
-            self.s3_client.put_object(
-                Body = str_buffer.getvalue().encode('utf-8'),
-                Bucket = self.bucket,
-                Key = self.root_dir + file_name)
+            self.save_bytes(str_buffer.getvalue().encode('utf-8'), file_name)
 
     def save_model(self, model, config, file_name):
         ''' Store a (model, config) pair directly onto S3 '''
@@ -41,13 +69,36 @@ class RetroS3Client:
             self.save_buffer(buffer, file_name)
 
 
-    def load_to_buffer(self, model_name):
-        ''' Load model off S3 into a buffer '''
+    def load_bytes(self, file_name):
+        ''' Load the raw bytes of a file off S3 '''
         response = self.s3_client.get_object(
             Bucket = self.bucket,
-            Key = self.root_dir + model_name)
+            Key = self.root_dir + file_name)
+        return response['Body'].read()
+
+    def get_etag(self, file_name):
+        ''' Return the ETag of the stored file with a single HEAD request '''
+        response = self.s3_client.head_object(Bucket = self.bucket,
+                                              Key = self.root_dir + file_name)
+        return response['ETag']
 
-        buffer = io.BytesIO(initial_bytes = response['Body'].read())
+    def download_file(self, file_name, path):
+        ''' Stream the file off S3 straight into the local `path` '''
+        self.s3_client.download_file(self.bucket, self.root_dir + file_name,
+                                     path, Config = self.transfer_config)
+
+    def exists(self, file_name):
+        ''' Return whether the file is already stored on S3 '''
+        try:
+            self.s3_client.head_object(Bucket = self.bucket,
+                                       Key = self.root_dir + file_name)
+            return True
+        except self.s3_client.exceptions.ClientError:
+            return False
+
+    def load_to_buffer(self, model_name):
+        ''' Load model off S3 into a buffer '''
+        buffer = io.BytesIO(initial_bytes = self.load_bytes(model_name))
         buffer.seek(0)
         return buffer
 
@@ -61,7 +112,7 @@ class RetroS3Client:
     def load_model_config_buffer(self, model_name):
         ''' Load a (model, config) pair off S3 '''
         buffer = self.load_to_buffer(model_name)
-        loaded_dict = torch.load(buffer)
+        loaded_dict = load_pickled(buffer)
 
         model_buffer = loaded_dict['model']
         config_buffer = loaded_dict['config']
@@ -69,3 +120,322 @@ class RetroS3Client:
         config_buffer.seek(0)
 
         return model_buffer, config_buffer
+
+    def save_model_chunked(self, model, config, file_name, fp16 = False,
+                           compress = False, chunk_dir = 'chunks/'):
+        ''' Store a (model, config) pair as a manifest plus one content-hashed
+            chunk per tensor, skipping chunks that are already stored
+
+        Args:
+            model: object with a `get_state()` dictionary holding its tensors
+                under 'model' (e.g. BasicConvolutionNetwork)
+            config: object with a `get_state()` dictionary (e.g. CNNConfig)
+            file_name (str): name of the manifest, as used by `save_model`
+            fp16 (bool, optional): store floating point tensors as float16
+            compress (bool, optional): zlib-compress every chunk
+            chunk_dir (str, optional): folder shared by all chunks so that
+                unchanged tensors are shared across checkpoints
+        '''
+        model_state = dict(model.get_state(snapshot = True))
+        tensors = model_state.pop('model')
+        tensor_entries = []
+
+        for name, tensor in tensors.items():
+            array = tensor.detach().cpu().numpy()
+            stored = array.astype(np.float16) if fp16 and array.dtype.kind == 'f' else array
+            payload = np.ascontiguousarray(stored).tobytes()
+            if compress:
+                payload = zlib.compress(payload, 1)
+
+            chunk_name = chunk_dir + hashlib.sha256(payload).hexdigest()
+            if chunk_name not in self.stored_chunks and not self.exists(chunk_name):
+                self.save_bytes(payload, chunk_name)
+            self.stored_chunks.add(chunk_name)
+
+            tensor_entries.append({
+                'name': name,
+                'chunk': chunk_name,
+                'shape': list(array.shape),
+                'dtype': array.dtype.str,
+                'stored_dtype': stored.dtype.str,
+                'compressed': compress
+            })
+
+        with io.BytesIO() as buffer:
+            torch.save({
+                'format': CHUNKED_FORMAT,
+                'model': model_state,
+                'tensors': tensor_entries,
+                'config': config.get_state()
+            }, buffer)
+            self.save_buffer(buffer, file_name)
+
+    def load_model_config_state(self, model_name, max_workers = 8, cache = None):
+        ''' Load a (model, config) pair saved by either `save_model` or
+            `save_model_chunked`, fetching tensor chunks in parallel
+
+        Args:
+            model_name (str): file name the checkpoint was saved under
+            max_workers (int, optional): concurrent chunk downloads
+            cache (ModelCache, optional): local cache to load through
+
+        Returns:
+            tuple of the model and config state dictionaries, as accepted by
+            their `load_state()` methods
+        '''
+        if cache is not None:
+            return cache.load_model_config_state(self, model_name, max_workers)
+        return self.decode_checkpoint(load_pickled(self.load_to_buffer(model_name)),
+                                      max_workers)
+
+    def decode_checkpoint(self, loaded_dict, max_workers = 8):
+        ''' Return the (model, config) state pair of a loaded checkpoint
+            dictionary of either format, fetching chunks if needed '''
+        if loaded_dict.get('format') != CHUNKED_FORMAT:
+            model_buffer = loaded_dict['model']
+            config_buffer = loaded_dict['config']
+            model_buffer.seek(0)
+            config_buffer.seek(0)
+            return load_pickled(model_buffer), load_pickled(config_buffer)
+
+        entries = loaded_dict['tensors']
+        with ThreadPoolExecutor(max_workers = max_workers) as pool:
+            payloads = list(pool.map(self.load_bytes, [e['chunk'] for e in entries]))
+
+        tensors = OrderedDict()
+        for entry, payload in zip(entries, payloads):
+            if entry['compressed']:
+                payload = zlib.decompress(payload)
+            array = np.frombuffer(payload, dtype=np.dtype(entry['stored_dtype']))
+            array = array.astype(np.dtype(entry['dtype'])).reshape(entry['shape'])
+            tensors[entry['name']] = torch.from_numpy(array)
+
+        model_state = dict(loaded_dict['model'], model = tensors)
+        return model_state, loaded_dict['config']
+
+
+class RetroLocalClient(RetroS3Client):
+    ''' Stand-in for RetroS3Client with the same API that stores everything
+        under a local directory, for offline runs and benchmarks '''
+
+    def __init__(self, root_dir = 'model_outputs/'):
+        self.root_dir = os.path.join(os.path.expanduser(root_dir), '')
+        self.stored_chunks = set()
+
+    def get_path(self, file_name):
+        ''' Return the local path of `file_name`, creating its folder '''
+        path = self.root_dir + file_name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def save_buffer(self, buffer, file_name):
+        ''' Save a buffer into the local directory with the given file name '''
+        buffer.seek(0)
+        self.save_bytes(buffer.getbuffer(), file_name)
+
+    def save_bytes(self, body, file_name):
+        ''' Save raw bytes into the local directory, replacing the file
+            atomically so readers never see a partial write '''
+        path = self.get_path(file_name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+
+    def load_bytes(self, file_name):
+        ''' Load the raw bytes of a file from the local directory '''
+        with open(self.root_dir + file_name, 'rb') as f:
+            return f.read()
+
+    def exists(self, file_name):
+        ''' Return whether the file is already stored locally '''
+        return os.path.exists(self.root_dir + file_name)
+
+    def get_etag(self, file_name):
+        ''' Return an ETag stand-in built from the file's mtime and size '''
+        stat = os.stat(self.root_dir + file_name)
+        return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    def download_file(self, file_name, path):
+        ''' Copy the file from the local directory to `path` '''
+        shutil.copyfile(self.root_dir + file_name, path)
+
+
+class ModelCache:
+    ''' Size-bounded on-disk LRU cache of downloaded checkpoints
+
+        Each entry is keyed by the storage location and ETag of a checkpoint
+        and holds its decoded (model, config) states re-saved as one flat
+        file, so a repeat load memory-maps the tensors straight from the page
+        cache instead of downloading and unpickling nested buffers. The ETag
+        is checked with a HEAD request at most every `ttl` seconds, within
+        which repeat loads use no network at all. Hits refresh the entry's
+        mtime and the least recently used entries are evicted once the cache
+        exceeds `max_bytes`. Files are replaced atomically, so jobs on one
+        host can share the cache.
+    '''
+
+    def __init__(self, cache_dir = '~/.cache/retro_models',
+                 max_bytes = 4 * 2**30, ttl = 0):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, client, file_name):
+        ''' Return the cache key of `file_name` stored through `client` '''
+        location = '/'.join([getattr(client, 'bucket', 'local'),
+                             client.root_dir, file_name])
+        return hashlib.sha1(location.encode('utf-8')).hexdigest()
+
+    def get_etag(self, client, file_name):
+        ''' Return the ETag of `file_name`, only asking the storage if the last
+            check is older than `ttl` (or the storage is unreachable) '''
+        etag_path = os.path.join(self.cache_dir, self.get_key(client, file_name) + '.etag')
+        age = time() - os.path.getmtime(etag_path) if os.path.exists(etag_path) else None
+        if age is not None and age < self.ttl:
+            warn("Using the ETag of {} checked {:.0f}s ago, a newer upload may be "
+                 "missed".format(file_name, age))
+        else:
+            try:
+                self.write_atomic(etag_path, client.get_etag(file_name).encode('utf-8'))
+            except Exception as e:
+                if not os.path.exists(etag_path):
+                    raise
+                warn("Using the cached ETag of " + file_name + ": " + repr(e))
+        with open(etag_path, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def write_atomic(self, path, body):
+        ''' Write `body` to `path` through a temporary file in the cache '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def load_model_config_state(self, client, file_name, max_workers = 8):
+        ''' Return the (model, config) state pair of `file_name`, downloading
+            and decoding it into the cache on a miss '''
+        etag = re.sub('[^0-9A-Za-z-]', '', self.get_etag(client, file_name))
+        path = os.path.join(self.cache_dir,
+                            '{}-{}.pt'.format(self.get_key(client, file_name), etag))
+
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            os.close(fd)
+            try:
+                client.download_file(file_name, tmp_path)
+                model_state, config_state = client.decode_checkpoint(
+                    load_pickled(tmp_path), max_workers)
+                torch.save({'model': model_state, 'config': config_state}, tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self.evict(keep = path)
+
+        loaded_dict = load_mapped(path)
+        return loaded_dict['model'], loaded_dict['config']
+
+    def evict(self, keep = None):
+        ''' Remove least recently used entries until the cache fits '''
+        entries = sorted(glob.glob(os.path.join(self.cache_dir, '*.pt')),
+                         key=os.path.getmtime)
+        total = sum(os.path.getsize(p) for p in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                total -= os.path.getsize(path)
+                os.remove(path)
+
+
+def load_pickled(path_or_buffer, **kwargs):
+    ''' torch.load a checkpoint that holds pickled objects (nested buffers,
+        optimizer classes), which PyTorch 2.6 and later refuse by default '''
+    try:
+        return torch.load(path_or_buffer, weights_only = False, **kwargs)
+    except TypeError: # PyTorch versions without weights_only
+        return torch.load(path_or_buffer, **kwargs)
+
+
+def load_mapped(path):
+    ''' torch.load `path` with tensor storages memory-mapped from the file
+        where PyTorch supports it, instead of reading them into memory '''
+    try:
+        return load_pickled(path, mmap = True)
+    except TypeError: # PyTorch versions without mmap loading
+        return load_pickled(path)
+
+
+class StateSnapshot:
+    ''' Frozen state dictionary exposing the `.save()` method of the object
+        it was taken from, so it can be serialized later on another thread '''
+
+    def __init__(self, input):
+        self.state = input.get_state(snapshot = True)
+
+    def get_state(self, snapshot = False):
+        return self.state
+
+    def save(self, path_or_buffer):
+        torch.save(self.state, path_or_buffer)
+
+
+class BackgroundModelSaver:
+    ''' Save (model, config) checkpoints through `client` on a background
+        thread so training never waits on serialization or uploads
+
+        `save_model` only snapshots the parameters in memory. Passing
+        `chunk_options` saves through `save_model_chunked` with those options
+        instead of writing a full checkpoint. The queue holds a single pending
+        checkpoint: if uploads fall behind, a newer snapshot replaces the one
+        still waiting instead of piling up.
+    '''
+
+    def __init__(self, client, chunk_options = None):
+        self.client = client
+        self.chunk_options = chunk_options
+        self.pending = None
+        self.is_closed = False
+        self.replaced_count = 0
+        self.saved_count = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save_model(self, model, config, file_name):
+        ''' Snapshot a (model, config) pair and queue it for saving '''
+        job = (StateSnapshot(model), StateSnapshot(config), file_name)
+        with self.condition:
+            if self.pending is not None:
+                self.replaced_count += 1
+            self.pending = job
+            self.condition.notify()
+
+    def run(self):
+        ''' Save queued checkpoints until closed and drained '''
+        while True:
+            with self.condition:
+                while self.pending is None and not self.is_closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                job, self.pending = self.pending, None
+
+            try:
+                if self.chunk_options is None:
+                    self.client.save_model(*job)
+                else:
+                    self.client.save_model_chunked(*job, **self.chunk_options)
+                self.saved_count += 1
+            except Exception as e:
+                warn("Background checkpoint save failed: " + repr(e))
+
+    def close(self):
+        ''' Wait for the pending checkpoint to be saved and stop the thread '''
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Genesis button order used by the retro Sonic environments
+BUTTONS = ["B", "A", "MODE", "START", "UP", "DOWN", "LEFT", "RIGHT", "C", "Y", "X", "Z"]
+
+
+class SyntheticEnv:
+    """ Stand-in for the retro environment that needs neither the ROM nor
+        `retro_contest`, for benchmarks and offline runs
+
+    The level is a pre-generated strip of flat color blocks with light noise
+    that scrolls horizontally as the agent runs right or left, so every step
+    returns a fresh uint8 frame [height,width,color] like the emulator does.
+    The reward is `reward_scale` times the horizontal progress plus optional
+    Gaussian noise, and a round ends after `episode_length` steps or when the
+    end of the level is reached.
+    """
+
+    def __init__(self, frame_shape = (224,320,3), episode_length = 4500,
+                 reward_scale = 1.0, reward_noise = 0.0, speed = 8,
+                 level_width = 9600, seed = 0):
+        self.frame_shape = tuple(frame_shape)
+        self.episode_length = episode_length
+        self.reward_scale = reward_scale
+        self.reward_noise = reward_noise
+        self.speed = speed
+        self.level_width = level_width
+        self.rng = np.random.RandomState(seed)
+        self.buttons = BUTTONS
+
+        height, width, color = self.frame_shape
+        blocks = self.rng.randint(0, 256,
+            size=(height // 16 + 1, (level_width + width) // 16 + 1, color))
+        level = blocks.repeat(16, axis=0).repeat(16, axis=1)[:height,:level_width + width]
+        noise = self.rng.randint(-8, 9, size=level.shape)
+        self.level = np.clip(level + noise, 0, 255).astype(np.uint8)
+
+        self.x = 0
+        self.step_count = 0
+
+    def get_screen(self):
+        ''' Return a copy of the part of the level currently on screen '''
+        return self.level[:, self.x:self.x + self.frame_shape[1]].copy()
+
+    def reset(self):
+        self.x = 0
+        self.step_count = 0
+        return self.get_screen()
+
+    def step(self, buttons):
+        ''' Move by `speed` pixels per step while RIGHT or LEFT is pressed
+
+        Returns:
+            tuple of observation [height,width,color], reward, done and an info
+            dictionary with the horizontal position like the Sonic environments
+        '''
+        dx = self.speed * (int(buttons[BUTTONS.index("RIGHT")]) -
+                           int(buttons[BUTTONS.index("LEFT")]))
+        new_x = int(np.clip(self.x + dx, 0, self.level_width))
+        reward = self.reward_scale * (new_x - self.x)
+        if self.reward_noise > 0:
+            reward += self.rng.normal(0, self.reward_noise)
+
+        self.x = new_x
+        self.step_count += 1
+        done = self.step_count >= self.episode_length or self.x >= self.level_width
+        info = {'x': self.x, 'screen_x': self.x, 'screen_x_end': self.level_width}
+        return self.get_screen(), reward, done, info
+
+    def render(self):
+        pass
+
+    def close(self):
+        pass
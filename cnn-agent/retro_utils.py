@@ -1,24 +1,102 @@
-import io
+import numpy as np
 
-def get_environment(environment):
-    """ Return a local or remote environment as requested """
-    if environment in ['aws','local']:
+DEFAULT_GAME = 'SonicTheHedgehog-Genesis'
+DEFAULT_STATE = 'LabyrinthZone.Act1'
+
+# Validation levels of the OpenAI Retro Contest as (game, state) pairs
+CONTEST_VALIDATION_LEVELS = [
+    ('SonicTheHedgehog-Genesis', 'SpringYardZone.Act1'),
+    ('SonicTheHedgehog-Genesis', 'GreenHillZone.Act2'),
+    ('SonicTheHedgehog-Genesis', 'StarLightZone.Act3'),
+    ('SonicTheHedgehog-Genesis', 'ScrapBrainZone.Act1'),
+    ('SonicTheHedgehog2-Genesis', 'MetropolisZone.Act3'),
+    ('SonicTheHedgehog2-Genesis', 'HillTopZone.Act2'),
+    ('SonicTheHedgehog2-Genesis', 'CasinoNightZone.Act2'),
+    ('SonicAndKnuckles3-Genesis', 'LavaReefZone.Act1'),
+    ('SonicAndKnuckles3-Genesis', 'FlyingBatteryZone.Act2'),
+    ('SonicAndKnuckles3-Genesis', 'HydrocityZone.Act1'),
+    ('SonicAndKnuckles3-Genesis', 'AngelIslandZone.Act2')
+]
+
+class FrameSkipEnv:
+    """ Repeat each chosen button array for `frame_skip` emulator steps
+
+    Rewards are summed over the repeated steps, repetition stops early when
+    the round terminates, and the returned observation is the pixel-wise max
+    of the last two raw frames so sprites flickering between frames survive.
+    """
+
+    def __init__(self, env, frame_skip):
+        self.env = env
+        self.frame_skip = frame_skip
+
+    def reset(self):
+        return self.env.reset()
+
+    def step(self, buttons):
+        total_reward = 0
+        last_frames = []
+        for _ in range(self.frame_skip):
+            obs, reward, done, info = self.env.step(buttons)
+            total_reward += reward
+            last_frames = last_frames[-1:] + [obs]
+            if done:
+                break
+
+        if len(last_frames) == 2:
+            obs = np.maximum(last_frames[0], last_frames[1])
+        return obs, total_reward, done, info
+
+    def render(self):
+        self.env.render()
+
+    def close(self):
+        self.env.close()
+
+def get_environment(environment, frame_skip = 1, env_options = None,
+                    game = DEFAULT_GAME, state = DEFAULT_STATE):
+    """ Return a local, remote or synthetic environment as requested, playing
+        the level `state` of `game` when running the emulator locally """
+    if environment == 'synthetic':
+        from retro_synthetic import SyntheticEnv
+        env = SyntheticEnv(**(env_options or {}))
+    elif environment in ['aws','local']:
         from retro_contest.local import make
-        env = make(game='SonicTheHedgehog-Genesis', state='LabyrinthZone.Act1')
+        env = make(game=game, state=state)
     else:
         import gym_remote.exceptions as gre
         import gym_remote.client as grc
         env = grc.RemoteEnv('tmp/sock')
+    if frame_skip > 1:
+        env = FrameSkipEnv(env, frame_skip)
     return env
 
-def clone_checkpoint_nn(old_network):
-    """ Create a clone of the given network with the same parameters """
-    new_network_buffer = io.BytesIO()
-    old_network.save(new_network_buffer)
-    new_network_buffer.seek(0)
+def get_vector_environment(environment, num_envs = 1, frame_skip = 1,
+                           env_options = None):
+    """ Return a vectorized environment running `num_envs` emulators """
+    from retro_vec_env import DummyVecEnv, SubprocessVecEnv
+    if num_envs == 1:
+        return DummyVecEnv(get_environment(environment, frame_skip, env_options))
+    elif environment == 'remote':
+        raise ValueError("Remote environment only supports a single emulator")
+    else:
+        return SubprocessVecEnv(environment, num_envs, frame_skip = frame_skip,
+                                env_options = env_options)
 
-    new_network = type(old_network)()
-    new_network.load(new_network_buffer)
-    new_network.eval()
+def get_environment_options(args):
+    """ Return the options of the synthetic environment given on the command
+        line, or None for the emulator environments """
+    if args.environment != 'synthetic':
+        return None
+    return {
+        'episode_length': args.synthetic_episode_length,
+        'reward_scale': args.synthetic_reward_scale,
+        'reward_noise': args.synthetic_reward_noise
+    }
 
-    return new_network
+def get_worker_environment_options(env_options, index):
+    """ Return `env_options` for the worker `index` of several environments,
+        offsetting the synthetic seed so workers play different levels """
+    if env_options is None:
+        return None
+    return dict(env_options, seed = env_options.get('seed', 0) + index)
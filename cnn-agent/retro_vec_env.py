@@ -0,0 +1,146 @@
+import multiprocessing as mp
+import numpy as np
+
+import retro_utils
+
+
+def env_worker(environment, frame_skip, remote, parent_remote, shared_obs, index,
+               obs_shape, env_options = None):
+    ''' Run one emulator inside a worker process and serve commands sent over
+        `remote`, writing every observation into its slot of `shared_obs` '''
+    parent_remote.close()
+    env = retro_utils.get_environment(environment, frame_skip,
+        retro_utils.get_worker_environment_options(env_options, index))
+    obs_buffer = np.frombuffer(shared_obs, dtype=np.uint8).reshape(
+        (-1,) + obs_shape)[index]
+
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == 'step':
+                obs, reward, done, info = env.step(data)
+                if done: # Reset the screen if the game round was terminated
+                    obs = env.reset()
+                obs_buffer[...] = obs
+                remote.send((reward, done, info))
+            elif command == 'reset':
+                obs_buffer[...] = env.reset()
+                remote.send(None)
+            elif command == 'render':
+                env.render()
+                remote.send(None)
+            elif command == 'close':
+                break
+    finally:
+        env.close()
+        remote.close()
+
+
+class DummyVecEnv:
+    ''' Vectorized interface around a single in-process environment '''
+
+    def __init__(self, env):
+        self.env = env
+        self.num_envs = 1
+
+    def reset(self):
+        ''' Reset the environment and return observations [envs,h,w,color] '''
+        return np.expand_dims(self.env.reset(), 0)
+
+    def step(self, buttons_list):
+        ''' Apply one button array per environment, resetting finished rounds
+
+        Returns:
+            tuple of observations [envs,h,w,color], rewards [envs],
+            dones [envs] and a list of info dictionaries
+        '''
+        obs, reward, done, info = self.env.step(buttons_list[0])
+        if done: # Reset the screen if the game round was terminated
+            obs = self.env.reset()
+        return (np.expand_dims(obs, 0), np.array([reward], dtype=np.float32),
+                np.array([done]), [info])
+
+    def render(self):
+        self.env.render()
+
+    def close(self):
+        self.env.close()
+
+
+class SubprocessVecEnv:
+    ''' Run `num_envs` emulators in worker processes that share one uint8
+        observation buffer with the training process
+
+        The retro emulator only allows one instance per process, so each
+        environment gets its own worker. Workers write observations straight
+        into the shared buffer and only rewards, dones and infos travel over
+        the pipes. The returned observations are a view of that buffer and
+        are overwritten by the next `step` or `reset` call.
+    '''
+
+    def __init__(self, environment, num_envs, obs_shape = (224,320,3),
+                 frame_skip = 1, env_options = None):
+        self.num_envs = num_envs
+        self.obs_shape = tuple(obs_shape)
+        self.waiting = False
+
+        ctx = mp.get_context('spawn')
+        self.shared_obs = ctx.RawArray('B', int(num_envs * np.prod(obs_shape)))
+        self.observations = np.frombuffer(self.shared_obs, dtype=np.uint8).reshape(
+            (num_envs,) + self.obs_shape)
+
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(num_envs)])
+        self.processes = [
+            ctx.Process(target=env_worker, daemon=True, args=(environment, frame_skip,
+                work_remote, remote, self.shared_obs, index, self.obs_shape, env_options))
+            for index, (work_remote, remote) in enumerate(zip(self.work_remotes, self.remotes))
+        ]
+        for p in self.processes:
+            p.start()
+        for work_remote in self.work_remotes:
+            work_remote.close()
+
+    def reset(self):
+        ''' Reset all environments and return observations [envs,h,w,color] '''
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.observations
+
+    def step_async(self, buttons_list):
+        ''' Send one button array to each environment without waiting '''
+        for remote, buttons in zip(self.remotes, buttons_list):
+            remote.send(('step', buttons))
+        self.waiting = True
+
+    def step_wait(self):
+        ''' Wait for all environments to finish the step sent by `step_async`
+
+        Returns:
+            tuple of observations [envs,h,w,color], rewards [envs],
+            dones [envs] and a list of info dictionaries
+        '''
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        rewards, dones, infos = zip(*results)
+        return (self.observations, np.array(rewards, dtype=np.float32),
+                np.array(dones), list(infos))
+
+    def step(self, buttons_list):
+        ''' Apply one button array per environment, resetting finished rounds '''
+        self.step_async(buttons_list)
+        return self.step_wait()
+
+    def render(self):
+        ''' Render the first environment only '''
+        self.remotes[0].send(('render', None))
+        self.remotes[0].recv()
+
+    def close(self):
+        if self.waiting:
+            self.step_wait()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.processes:
+            p.join()
@@ -0,0 +1,61 @@
+import math
+import numpy as np
+import pytest
+
+from cnn_anomaly import AnomalyDetector, P2Quantile, RunningStats, StreamingMetric
+
+
+def test_running_stats_match_numpy():
+    values = np.random.RandomState(0).normal(3.0, 2.0, size=1000)
+    stats = RunningStats()
+    for x in values:
+        stats.update(x)
+
+    assert stats.count == 1000
+    assert stats.mean == pytest.approx(values.mean())
+    assert stats.std() == pytest.approx(values.std(ddof=1))
+
+
+@pytest.mark.parametrize('p', [0.5, 0.9, 0.99])
+def test_p2_quantile_tracks_sample_quantile(p):
+    values = np.random.RandomState(1).normal(size=20000)
+    quantile = P2Quantile(p)
+    for x in values:
+        quantile.update(x)
+
+    assert quantile.value() == pytest.approx(np.quantile(values, p), abs=0.05)
+
+
+def test_p2_quantile_before_five_observations():
+    quantile = P2Quantile(0.5)
+    assert math.isnan(quantile.value())
+    for x in [3.0, 1.0, 2.0]:
+        quantile.update(x)
+    assert quantile.value() == 2.0
+
+
+def test_streaming_metric_waits_for_warmup():
+    metric = StreamingMetric(quantile = 0.99, z_threshold = 3.0, warmup = 100)
+    values = np.random.RandomState(2).normal(size=200)
+    for x in values[:50]:
+        metric.update(x)
+    assert not metric.is_outlier(100.0)
+
+    for x in values[50:]:
+        metric.update(x)
+    assert metric.is_outlier(100.0)
+    assert not metric.is_outlier(-100.0)
+    assert not metric.is_outlier(0.5)
+
+
+def test_anomaly_detector_flags_metrics_on_their_tails():
+    detector = AnomalyDetector(quantile = 0.99, z_threshold = 3.0, warmup = 100)
+    rng = np.random.RandomState(3)
+    for _ in range(500):
+        detector.observe({'loss': rng.uniform(0, 1), 'reward': rng.normal(),
+                          'td_error': None, 'q_spread': float('nan')})
+
+    assert detector.observe({'loss': 50.0, 'reward': -50.0}) == ['loss', 'reward']
+    assert detector.observe({'loss': -50.0}) == []
+    assert detector.summary()['loss']['count'] == 502
+    assert detector.summary()['td_error']['count'] == 0
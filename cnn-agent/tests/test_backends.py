@@ -0,0 +1,56 @@
+import sys
+import threading
+import pytest
+
+from retro_backends import BackendRegistry, get_storage_client
+
+
+BACKEND_SOURCE = '''
+created = []
+
+class Backend:
+    def __init__(self, name, suffix = ''):
+        created.append(name)
+        self.name = name + suffix
+'''
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    (tmp_path / 'fake_backend.py').write_text(BACKEND_SOURCE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, 'fake_backend', raising=False)
+    registry = BackendRegistry('test')
+    registry.register('fake', 'fake_backend:Backend')
+    return registry
+
+
+def test_registry_creates_backend_with_arguments(registry):
+    backend = registry.create('fake', 'a', suffix = '!')
+    assert backend.name == 'a!'
+
+
+def test_lazy_backend_imports_on_first_use(registry):
+    backend = registry.lazy('fake', 'a')
+    assert 'fake_backend' not in sys.modules
+
+    assert backend.name == 'a'
+    assert sys.modules['fake_backend'].created == ['a']
+
+
+def test_lazy_backend_is_created_once_across_threads(registry):
+    backend = registry.lazy('fake', 'a')
+    threads = [threading.Thread(target=lambda: backend.name) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sys.modules['fake_backend'].created == ['a']
+
+
+def test_unknown_backends_are_rejected(registry):
+    with pytest.raises(ValueError):
+        registry.create('missing')
+    with pytest.raises(ValueError):
+        get_storage_client('ftp')
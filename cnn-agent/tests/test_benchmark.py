@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from cnn_benchmark import BenchmarkArgumentParser, run_benchmark
+
+
+def test_startup_benchmark_reaches_first_action():
+    args = BenchmarkArgumentParser().parse_args(['startup', '--repeats', '1',
+                                                 '--image_dimension', '100,100'])
+    results = run_benchmark('startup', args)
+
+    assert results['median_first_action_seconds'] > results['median_import_seconds'] > 0
+    assert 'boto3' not in results['heavy_modules']
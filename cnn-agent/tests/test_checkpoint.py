@@ -0,0 +1,120 @@
+import os
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from cnn_config import CNNConfig
+from cnn_model import BasicConvolutionNetwork
+from retro_s3 import ModelCache, RetroLocalClient
+
+
+class CountingClient(RetroLocalClient):
+    ''' Local client counting the checkpoint downloads '''
+
+    def __init__(self, root_dir):
+        super(CountingClient, self).__init__(root_dir)
+        self.download_count = 0
+
+    def download_file(self, file_name, path):
+        self.download_count += 1
+        super(CountingClient, self).download_file(file_name, path)
+
+
+def assert_same_tensors(loaded, expected, **tolerance):
+    assert list(loaded) == list(expected)
+    for name, tensor in expected.items():
+        assert loaded[name].dtype == tensor.dtype
+        torch.testing.assert_close(loaded[name], tensor, **tolerance)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_chunked_checkpoint_round_trips(tmp_path, compress):
+    client = RetroLocalClient(str(tmp_path))
+    model, config = BasicConvolutionNetwork(), CNNConfig(gamma = 0.9)
+    client.save_model_chunked(model, config, 'model.pt', compress = compress)
+
+    model_state, config_state = client.load_model_config_state('model.pt')
+    assert_same_tensors(model_state['model'], model.state_dict(), rtol=0, atol=0)
+    assert model_state['epsilon'] == model.epsilon
+    assert config_state['gamma'] == 0.9
+
+
+def test_chunked_checkpoint_stores_fp16_tensors(tmp_path):
+    client = RetroLocalClient(str(tmp_path))
+    model = BasicConvolutionNetwork()
+    client.save_model_chunked(model, CNNConfig(), 'model.pt', fp16 = True)
+
+    model_state = client.load_model_config_state('model.pt')[0]
+    assert_same_tensors(model_state['model'], model.state_dict(), rtol=1e-3, atol=1e-4)
+
+
+def test_chunked_checkpoint_reuses_unchanged_chunks(tmp_path):
+    client = RetroLocalClient(str(tmp_path))
+    model = BasicConvolutionNetwork()
+    client.save_model_chunked(model, CNNConfig(), 'first.pt')
+    chunk_count = len(os.listdir(str(tmp_path / 'chunks')))
+
+    # A fresh client finds the stored chunks on disk instead of in memory
+    client = RetroLocalClient(str(tmp_path))
+    client.save_model_chunked(model, CNNConfig(), 'second.pt')
+    assert len(os.listdir(str(tmp_path / 'chunks'))) == chunk_count
+
+    with torch.no_grad():
+        next(model.parameters()).add_(1)
+    client.save_model_chunked(model, CNNConfig(), 'third.pt')
+    assert len(os.listdir(str(tmp_path / 'chunks'))) == chunk_count + 1
+
+
+def test_full_checkpoint_decodes_like_chunked(tmp_path):
+    client = RetroLocalClient(str(tmp_path))
+    model = BasicConvolutionNetwork()
+    client.save_model(model, CNNConfig(gamma = 0.9), 'model.pt')
+
+    model_state, config_state = client.load_model_config_state('model.pt')
+    assert_same_tensors(model_state['model'], model.state_dict(), rtol=0, atol=0)
+    assert config_state['gamma'] == 0.9
+
+
+def test_model_cache_reuses_entry_until_etag_changes(tmp_path):
+    client = CountingClient(str(tmp_path / 'models'))
+    cache = ModelCache(str(tmp_path / 'cache'), ttl = 0)
+    model = BasicConvolutionNetwork()
+    client.save_model_chunked(model, CNNConfig(), 'model.pt')
+
+    for _ in range(2):
+        model_state = client.load_model_config_state('model.pt', cache = cache)[0]
+        assert_same_tensors(model_state['model'], model.state_dict(), rtol=0, atol=0)
+    assert client.download_count == 1
+
+    with torch.no_grad():
+        next(model.parameters()).add_(1)
+    client.save_model_chunked(model, CNNConfig(gamma = 0.5), 'model.pt')
+    model_state, config_state = client.load_model_config_state('model.pt', cache = cache)
+    assert client.download_count == 2
+    assert config_state['gamma'] == 0.5
+    assert_same_tensors(model_state['model'], model.state_dict(), rtol=0, atol=0)
+
+
+def test_model_cache_evicts_least_recently_used(tmp_path):
+    client = RetroLocalClient(str(tmp_path / 'models'))
+    cache = ModelCache(str(tmp_path / 'cache'), max_bytes = 0)
+    for name in ['first.pt', 'second.pt']:
+        client.save_model(BasicConvolutionNetwork(), CNNConfig(), name)
+        client.load_model_config_state(name, cache = cache)
+
+    # Only the entry just loaded is kept once the cache is over budget
+    entries = [f for f in os.listdir(str(tmp_path / 'cache')) if f.endswith('.pt')]
+    assert len(entries) == 1
+    assert entries[0].startswith(cache.get_key(client, 'second.pt'))
+
+
+def test_model_cache_warns_when_serving_unchecked_etag(tmp_path):
+    client = CountingClient(str(tmp_path / 'models'))
+    cache = ModelCache(str(tmp_path / 'cache'), ttl = 300)
+    client.save_model(BasicConvolutionNetwork(), CNNConfig(), 'model.pt')
+    client.load_model_config_state('model.pt', cache = cache)
+
+    client.save_model(BasicConvolutionNetwork(), CNNConfig(), 'model.pt')
+    with pytest.warns(UserWarning, match='newer upload may be missed'):
+        client.load_model_config_state('model.pt', cache = cache)
+    assert client.download_count == 1
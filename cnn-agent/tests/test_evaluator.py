@@ -0,0 +1,23 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from cnn_evaluator import RetroEvaluator
+
+
+def test_recent_screens_are_kept_as_uint8(tmp_path):
+    evaluator = RetroEvaluator(str(tmp_path), log_system = 'local',
+                               print_log_messages = False, max_selective = 0,
+                               screen_buffer_size = 4)
+    screens = [torch.full((3, 4, 5), i / 255) for i in range(6)]
+    for screen in screens:
+        evaluator.summarize_step(torch.zeros(18), 0, 0.0, next_screen = screen)
+    evaluator.summarize_step(torch.zeros(18), 0, 0.0)
+
+    assert evaluator.screen_frames.dtype == torch.uint8
+    assert evaluator.screen_frames.shape == (4, 3, 4, 5)
+    assert evaluator.get_recent_step(1) is None # Overwritten
+    assert evaluator.get_recent_step(6) is None # No screen given
+    screen, Q_estimate = evaluator.get_recent_step(5)
+    assert torch.equal(screen, torch.full((3, 4, 5), 5, dtype=torch.uint8))
+    evaluator.close()
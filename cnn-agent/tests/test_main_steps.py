@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from cnn_benchmark import run_main_steps
+from cnn_model import BasicConvolutionNetwork
+
+
+@pytest.mark.parametrize('mode, main_args, load_model', [
+    ('build', ['--use_experience_replay', '--batch_size', '4'], False),
+    ('build', ['--num_actors', '2', '--batch_size', '2', '--memory_size', '64',
+               '--weight_sync_interval', '2'], False),
+    ('validate', [], True),
+    ('validate', ['--levels', 'a:b,c:d', '--episode_steps', '20',
+                  '--synthetic_episode_length', '10'], True),
+    ('validate', [], False),
+    ('validate', ['--inference_engine'], True),
+    ('validate', ['--inference_engine', '--quantize', 'static', '--calibration_steps', '4',
+                  '--accuracy_gap'], True),
+    ('test', [], True)
+])
+def test_main_runs_steps_on_synthetic_env(mode, main_args, load_model):
+    model = BasicConvolutionNetwork() if load_model else None
+    assert run_main_steps(mode, 3, main_args, model) > 0
@@ -0,0 +1,244 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from cnn_memory import SumTree, get_replay_memory
+
+
+SCREEN_SHAPE = (3, 4, 5)
+
+
+def make_screens(count, seed = 0):
+    ''' Return `count` screens of random bytes scaled into [0,1] '''
+    generator = torch.Generator().manual_seed(seed)
+    pixels = torch.randint(0, 256, (count,) + SCREEN_SHAPE, generator=generator)
+    return [screen for screen in pixels.float().div(255)]
+
+
+def fill(memory, screens, done_every = 0):
+    ''' Add the chained transitions screens[i] -> screens[i+1] '''
+    for i in range(len(screens) - 1):
+        done = done_every > 0 and (i + 1) % done_every == 0
+        memory.add_memory(screens[i], i % 18, float(i), screens[i + 1], done)
+
+
+def read_slots(memory, slots):
+    ''' Return the start screens, actions, rewards, end screens and dones
+        stored at `slots` '''
+    memory.set_batch(torch.LongTensor(list(slots)))
+    starts = memory.get_batch_start_including()
+    actions, rewards, ends = memory.get_batch_post_action_including()
+    return starts, actions, rewards, ends, memory.get_batch_dones_including()
+
+
+def test_ring_memory_round_trips_byte_screens():
+    memory = get_replay_memory('ring', batch_size = 4, memory_size = 8)
+    screens = make_screens(6)
+    fill(memory, screens, done_every = 2)
+
+    starts, actions, rewards, ends, dones = read_slots(memory, range(5))
+    assert torch.equal(starts, torch.stack(screens[:5]))
+    assert torch.equal(ends, torch.stack(screens[1:]))
+    assert actions.tolist() == list(range(5))
+    assert rewards.tolist() == [float(i) for i in range(5)]
+    assert dones.tolist() == [0, 1, 0, 1, 0]
+
+
+def test_ring_memory_rounds_resized_screens_to_bytes():
+    memory = get_replay_memory('ring', memory_size = 2)
+    screen = torch.rand(SCREEN_SHAPE)
+    memory.add_memory(screen, 0, 0.0, screen)
+
+    starts = read_slots(memory, [0])[0]
+    assert (starts[0] - screen).abs().max() <= 1 / 510 + 1e-6
+
+
+def test_ring_memory_overwrites_oldest_slots():
+    memory = get_replay_memory('ring', memory_size = 4)
+    screens = make_screens(7)
+    fill(memory, screens)
+
+    assert len(memory) == 4
+    assert memory.head == 2
+    starts, actions = read_slots(memory, [0, 1, 2, 3])[:2]
+    assert actions.tolist() == [4, 5, 2, 3]
+    assert torch.equal(starts[0], screens[4])
+
+    memory.batch_size = 64
+    memory.sample_new_batch()
+    assert set(memory.last_batch.tolist()) <= {0, 1, 2, 3}
+
+
+def test_frame_table_memory_stores_chained_screens_once():
+    memory = get_replay_memory('dedup', memory_size = 8)
+    screens = make_screens(6)
+    fill(memory, screens)
+
+    assert memory.frame_count == 6
+    starts, actions, rewards, ends, dones = read_slots(memory, range(5))
+    assert torch.equal(starts, torch.stack(screens[:5]))
+    assert torch.equal(ends, torch.stack(screens[1:]))
+    assert actions.tolist() == list(range(5))
+
+
+def test_frame_table_memory_starts_new_chain_after_done():
+    memory = get_replay_memory('dedup', memory_size = 8)
+    screens = make_screens(6)
+    fill(memory, screens, done_every = 2)
+
+    assert memory.frame_count == 8
+    starts, actions, rewards, ends, dones = read_slots(memory, range(5))
+    assert torch.equal(starts, torch.stack(screens[:5]))
+    assert torch.equal(ends, torch.stack(screens[1:]))
+    assert dones.tolist() == [0, 1, 0, 1, 0]
+
+
+def test_frame_table_memory_stacks_preceding_frames():
+    memory = get_replay_memory('dedup', memory_size = 8, frame_stack = 2)
+    screens = make_screens(4)
+    fill(memory, screens)
+
+    starts, actions, rewards, ends, dones = read_slots(memory, [0, 2])
+    assert starts.shape == (2, 6, 4, 5)
+    assert torch.equal(starts[0], torch.cat([screens[0], screens[0]]))
+    assert torch.equal(starts[1], torch.cat([screens[1], screens[2]]))
+    assert torch.equal(ends[1], torch.cat([screens[2], screens[3]]))
+
+
+def test_frame_table_memory_evicts_overwritten_starts():
+    memory = get_replay_memory('dedup', memory_size = 3)
+    screens = make_screens(6)
+    # Unchained transitions write two frames each into the 4 frame table
+    for i in range(3):
+        memory.add_memory(screens[2 * i], i, 0.0, screens[2 * i + 1].clone())
+
+    assert len(memory) == 2
+    starts, actions, rewards, ends = read_slots(memory, [1, 2])[:4]
+    assert actions.tolist() == [1, 2]
+    assert torch.equal(starts, torch.stack([screens[2], screens[4]]))
+    assert torch.equal(ends, torch.stack([screens[3], screens[5]]))
+
+
+def test_memory_mapped_memory_reopens_flushed_slots(tmp_path):
+    memory = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    screens = make_screens(5)
+    fill(memory, screens, done_every = 2)
+    memory.flush()
+
+    reopened = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    assert (reopened.head, len(reopened)) == (4, 4)
+    starts, actions, rewards, ends, dones = read_slots(reopened, range(4))
+    assert torch.equal(starts, torch.stack(screens[:4]))
+    assert torch.equal(ends, torch.stack(screens[1:]))
+    assert rewards.tolist() == [0.0, 1.0, 2.0, 3.0]
+    assert dones.tolist() == [0, 1, 0, 1]
+
+
+def test_memory_mapped_header_only_advances_on_flush(tmp_path):
+    memory = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    screens = make_screens(5)
+    fill(memory, screens[:3])
+    memory.flush(background = True)
+    memory.flush_thread.join()
+    fill(memory, screens[2:])
+
+    reopened = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    assert len(reopened) == 2
+    memory.flush()
+    reopened = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    assert len(reopened) == 4
+
+
+def test_memory_mapped_memory_rejects_other_size(tmp_path):
+    get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    with pytest.raises(ValueError):
+        get_replay_memory('mmap', memory_size = 16, replay_folder = str(tmp_path))
+
+
+def test_memory_mapped_memory_rejects_other_screen_shape(tmp_path):
+    memory = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path))
+    fill(memory, make_screens(3))
+    memory.flush()
+
+    with pytest.raises(ValueError):
+        get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path),
+                          screen_shape = (1, 4, 5))
+    reopened = get_replay_memory('mmap', memory_size = 8, replay_folder = str(tmp_path),
+                                 screen_shape = SCREEN_SHAPE)
+    gray = torch.zeros((1, 4, 5))
+    with pytest.raises(ValueError):
+        reopened.add_memory(gray, 0, 0.0, gray)
+
+
+def test_sum_tree_finds_leaves_by_prefix_sum():
+    tree = SumTree(5)
+    tree.update([0, 1, 2, 3, 4], [1.0, 2.0, 0.0, 3.0, 4.0])
+
+    assert tree.total() == 10.0
+    values = np.arange(10) + 0.5
+    assert tree.find(values).tolist() == [0, 1, 1, 3, 3, 3, 4, 4, 4, 4]
+
+    tree.update([4], [0.0])
+    assert tree.total() == 6.0
+    assert tree.find([5.99]).tolist() == [3]
+
+
+def test_sum_tree_samples_in_proportion_to_priority():
+    tree = SumTree(4)
+    tree.update(np.arange(4), [1.0, 2.0, 3.0, 4.0])
+
+    values = np.random.RandomState(0).uniform(0, tree.total(), size=20000)
+    counts = np.bincount(tree.find(values), minlength=4)
+    np.testing.assert_allclose(counts / counts.sum(), [0.1, 0.2, 0.3, 0.4], atol=0.02)
+
+
+def test_prioritized_memory_replays_high_priority_slots():
+    memory = get_replay_memory('prioritized', batch_size = 8, memory_size = 8,
+                               priority_alpha = 1.0, priority_beta = 1.0)
+    fill(memory, make_screens(9))
+
+    memory.set_batch(torch.arange(8))
+    memory.update_priorities(torch.FloatTensor([1e-3] * 7 + [10.0]))
+    memory.sample_new_batch()
+    assert len(memory.last_batch) == 8
+    assert memory.last_batch.tolist().count(7) >= 7
+
+    # The rarely sampled low-priority slots get the largest weights
+    memory.set_batch(torch.LongTensor([0, 7]))
+    assert memory.get_batch_weights_including().tolist() == [1.0, pytest.approx(1e-4, rel=1e-4)]
+
+
+@pytest.mark.parametrize('delta', [False, True])
+def test_compressed_memory_round_trips_screens(delta):
+    memory = get_replay_memory('compressed', memory_size = 8, delta = delta,
+                               decode_threads = 2)
+    screens = make_screens(7)
+    fill(memory, screens, done_every = 3)
+
+    # Slots out of order, so chains are decoded across the thread pool
+    order = [5, 0, 3, 1, 4, 2]
+    starts, actions, rewards, ends, dones = read_slots(memory, order)
+    assert torch.equal(starts, torch.stack([screens[i] for i in order]))
+    assert torch.equal(ends, torch.stack([screens[i + 1] for i in order]))
+    assert dones.tolist() == [1 if i % 3 == 2 else 0 for i in order]
+
+
+def test_compressed_memory_stacks_delta_frames():
+    memory = get_replay_memory('compressed', memory_size = 16, frame_stack = 3,
+                               delta = True)
+    screens = make_screens(12)
+    fill(memory, screens)
+
+    starts, actions, rewards, ends = read_slots(memory, [1, 10])[:4]
+    assert torch.equal(starts[0], torch.cat([screens[0], screens[0], screens[1]]))
+    assert torch.equal(ends[1], torch.cat(screens[9:12]))
+
+
+def test_compressed_memory_shrinks_static_screens():
+    memory = get_replay_memory('compressed', memory_size = 8)
+    screen = torch.zeros(SCREEN_SHAPE)
+    for i in range(4):
+        memory.add_memory(screen, 0, 0.0, screen.clone())
+
+    assert memory.compression_ratio() > 1
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from cnn_preprocess import ScreenPreprocessor
+
+
+def make_frames(count, height = 224, width = 320):
+    return np.random.RandomState(0).randint(0, 256, size=(count, height, width, 3),
+                                            dtype=np.uint8)
+
+
+@pytest.mark.filterwarnings('error')
+@pytest.mark.parametrize('image_to_grayscale, image_dimension', [
+    (False, (320,224)),
+    (False, (160,112)),
+    (True, (320,224)),
+    (True, (80,56))
+])
+def test_single_frame_converts_like_batch(image_to_grayscale, image_dimension):
+    preprocessor = ScreenPreprocessor(image_to_grayscale, image_dimension)
+    frames = make_frames(2)
+
+    batch = preprocessor(frames)
+    screen = preprocessor(frames[0])
+    assert batch.shape == preprocessor.output_shape(2)
+    assert screen.shape == preprocessor.output_shape()
+    torch.testing.assert_close(screen, batch[0])
+
+
+def test_single_frame_writes_into_buffer():
+    preprocessor = ScreenPreprocessor(image_dimension = (160,112))
+    out = torch.empty(preprocessor.output_shape())
+    frame = make_frames(1)[0]
+
+    assert preprocessor(frame, out) is out
+    torch.testing.assert_close(out, preprocessor(frame))
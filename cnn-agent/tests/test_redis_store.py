@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from retro_redis import RedisMetricsStore
+
+
+def make_memory(start, count):
+    return [{'counter': c, 'action': c % 18, 'reward': float(c) / 2,
+             'loss': None if c % 5 == 0 else float(c) / 10}
+            for c in range(start, start + count)]
+
+
+def test_common_metrics_round_trip():
+    store = RedisMetricsStore(fakeredis.FakeStrictRedis(), 'model')
+    store.register()
+    store.write_common(make_memory(0, 10))
+    store.write_common(make_memory(10, 10))
+
+    metrics = store.read_metrics(5, 15)
+    assert list(metrics['counter']) == list(range(5, 15))
+    assert list(metrics['action']) == [c % 18 for c in range(5, 15)]
+    np.testing.assert_allclose(metrics['reward'], [c / 2 for c in range(5, 15)])
+    assert np.isnan(metrics['loss'][metrics['counter'] == 10][0])
+    np.testing.assert_allclose(metrics['loss'][metrics['counter'] == 6], [0.6], rtol=1e-6)
+
+
+def test_restarted_run_writes_its_own_streams():
+    client = fakeredis.FakeStrictRedis()
+    first = RedisMetricsStore(client, 'model', run_id = 1)
+    first.register()
+    first.write_common(make_memory(0, 10))
+
+    # A restart counts from zero again, which one shared stream would reject
+    second = RedisMetricsStore(client, 'model', run_id = 2)
+    second.register()
+    second.write_common(make_memory(0, 5))
+
+    assert second.get_runs() == ['1', '2']
+    assert len(first.read_metrics(0, 100)['counter']) == 10
+    assert len(second.read_metrics(0, 100)['counter']) == 5
+
+
+def test_decoding_client_is_rejected():
+    with pytest.raises(ValueError):
+        RedisMetricsStore(fakeredis.FakeStrictRedis(decode_responses=True), 'model')
+
+
+def test_selective_round_trip():
+    torch = pytest.importorskip('torch')
+    store = RedisMetricsStore(fakeredis.FakeStrictRedis(), 'model')
+    screen = torch.randint(0, 256, (3, 4, 5), dtype=torch.uint8)
+    Q_estimate, Q_future = torch.rand(18), torch.rand(18)
+    store.write_selective([{
+        'counter': 7, 'reason': 'loss', 'Q_estimate': Q_estimate, 'Q_future': Q_future,
+        'screen': screen, 'context': [(screen, Q_estimate), (screen, Q_future)]
+    }])
+
+    [entry] = store.read_selective(0, 10)
+    assert entry['counter'] == 7 and entry['reason'] == 'loss'
+    np.testing.assert_array_equal(entry['screen'], screen.numpy())
+    np.testing.assert_allclose(entry['Q_estimate'], Q_estimate.numpy())
+    assert entry['context'].shape == (2, 3, 4, 5)
+    np.testing.assert_allclose(entry['context_Q'][1], Q_future.numpy())
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from cnn_model import BasicConvolutionNetwork
+from cnn_validation import summarize_levels, validate_level
+
+
+def test_validate_level_plays_episode_to_completion():
+    model_state = BasicConvolutionNetwork(image_dimension = (100,100)).get_state(snapshot = True)
+    result = validate_level(model_state, 'game', 'state', 'synthetic', episode_steps = 50,
+                            env_options = {'episode_length': 5})
+
+    assert (result['game'], result['state'], result['steps']) == ('game', 'state', 5)
+    assert 0.0 <= result['progress'] <= 1.0
+
+
+def test_validate_level_stops_at_step_budget():
+    model_state = BasicConvolutionNetwork(image_dimension = (100,100),
+                                          frame_stack = 2).get_state(snapshot = True)
+    results = [validate_level(model_state, 'game', state, 'synthetic', episode_steps = 3)
+               for state in ['a', 'b']]
+
+    assert [r['steps'] for r in results] == [3, 3]
+    assert summarize_levels(results)['total_steps'] == 6
@@ -0,0 +1,24 @@
+import numpy as np
+
+import retro_utils
+from retro_synthetic import SyntheticEnv
+from retro_vec_env import SubprocessVecEnv
+
+
+def test_subprocess_workers_play_different_synthetic_levels():
+    env_options = {'episode_length': 10, 'reward_noise': 1.0}
+    game_env = SubprocessVecEnv('synthetic', 2, env_options = env_options)
+    try:
+        obs = game_env.reset().copy()
+        rewards = game_env.step([[0] * 12, [0] * 12])[1]
+    finally:
+        game_env.close()
+
+    assert not np.array_equal(obs[0], obs[1])
+    assert rewards[0] != rewards[1]
+    np.testing.assert_array_equal(obs[1], SyntheticEnv(seed = 1, **env_options).reset())
+
+
+def test_worker_options_keep_emulator_options_unset():
+    assert retro_utils.get_worker_environment_options(None, 3) is None
+    assert retro_utils.get_worker_environment_options({'seed': 5}, 3) == {'seed': 8}